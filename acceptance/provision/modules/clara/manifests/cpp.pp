@@ -7,6 +7,7 @@ class clara::cpp {
         "build-essential",
         "g++",
         "cmake",
+        "ccache",
     ]:
     }
 
@@ -7,8 +7,7 @@ class clara::env {
 
     file { [
         "/home/vagrant/clara",
-        "/vagrant/acceptance/services",
-        "/vagrant/acceptance/services/log",
+        "/vagrant/acceptance/log",
     ]:
         ensure => "directory",
     }
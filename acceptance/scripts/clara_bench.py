@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+
+from clara_report import percentile
+
+bench_actions = ('list', 'cycle')
+bench_instance = 'dpe.bench%d'
+
+
+def parse_mix(text):
+    mix = []
+    for part in filter(None, text.split(',')):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in bench_actions:
+            raise ValueError('Unsupported bench action: %s' % name)
+        try:
+            weight = int(weight or 1)
+        except ValueError:
+            raise ValueError('Bad weight for %s: %s' % (name, weight))
+        if weight > 0:
+            mix.append((name, weight))
+    if not mix:
+        raise ValueError('Empty bench mix: "%s"' % text)
+    return mix
+
+
+class BenchClient():
+
+    def __init__(self, client, node, lang, index, mix, seed=None):
+        self.samples = []
+        self._client = client
+        self._node = node
+        self._lang = lang
+        self._instance = bench_instance % index
+        self._choices = sum([[name] * weight for name, weight in mix], [])
+        self._random = random.Random(seed)
+        self._running = False
+
+    def run(self, deadline):
+        while time.time() < deadline:
+            kind = self._random.choice(self._choices)
+            if kind == 'list':
+                self._timed('list', 'clara:request:%s:list-dpes' % self._lang)
+            elif kind == 'cycle':
+                if self._timed('start', self._message('start')):
+                    self._running = True
+                    if self._timed('stop', self._message('stop')):
+                        self._running = False
+        self.cleanup()
+
+    def cleanup(self):
+        if self._running:
+            try:
+                self._client.request(self._node, self._message('stop'))
+                self._running = False
+            except Exception:
+                pass
+
+    def _message(self, action):
+        return 'clara:%s:%s:%s' % (action, self._lang, self._instance)
+
+    def _timed(self, kind, msg):
+        start = time.time()
+        try:
+            self._client.request(self._node, msg)
+            ok = True
+        except Exception:
+            ok = False
+        self.samples.append((kind, time.time() - start, ok))
+        return ok
+
+
+def bench_stats(samples, elapsed):
+    latencies = {}
+    errors = {}
+    for kind, latency, ok in samples:
+        latencies.setdefault(kind, []).append(latency)
+        errors[kind] = errors.get(kind, 0) + (not ok)
+    stats = {}
+    for kind, values in latencies.items():
+        stats[kind] = {
+            'count': len(values),
+            'errors': errors[kind],
+            'throughput': len(values) / elapsed if elapsed else 0.0,
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': max(values),
+        }
+    return stats
+
+
+def run_bench(make_client, node, clients=4, duration=30.0,
+              mix=(('list', 1),), lang='java', seed=None):
+    workers = []
+    for index in range(clients):
+        client = make_client()
+        worker_seed = None if seed is None else seed + index
+        workers.append(BenchClient(client, node, lang, index, mix,
+                                   worker_seed))
+
+    start = time.time()
+    deadline = start + duration
+    threads = [threading.Thread(target=w.run, args=(deadline,))
+               for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    for worker in workers:
+        close = getattr(worker._client, 'close', None)
+        if close is not None:
+            close()
+
+    samples = sum([w.samples for w in workers], [])
+    errors = sum(1 for _, _, ok in samples if not ok)
+    return {
+        'node': node,
+        'lang': lang,
+        'clients': clients,
+        'duration': duration,
+        'elapsed': elapsed,
+        'mix': dict(mix),
+        'requests': len(samples),
+        'errors': errors,
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'actions': bench_stats(samples, elapsed),
+    }
+
+
+def format_bench(result):
+    lines = [
+        '%d clients on %s for %.1f s: %d requests, %d errors, %.1f req/s' %
+        (result['clients'], result['node'], result['elapsed'],
+         result['requests'], result['errors'], result['throughput']),
+        '',
+        '%-8s %7s %6s %9s %8s %8s %8s %8s' %
+        ('action', 'count', 'errors', 'req/s', 'p50', 'p95', 'p99', 'max'),
+    ]
+    for kind, stats in sorted(result['actions'].items()):
+        lines.append('%-8s %7d %6d %9.1f %8.4f %8.4f %8.4f %8.4f' %
+                     (kind, stats['count'], stats['errors'],
+                      stats['throughput'], stats['p50'], stats['p95'],
+                      stats['p99'], stats['max']))
+    for slow in result.get('slowdowns', []):
+        lines.append('SLOWER  %s %s: %.4f s -> %.4f s' %
+                     (slow['type'], slow['stat'],
+                      slow['previous'], slow['current']))
+    return lines
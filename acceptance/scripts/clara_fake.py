@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+default_port = 7771
+env_prefix = 'CLARA_FAKE_'
+
+
+def env_default(name, default):
+    return type(default)(os.environ.get(env_prefix + name, default))
+
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--startup-delay", type=float,
+                        default=env_default('STARTUP_DELAY', 0.5))
+    parser.add_argument("--shutdown-delay", type=float,
+                        default=env_default('SHUTDOWN_DELAY', 0.1))
+    parser.add_argument("--children", type=int,
+                        default=env_default('CHILDREN', 0))
+    parser.add_argument("--log-rate", type=float,
+                        default=env_default('LOG_RATE', 10.0))
+    parser.add_argument("--log-size", type=int,
+                        default=env_default('LOG_SIZE', 80))
+    parser.add_argument("--dpes", default=env_default('DPES', ''))
+    parser.add_argument("--host", default=env_default('HOST', ''))
+    parser.add_argument("--registry",
+                        default=env_default('REGISTRY',
+                                            '/tmp/clara-fake/registry'))
+    parser.add_argument("-port", "--port", type=int, default=default_port)
+    parser.add_argument("-fe_host")
+    parser.add_argument("-poolsize")
+    parser.add_argument("role",
+                        choices=['dpe', 'orchestrator', 'query', 'child'])
+    parser.add_argument("request", nargs='?')
+
+    return parser.parse_args(argv)
+
+
+def host_ip():
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except socket.error:
+        return '127.0.0.1'
+
+
+def dpe_name(port, host=None):
+    host = host or host_ip()
+    if port == default_port:
+        return '%s_admin' % host
+    return '%s%%%d_admin' % (host, port)
+
+
+def register(registry, name):
+    if not os.path.isdir(registry):
+        os.makedirs(registry)
+    with open(os.path.join(registry, name), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def unregister(registry, name):
+    try:
+        os.remove(os.path.join(registry, name))
+    except OSError:
+        pass
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def registered_dpes(registry):
+    if not os.path.isdir(registry):
+        return []
+    dpes = []
+    for name in sorted(os.listdir(registry)):
+        try:
+            with open(os.path.join(registry, name)) as f:
+                pid = int(f.read())
+        except (IOError, ValueError):
+            continue
+        if is_alive(pid):
+            dpes.append(name)
+    return dpes
+
+
+def run_request(args, request):
+    if request == 'list-dpes':
+        if args.dpes:
+            return filter(None, args.dpes.split(',')), 0
+        return registered_dpes(args.registry), 0
+    return ['Unsupported request: %s' % request], 1
+
+
+def run_orchestrator(args):
+    lines, code = run_request(args, args.request)
+    stream = sys.stdout if code == 0 else sys.stderr
+    for line in lines:
+        stream.write(line + '\n')
+    return code
+
+
+def run_query(args):
+    while True:
+        request = sys.stdin.readline()
+        if not request:
+            return 0
+        lines, code = run_request(args, request.strip())
+        for line in lines:
+            sys.stdout.write(line + '\n')
+        sys.stdout.write('%%%%END %d\n' % code)
+        sys.stdout.flush()
+
+
+def run_child(args):
+    while True:
+        signal.pause()
+
+
+def log_line(seq, size):
+    line = 'INFO: fake DPE message %d ' % seq
+    return (line + 'x' * max(size - len(line), 0)) + '\n'
+
+
+def run_dpe(args):
+    children = [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  'child'])
+                for _ in range(args.children)]
+    name = dpe_name(args.port, args.host)
+    server = None
+    registered = False
+    try:
+        sys.stdout.write('Starting fake DPE %s\n' % name)
+        sys.stdout.flush()
+        time.sleep(args.startup_delay)
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((args.host or '0.0.0.0', args.port))
+        server.listen(16)
+        register(args.registry, name)
+        registered = True
+        sys.stdout.write('DPE ready on port %d\n' % args.port)
+        sys.stdout.flush()
+
+        interval = 1.0 / args.log_rate if args.log_rate > 0 else 1.0
+        seq = 0
+        while True:
+            try:
+                ready, _, _ = select.select([server], [], [], interval)
+            except select.error:
+                continue
+            if ready:
+                conn, _ = server.accept()
+                conn.close()
+            if args.log_rate > 0:
+                seq += 1
+                sys.stdout.write(log_line(seq, args.log_size))
+                sys.stdout.flush()
+    finally:
+        if registered:
+            unregister(args.registry, name)
+        time.sleep(args.shutdown_delay)
+        if server is not None:
+            server.close()
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+            child.wait()
+
+
+def terminate(num, frame):
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+
+    signal.signal(signal.SIGTERM, terminate)
+    runners = {
+        'dpe': run_dpe,
+        'orchestrator': run_orchestrator,
+        'query': run_query,
+        'child': run_child,
+    }
+    sys.exit(runners[args.role](args))
@@ -1,11 +1,20 @@
+import Queue
 import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
 from clara_common import get_config_section
 from colorama import init as color_init
 from colorama import Fore
@@ -13,12 +22,114 @@ from colorama import Fore
 color_init(autoreset=True)
 
 credentials_cache = {}
+git = ['git', '-c', 'credential.helper=cache']
+log_tail = 20
+manifests = '.clara-build'
+installed_mark = '.clara-installed'
+stage_excludes = ('log',)
+ccache_hits = ('direct_cache_hit', 'preprocessed_cache_hit',
+               'cache_hit_direct', 'cache_hit_preprocessed',
+               'cache hit (direct)', 'cache hit (preprocessed)')
+ccache_misses = ('cache_miss', 'cache miss')
+gradle_outcomes = {None: 'executed', 'UP-TO-DATE': 'up-to-date',
+                   'FROM-CACHE': 'from cache'}
+gradle_init = """gradle.settingsEvaluated { settings ->
+    settings.buildCache {
+        local {
+            directory = new File('%s')
+        }
+    }
+}
+"""
 
 
 def print_c(color, msg):
     print color + msg + Fore.RESET
 
 
+def check_dependencies(projects):
+    names = set(p.name for p in projects)
+    for p in projects:
+        for dep in p.depends_on:
+            if dep not in names:
+                raise RuntimeError("Unknown dependency of '%s': %s" %
+                                   (p.name, dep))
+    order, done, pending = [], set(), list(projects)
+    while pending:
+        ready = [p for p in pending if set(p.depends_on) <= done]
+        if not ready:
+            raise RuntimeError('Dependency cycle between %s' %
+                               ', '.join(p.name for p in pending))
+        order.extend(ready)
+        done.update(p.name for p in ready)
+        pending = [p for p in pending if p.name not in done]
+    return order
+
+
+def build_key(state, build_cmds, dep_keys):
+    if state is None or None in dep_keys:
+        return None
+    data = json.dumps([state, build_cmds, dep_keys], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def build_env(jobs, install_dir=None):
+    env = os.environ.copy()
+    if install_dir:
+        env['CLARA_HOME'] = install_dir
+    env['CLARA_BUILD_JOBS'] = str(jobs)
+    env['MAKEFLAGS'] = '-j%d' % jobs
+    gradle_opts = '-Dorg.gradle.workers.max=%d' % jobs
+    env['GRADLE_OPTS'] = ' '.join(filter(None, [env.get('GRADLE_OPTS'),
+                                                gradle_opts]))
+    return env
+
+
+def parse_ccache_stats(text):
+    hits, misses = 0, 0
+    for line in text.splitlines():
+        match = re.match(r'^(.*?)\s+(\d+)\s*$', line)
+        if not match:
+            continue
+        key, value = match.group(1).strip(), int(match.group(2))
+        if key in ccache_hits:
+            hits += value
+        elif key in ccache_misses:
+            misses += value
+    return hits, misses
+
+
+def parse_gradle_stats(text):
+    stats = {}
+    summaries = re.findall(r'\d+ actionable tasks?: (.*)', text)
+    for summary in summaries:
+        for part in summary.split(','):
+            count, outcome = part.strip().split(' ', 1)
+            stats[outcome] = stats.get(outcome, 0) + int(count)
+    if summaries:
+        return stats
+    for line in text.splitlines():
+        match = re.match(r'^(?:> Task )?:\S+(?: ([A-Z-]+))?\s*$', line)
+        if match and match.group(1) in gradle_outcomes:
+            outcome = gradle_outcomes[match.group(1)]
+            stats[outcome] = stats.get(outcome, 0) + 1
+    return stats
+
+
+def git_version():
+    try:
+        out = subprocess.check_output(['git', '--version'])
+        match = re.search(r'(\d+)\.(\d+)', out)
+        return tuple(map(int, match.groups()))
+    except (OSError, AttributeError, subprocess.CalledProcessError):
+        return (0, 0)
+
+
+def read_tail(path, lines):
+    with open(path) as f:
+        return f.readlines()[-lines:]
+
+
 class Project(object):
     def __init__(self, src_dir, data):
         self.name = data['name']
@@ -26,93 +137,575 @@ class Project(object):
         self.url = data['url']
         self.build_cmds = data['build']
         self.clean_cmds = data['clean']
+        self.depth = data.get('depth')
+        self.filter = data.get('filter')
+        self.depends_on = data.get('depends_on', [])
+        self.cancelled = False
+        self._proc = None
+        self._lock = threading.Lock()
 
     def is_present(self):
         return os.path.isdir(self.path)
 
-    def download(self):
-        if 'git' in self.url:
-            if 'https://' in self.url and '@' not in self.url:
-                base_url = self.url[:self.url.find('/', 10)]
-                if base_url not in credentials_cache:
-                    sys.stdout.write("Username for '%s': " % base_url)
-                    credentials_cache[base_url] = raw_input()
-                username = credentials_cache[base_url]
-                self.url = self.url[:8] + username + '@' + self.url[8:]
-            cmd = 'git clone %s %s' % (self.url, self.path)
-        else:
+    def source_state(self):
+        try:
+            head = self._git('rev-parse', 'HEAD').strip()
+            digest = hashlib.sha1(self._git('diff', 'HEAD', '--binary'))
+            others = self._git('ls-files', '--others', '--exclude-standard',
+                               '-z')
+            for name in sorted(filter(None, others.split('\0'))):
+                digest.update(name + '\0')
+                with open(os.path.join(self.path, name), 'rb') as f:
+                    digest.update(f.read())
+        except (OSError, IOError, subprocess.CalledProcessError):
+            return None
+        return {'head': head, 'changes': digest.hexdigest()}
+
+    def _git(self, *args):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git'] + list(args),
+                                           cwd=self.path, stderr=devnull)
+
+    def resolve_url(self):
+        if 'git' not in self.url:
             raise RuntimeError('Bad URL: %s' % self.url)
-        print_c(Fore.BLUE, cmd)
-        time.sleep(1)
-        rc = subprocess.check_call(cmd.split())
+        if 'https://' in self.url and '@' not in self.url:
+            base_url = self.base_url()
+            if base_url not in credentials_cache:
+                sys.stdout.write("Username for '%s': " % base_url)
+                credentials_cache[base_url] = raw_input()
+            username = credentials_cache[base_url]
+            self.url = self.url[:8] + username + '@' + self.url[8:]
+
+    def base_url(self):
+        return self.url[:self.url.find('/', 10)]
+
+    def needs_password(self):
+        return 'https://' in self.url
+
+    def cache_path(self, cache_dir):
+        return os.path.join(cache_dir, self.name + '.git')
+
+    def update_cache(self, cache_dir, version):
+        mirror = self.cache_path(cache_dir)
+        if os.path.isdir(mirror):
+            cmd = git + ['--git-dir', mirror, 'fetch', '--prune']
+        else:
+            cmd = git + ['clone', '--mirror'] + self._filter_opts(version)
+            cmd += [self.url, mirror]
+        print_c(Fore.BLUE, ' '.join(cmd))
+        return subprocess.call(cmd) == 0
+
+    def download(self, version, cache_dir=None):
+        self.resolve_url()
+        cmd = git + ['clone']
+        if self.depth:
+            cmd += ['--depth', str(self.depth)]
+        cmd += self._filter_opts(version)
+        if cache_dir:
+            cmd += self._reference_opts(cache_dir, version)
+        cmd += [self.url, self.path]
+        print_c(Fore.BLUE, ' '.join(cmd))
+        rc = subprocess.check_call(cmd)
         return rc == 0
 
-    def build(self):
+    def _filter_opts(self, version):
+        if self.filter and version >= (2, 19):
+            return ['--filter', self.filter]
+        return []
+
+    def _reference_opts(self, cache_dir, version):
+        mirror = self.cache_path(cache_dir)
+        if version >= (2, 11):
+            return ['--reference-if-able', mirror, '--dissociate']
+        if os.path.isdir(mirror):
+            return ['--reference', mirror, '--dissociate']
+        return []
+
+    def build(self, log=None, env=None, cache=None):
         for cmd in self.build_cmds:
-            print_c(Fore.BLUE, cmd)
             if re.match(r'^cmake', cmd):
                 cmd += ' -DCMAKE_COLOR_MAKEFILE=OFF'
-            time.sleep(1)
-            rc = subprocess.check_call(cmd, shell=True, cwd=self.path)
-            if rc != 0:
+            if cache is not None:
+                cmd = cache.command(self, cmd)
+            if not self._run(cmd, log, env):
                 return False
         return True
 
-    def clean(self):
+    def clean(self, log=None, env=None):
         for cmd in self.clean_cmds:
-            print_c(Fore.BLUE, cmd)
-            time.sleep(1)
-            rc = subprocess.check_call(cmd, shell=True, cwd=self.path)
-            if rc != 0:
+            if not self._run(cmd, log, env):
                 return False
         return True
 
+    def terminate(self):
+        with self._lock:
+            self.cancelled = True
+            if self._proc is not None and self._proc.poll() is None:
+                try:
+                    os.killpg(self._proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def _run(self, cmd, log, env):
+        print_c(Fore.BLUE, '%s: %s' % (self.name, cmd))
+        with self._lock:
+            if self.cancelled:
+                return False
+            if log is not None:
+                log.write('$ %s\n' % cmd)
+                log.flush()
+            self._proc = subprocess.Popen(cmd, shell=True, cwd=self.path,
+                                          stdout=log,
+                                          stderr=subprocess.STDOUT,
+                                          preexec_fn=os.setsid,
+                                          env=env)
+        rc = self._proc.wait()
+        with self._lock:
+            self._proc = None
+        return rc == 0
+
+
+# Wires ccache into cmake, and the daemon and local build cache into Gradle
+# and Maven, all of them keeping their files in a shared directory.
+class BuildCache(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.ccache = find_executable('ccache')
+        self.mvnd = find_executable('mvnd')
+        self.init_script = os.path.join(self.path, 'gradle', 'init.gradle')
+        self._versions = {}
+        self._lock = threading.Lock()
+        gradle_dir = os.path.dirname(self.init_script)
+        if not os.path.isdir(gradle_dir):
+            os.makedirs(gradle_dir)
+        with open(self.init_script, 'w') as f:
+            f.write(gradle_init % os.path.join(gradle_dir, 'build-cache'))
+
+    def env(self, p, env):
+        env['CCACHE_DIR'] = self._ccache_dir(p)
+        env['CCACHE_BASEDIR'] = p.path
+        # CMake has compiler launchers since 3.4, older ones take the
+        # compiler with its arguments from CC and CXX
+        if self.ccache and any(re.match(r'^cmake', c) for c in p.build_cmds) \
+                and self._cmake_version(p) < (3, 4):
+            env['CC'] = 'ccache %s' % env.get('CC', 'gcc')
+            env['CXX'] = 'ccache %s' % env.get('CXX', 'g++')
+        return env
+
+    def command(self, p, cmd):
+        if re.match(r'^cmake', cmd) and self.ccache and \
+                self._cmake_version(p) >= (3, 4):
+            cmd += (' -DCMAKE_C_COMPILER_LAUNCHER=ccache'
+                    ' -DCMAKE_CXX_COMPILER_LAUNCHER=ccache')
+        elif re.match(r'^(gradle|\./gradlew)\b', cmd):
+            cmd += ' --daemon'
+            if self._gradle_version(p, cmd.split()[0]) >= (3, 5):
+                cmd += ' --build-cache --init-script %s' % self.init_script
+        elif re.match(r'^mvn\b', cmd):
+            if self.mvnd:
+                cmd = 'mvnd' + cmd[3:]
+            cmd += ' -Dmaven.repo.local=%s' % os.path.join(self.path,
+                                                           'maven')
+        return cmd
+
+    def ccache_stats(self, p):
+        if not self.ccache:
+            return None
+        env = dict(os.environ, CCACHE_DIR=self._ccache_dir(p))
+        for option in ('--print-stats', '-s'):
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    out = subprocess.check_output(['ccache', option],
+                                                  env=env, stderr=devnull)
+                return parse_ccache_stats(out)
+            except (OSError, subprocess.CalledProcessError):
+                continue
+        return None
+
+    def report(self, p, before, log_path):
+        parts = []
+        after = self.ccache_stats(p)
+        if before is not None and after is not None:
+            hits, misses = [a - b for a, b in zip(after, before)]
+            if hits or misses:
+                parts.append('ccache %d hits, %d misses' % (hits, misses))
+        with open(log_path) as f:
+            stats = parse_gradle_stats(f.read())
+        if stats:
+            parts.append('gradle ' + ', '.join(
+                '%d %s' % (n, k) for k, n in sorted(stats.items())))
+        return '; '.join(parts)
+
+    def _ccache_dir(self, p):
+        return os.path.join(self.path, 'ccache', p.name)
+
+    def _gradle_version(self, p, gradle):
+        key = gradle
+        if gradle.startswith('.'):
+            key = os.path.join(p.path, gradle)
+        return self._version(p, key, gradle, r'Gradle (\d+)\.(\d+)')
+
+    def _cmake_version(self, p):
+        return self._version(p, 'cmake', 'cmake',
+                             r'cmake version (\d+)\.(\d+)')
+
+    def _version(self, p, key, tool, pattern):
+        with self._lock:
+            if key not in self._versions:
+                try:
+                    with open(os.devnull, 'w') as devnull:
+                        out = subprocess.check_output([tool, '--version'],
+                                                      cwd=p.path,
+                                                      stderr=devnull)
+                    match = re.search(pattern, out)
+                    version = tuple(map(int, match.groups()))
+                except (OSError, AttributeError,
+                        subprocess.CalledProcessError):
+                    version = (0, 0)
+                self._versions[key] = version
+            return self._versions[key]
+
 
 class ProjectManager:
-    def __init__(self, src_dir):
+    def __init__(self, src_dir, jobs=4, cache_dir=None,
+                 build_jobs=None, log_dir=None, install_dir=None,
+                 build_cache=None):
         self.src_dir = src_dir
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.build_jobs = build_jobs or multiprocessing.cpu_count()
+        self.log_dir = log_dir or os.path.join(src_dir, '.build-logs')
+        self.install_dir = install_dir
+        self.build_cache = build_cache
         self.projects = []
 
+    @property
+    def manifest_dir(self):
+        if self.install_dir:
+            return os.path.join(self.install_dir, manifests)
+
     def register_projects(self, data):
         print_c(Fore.YELLOW, "Registering projects...")
         self.projects = [Project(self.src_dir, pd) for pd in data]
 
     def download_projects(self):
+        missing = []
         for p in self.projects:
-            print_c(Fore.YELLOW, "Downloading '%s'..." % p.name)
             if not p.is_present():
-                stat = p.download()
-                if not stat:
-                    raise RuntimeError('Could no download %s' % p.name)
-                print_c(Fore.GREEN, "'%s' successfully downloaded" % p.name)
+                p.resolve_url()
+                missing.append(p)
             else:
                 print "'%s' is already on disk" % p.name
+        if not missing:
+            return
 
-    def build_projects(self, clean):
-        for p in self.projects:
-            print_c(Fore.YELLOW, "Installing '%s'..." % p.name)
-            if p.is_present():
-                time.sleep(1)
-                if clean:
-                    stat = p.clean()
-                    if not stat:
-                        raise RuntimeError('Could no clean %s' % p.name)
-                stat = p.build()
-                if not stat:
-                    raise RuntimeError('Could no build %s' % p.name)
-                print_c(Fore.GREEN, "'%s' successfully installed" % p.name)
+        # The checkouts can only borrow objects from the cache with
+        # --dissociate (git 2.3), otherwise they would depend on it
+        self._git_version = git_version()
+        if self.cache_dir and self._git_version < (2, 3):
+            print_c(Fore.YELLOW, "git %d.%d cannot use the cache" %
+                    self._git_version)
+        elif self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # The first download from each server may prompt for a password,
+        # so it runs alone and the cached credentials serve the others.
+        first, rest, hosts = [], [], set()
+        for p in missing:
+            if p.needs_password() and p.base_url() not in hosts:
+                hosts.add(p.base_url())
+                first.append(p)
             else:
+                rest.append(p)
+        results = [self._download(p) for p in first]
+
+        pool = ThreadPool(max(min(self.jobs, len(rest)), 1))
+        try:
+            results += pool.map(self._download, rest)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [p.name for p, stat in zip(first + rest, results)
+                  if not stat]
+        if failed:
+            raise RuntimeError('Could no download %s' % ', '.join(failed))
+
+    def _download(self, p):
+        print_c(Fore.YELLOW, "Downloading '%s'..." % p.name)
+        version = self._git_version
+        # Shallow clones would not need most of a full mirror
+        cache_dir = self.cache_dir
+        if p.depth or version < (2, 3):
+            cache_dir = None
+        try:
+            if cache_dir and not p.update_cache(cache_dir, version):
+                print_c(Fore.RED, "Could not update the cache of '%s'" %
+                        p.name)
+            stat = p.download(version, cache_dir)
+        except Exception as e:
+            print_c(Fore.RED, "'%s': %s" % (p.name, e))
+            return False
+        if stat:
+            print_c(Fore.GREEN, "'%s' successfully downloaded" % p.name)
+        return stat
+
+    # Returns the build key and source state of the projects to build.
+    # A project is skipped if its build key matches the last manifest.
+    # The force list selects the projects to rebuild anyway (all if empty).
+    def plan_builds(self, clean, force=None):
+        for p in self.projects:
+            if not p.is_present():
                 raise RuntimeError("'%s' is not on disk" % p.name)
 
-    def clean_install_directory(self):
-        print_c(Fore.YELLOW, "Removing contents of $CLARA_HOME...")
-        clara_services = os.getenv('CLARA_HOME')
-        for f in os.listdir(clara_services):
-            path = os.path.join(clara_services, f)
-            if os.path.isfile(path):
-                os.remove(path)
+        keys = {}
+        plan = {}
+        for p in check_dependencies(self.projects):
+            state = p.source_state()
+            keys[p.name] = build_key(state, p.build_cmds,
+                                     [keys[d] for d in p.depends_on])
+            forced = clean or (force is not None and
+                               (not force or p.name in force))
+            if not forced and self._is_built(p, keys[p.name]):
+                print "'%s' is up to date" % p.name
             else:
-                shutil.rmtree(path)
+                plan[p.name] = (keys[p.name], state)
+        return plan
+
+    # Projects are built as soon as their dependencies are installed,
+    # sharing the job budget, and the first failure cancels the others.
+    def build_projects(self, clean, plan):
+        for d in (self.log_dir, self.manifest_dir):
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+
+        done = set(p.name for p in self.projects if p.name not in plan)
+        results = Queue.Queue()
+        pending = [p for p in self.projects if p.name in plan]
+        running = {}
+        built = []
+        failed = []
+        while running or (pending and not failed):
+            if not failed:
+                ready = [p for p in pending if set(p.depends_on) <= done]
+                launch = ready[:max(self.build_jobs - len(running), 0)]
+                share = self.build_jobs // max(len(running) + len(launch), 1)
+                for p in launch:
+                    pending.remove(p)
+                    running[p.name] = p
+                    key, state = plan[p.name]
+                    worker = threading.Thread(target=self._build,
+                                              args=(p, clean, max(share, 1),
+                                                    key, state, results))
+                    worker.daemon = True
+                    worker.start()
+            try:
+                p, stat = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+            del running[p.name]
+            if stat:
+                done.add(p.name)
+                built.append(p.name)
+            elif not p.cancelled:
+                failed.append(p.name)
+                for other in running.values():
+                    other.terminate()
+
+        if failed:
+            raise RuntimeError('Could no build %s' % ', '.join(failed))
+        return built
+
+    def _build(self, p, clean, jobs, key, state, results):
+        print_c(Fore.YELLOW, "Installing '%s' (-j%d)..." % (p.name, jobs))
+        start = time.time()
+        path = os.path.join(self.log_dir, '%s.log' % p.name)
+        cache = self.build_cache
+        try:
+            self._remove_manifest(p)
+            env = build_env(jobs, self.install_dir)
+            if cache is not None:
+                env = cache.env(p, env)
+                before = cache.ccache_stats(p)
+            with open(path, 'w') as log:
+                stat = ((not clean or p.clean(log, env)) and
+                        p.build(log, env, cache))
+            if stat:
+                self._write_manifest(p, key, state)
+        except Exception as e:
+            print_c(Fore.RED, "'%s': %s" % (p.name, e))
+            stat = False
+        if stat:
+            print_c(Fore.GREEN, "'%s' successfully installed in %.1f s" %
+                    (p.name, time.time() - start))
+            if cache is not None:
+                stats = cache.report(p, before, path)
+                if stats:
+                    print "'%s' cache: %s" % (p.name, stats)
+        elif p.cancelled:
+            print_c(Fore.YELLOW, "'%s' cancelled" % p.name)
+        elif os.path.isfile(path):
+            print_c(Fore.RED, "'%s' failed, see %s" % (p.name, path))
+            sys.stdout.write(''.join(read_tail(path, log_tail)))
+        results.put((p, stat))
+
+    def _manifest_path(self, p):
+        return os.path.join(self.manifest_dir, '%s.json' % p.name)
+
+    def _is_built(self, p, key):
+        if not self.manifest_dir or key is None:
+            return False
+        try:
+            with open(self._manifest_path(p)) as f:
+                return json.load(f).get('key') == key
+        except (IOError, ValueError):
+            return False
+
+    def _write_manifest(self, p, key, state):
+        if not self.manifest_dir or key is None:
+            return
+        manifest = {'name': p.name, 'key': key, 'source': state,
+                    'build': p.build_cmds, 'depends_on': p.depends_on,
+                    'time': time.time()}
+        with open(self._manifest_path(p), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def _remove_manifest(self, p):
+        if not self.manifest_dir:
+            return
+        try:
+            os.remove(self._manifest_path(p))
+        except OSError:
+            pass
+
+
+# Every build goes to a new directory next to $CLARA_HOME, which is a
+# symlink flipped to the new install only when all the projects built.
+# The logs of the running install are not copied to the new one.
+# If $CLARA_HOME is a link to another directory (like the shared folder of
+# the VMs), that directory is managed instead, so all the links to it
+# see the new install.
+class StagedInstall(object):
+    def __init__(self, clara_home, keep=2):
+        self.home = self._managed_path(os.path.normpath(clara_home))
+        self.root = self._installs_root(self.home)
+        self.keep = keep
+        self.stage = None
+
+    def installs(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root)
+                      if not d.endswith('.old') and
+                      os.path.isfile(os.path.join(self.root, d,
+                                                  installed_mark)))
+
+    def current(self):
+        if os.path.islink(self.home):
+            return os.path.basename(os.path.realpath(self.home))
+        return None
+
+    def begin(self, clean):
+        self._migrate()
+        self.stage = self._new_dir()
+        source = os.path.realpath(self.home)
+        excludes = stage_excludes + (installed_mark,)
+        if os.path.isdir(source) and not clean:
+            print_c(Fore.YELLOW, "Staging a copy of '%s'..." %
+                    os.path.basename(source))
+            shutil.copytree(source, self.stage, symlinks=True,
+                            ignore=lambda d, names: [
+                                n for n in names
+                                if d == source and n in excludes])
+        else:
+            os.makedirs(self.stage)
+        for d in stage_excludes:
+            os.mkdir(os.path.join(self.stage, d))
+        return self.stage
+
+    def commit(self):
+        open(os.path.join(self.stage, installed_mark), 'w').close()
+        self._link(self.stage)
+        print_c(Fore.GREEN, "$CLARA_HOME is now '%s'" %
+                os.path.basename(self.stage))
+        self.stage = None
+        self.prune()
+
+    def abort(self):
+        if self.stage:
+            shutil.rmtree(self.stage, ignore_errors=True)
+            self.stage = None
+
+    def rollback(self):
+        installs = self.installs()
+        current = self.current()
+        if current not in installs or installs.index(current) == 0:
+            raise RuntimeError('No previous install to roll back to')
+        previous = installs[installs.index(current) - 1]
+        self._link(os.path.join(self.root, previous))
+        print_c(Fore.GREEN, "$CLARA_HOME is now '%s'" % previous)
+
+    # Old installs are renamed first, so they disappear at once, and then
+    # removed by a detached process that outlives the installer.
+    def prune(self):
+        if not os.path.isdir(self.root):
+            return
+        keep = set(self.installs()[-(self.keep + 1):])
+        keep.add(self.current())
+        old = []
+        for d in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, d)
+            if d in keep or path == self.stage:
+                continue
+            if not d.endswith('.old'):
+                os.rename(path, path + '.old')
+                path += '.old'
+            old.append(path)
+        if old:
+            subprocess.Popen(['rm', '-rf'] + old, preexec_fn=os.setsid)
+
+    def _migrate(self):
+        if os.path.isdir(self.home) and not os.path.islink(self.home):
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            first = self._new_dir()
+            os.rename(self.home, first)
+            open(os.path.join(first, installed_mark), 'w').close()
+            self._link(first)
+
+    @staticmethod
+    def _installs_root(home):
+        parent, name = os.path.split(home)
+        return os.path.join(parent, '.%s-installs' % name)
+
+    @classmethod
+    def _managed_path(cls, path):
+        seen = set()
+        while os.path.islink(path) and path not in seen:
+            seen.add(path)
+            target = os.path.normpath(os.path.join(os.path.dirname(path),
+                                                   os.readlink(path)))
+            if os.path.dirname(target) == cls._installs_root(path):
+                break
+            path = target
+        return path
+
+    def _new_dir(self):
+        base = os.path.join(self.root, time.strftime('%Y%m%d-%H%M%S'))
+        path, n = base, 1
+        while os.path.exists(path) or os.path.exists(path + '.old'):
+            path = '%s-%d' % (base, n)
+            n += 1
+        return path
+
+    def _link(self, target):
+        parent = os.path.dirname(self.home)
+        tmp = self.home + '.new'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.relpath(target, parent), tmp)
+        os.rename(tmp, self.home)
 
 
 def get_arguments():
@@ -120,7 +713,15 @@ def get_arguments():
     parser.add_argument("--src-dir", required=True)
     parser.add_argument("--conf-file", required=True)
     parser.add_argument("--skip-download", action="store_true")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--git-cache")
     parser.add_argument("--skip-build", action="store_true")
+    parser.add_argument("--build-jobs", type=int)
+    parser.add_argument("--log-dir")
+    parser.add_argument("--build-cache")
+    parser.add_argument("--force-build", nargs='*', metavar='PROJECT')
+    parser.add_argument("--keep-installs", type=int, default=2)
+    parser.add_argument("--rollback", action="store_true")
     parser.add_argument("--clean-build", action="store_true")
     parser.add_argument("--clean-install", action="store_true")
 
@@ -132,17 +733,40 @@ if __name__ == '__main__':
         args = get_arguments()
         data = get_config_section(args.conf_file, 'projects')
 
-        pm = ProjectManager(args.src_dir)
+        installing = args.rollback or args.clean_install or not args.skip_build
+        clara_home = os.getenv('CLARA_HOME')
+        if installing and not clara_home:
+            raise RuntimeError('$CLARA_HOME is not set')
+        install = StagedInstall(clara_home or '', args.keep_installs)
+
+        if args.rollback:
+            install.rollback()
+            sys.exit(0)
+
+        cache = BuildCache(args.build_cache) if args.build_cache else None
+        pm = ProjectManager(args.src_dir, args.jobs, args.git_cache,
+                            args.build_jobs, args.log_dir,
+                            build_cache=cache)
         pm.register_projects(data)
 
         if not args.skip_download:
             pm.download_projects()
 
-        if args.clean_install:
-            pm.clean_install_directory()
-
-        if not args.skip_build:
-            pm.build_projects(args.clean_build)
+        if installing:
+            plan = {}
+            if not args.skip_build:
+                if os.path.isdir(install.home):
+                    pm.install_dir = install.home
+                force = [] if args.clean_install else args.force_build
+                plan = pm.plan_builds(args.clean_build, force)
+            if plan or args.clean_install:
+                pm.install_dir = install.begin(args.clean_install)
+                try:
+                    pm.build_projects(args.clean_build, plan)
+                except BaseException:
+                    install.abort()
+                    raise
+                install.commit()
 
         print_c(Fore.GREEN, "Done!")
     except Exception as e:
@@ -0,0 +1,107 @@
+import collections
+import gzip
+import os
+import re
+import shutil
+import threading
+
+
+class RotatingLog():
+    def __init__(self, path, max_bytes=0, backups=3, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._file = open(path, 'w')
+        self._size = 0
+
+    def write(self, data):
+        if self._file.closed:
+            return
+        if self.max_bytes and self._size + len(data) > self.max_bytes:
+            if self._size:
+                self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        self._file.close()
+
+    def backup_name(self, index):
+        name = '%s.%d' % (self.path, index)
+        if self.compress:
+            name += '.gz'
+        return name
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(self.backup_name(i)):
+                    os.rename(self.backup_name(i), self.backup_name(i + 1))
+            if self.compress:
+                with open(self.path, 'rb') as src:
+                    with gzip.open(self.backup_name(1), 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+            else:
+                os.rename(self.path, self.backup_name(1))
+        self._file = open(self.path, 'w')
+        self._size = 0
+
+
+class LogCapture():
+    def __init__(self, out_path, err_path,
+                 max_bytes=0, backups=3, compress=False, tail=1000):
+        self.out = RotatingLog(out_path, max_bytes, backups, compress)
+        self.err = RotatingLog(err_path, max_bytes, backups, compress)
+        self.lines = collections.deque(maxlen=tail)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._readers = []
+
+    def attach(self, out=None, err=None):
+        for stream, pipe in (('out', out), ('err', err)):
+            if pipe is None:
+                continue
+            reader = threading.Thread(target=self._read, args=(stream, pipe))
+            reader.daemon = True
+            reader.start()
+            self._readers.append(reader)
+
+    def close(self, timeout=1.0):
+        for reader in self._readers:
+            reader.join(timeout)
+        self._readers = []
+        self.out.close()
+        self.err.close()
+
+    def append(self, stream, line):
+        with self._lock:
+            self._seq += 1
+            self.lines.append((self._seq, stream, line))
+
+    def since(self, seq, stream='out'):
+        with self._lock:
+            lines = list(self.lines)
+        return [(n, l) for n, s, l in lines if n > seq and s == stream]
+
+    def tail(self, count):
+        with self._lock:
+            lines = list(self.lines)
+        return [l for _, _, l in lines[-count:]] if count > 0 else []
+
+    # Only the lines kept in memory are searched, the rotated files on disk
+    # are neither indexed nor scanned.
+    def grep(self, pattern):
+        regex = re.compile(pattern)
+        with self._lock:
+            lines = list(self.lines)
+        return ['%d:%s' % (n, l) for n, _, l in lines if regex.search(l)]
+
+    def _read(self, stream, pipe):
+        log = self.out if stream == 'out' else self.err
+        for line in iter(pipe.readline, ''):
+            log.write(line)
+            self.append(stream, line.rstrip('\n'))
+        pipe.close()
@@ -1,16 +1,37 @@
+import Queue
+import argparse
 import atexit
+import json
+import logging
+import multiprocessing
 import os
 import psutil
+import re
+import select
 import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 import zmq
 
+from clara_logs import LogCapture
+from clara_monitor import ClaraMonitor
+
 clara = {
     'services': '/home/vagrant/clara/services',
-    'logs': '/home/vagrant/clara/services/log',
+    'logs': '/vagrant/acceptance/log',
+    'capture': {
+        'max_bytes': 50 * 1024 * 1024,
+        'backups': 3,
+        'compress': True,
+        'tail': 5000,
+    },
+    'monitor': {
+        'interval': 1.0,
+        'samples': 600,
+    },
     'python': {
         'fullpath': '/home/vagrant/clara/dev/python',
         'platform': 'python -u core/system/Platform.py',
@@ -19,90 +40,354 @@ clara = {
     'java': {
         'fullpath': '/home/vagrant/clara/services',
         'platform': './bin/j_dpe',
-        'dpe': './bin/j_dpe -fe_host 10.11.1.100',
+        'dpe': './bin/j_dpe',
         'orchestrator': './bin/clara-orchestrator',
+        'args': {
+            'fe_host': '-fe_host',
+            'pool_size': '-poolsize',
+            'jvm_opts': '$JAVA_OPTS',
+            'port': '-port',
+        },
+        'ports': {'base': 7771, 'step': 10, 'slots': 16},
+        'defaults': {
+            'dpe': {'fe_host': '10.11.1.100'},
+        },
+        'ready': {
+            'platform': {'port': 7771, 'timeout': 30},
+            'dpe': {'port': 7771, 'timeout': 30},
+        },
     },
 }
 
+logging.basicConfig()
+log = logging.getLogger("MANAGER")
+
 host_ip = socket.gethostbyname(socket.gethostname())
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+standby_launcher = os.path.join(scripts_dir, 'clara_standby.py')
+fake_launcher = os.path.join(scripts_dir, 'clara_fake.py')
+
 port = "7788"
+events_port = "7789"
+protocol_version = 1
+actions = ('start', 'stop', 'stats', 'request', 'logs')
+replies_addr = "inproc://clara-replies"
+batch_request = "clara:batch"
+parallel_mark = "&"
+numeric_args = {'timeout': float, 'cores': int, 'numa': int, 'port': int}
 
 
-def stop_process(conf):
-    def finished_process(proc, limit=25):
-        counter = 0
-        while proc.is_running():
-            counter += 1
-            if counter > limit:
-                return False
-            time.sleep(0.2)
-        return True
+def process_tree(conf):
+    try:
+        process = psutil.Process(conf.proc.pid)
+        return [process] + process.get_children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def signal_group(conf, sig):
+    try:
+        os.killpg(conf.proc.pid, sig)
+    except OSError:
+        pass
+
+
+def stop_processes(runs, timeout=5):
+    start = time.time()
+    owners = {}
+    finished = {}
+
+    def on_exit(proc):
+        key = owners[proc.pid]
+        finished[key] = max(finished.get(key, 0.0), time.time() - start)
 
-    def kill_process(proc):
-        proc.terminate()
-        if not finished_process(proc):
+    procs = []
+    for key, conf in runs.items():
+        conf.stopping = True
+        tree = process_tree(conf)
+        for proc in tree:
+            owners[proc.pid] = key
+        procs.extend(tree)
+        signal_group(conf, signal.SIGTERM)
+
+    _, alive = psutil.wait_procs(procs, timeout, callback=on_exit)
+    for proc in alive:
+        try:
             proc.kill()
-            proc.wait()
-            return True
-        return False
+        except psutil.NoSuchProcess:
+            pass
+    if alive:
+        psutil.wait_procs(alive, timeout, callback=on_exit)
+    killed = set(owners[proc.pid] for proc in alive)
 
-    killed = False
-    process = psutil.Process(conf.proc.pid)
-    children = process.get_children(recursive=True)
-    for proc in children:
-        killed = kill_process(proc) or killed
-    if not children:
-        killed = kill_process(process) or killed
+    report = {}
+    for key, conf in runs.items():
+        conf.close_logs()
+        report[key] = (finished.get(key, 0.0), key in killed)
+    return report
 
-    conf.close_logs()
 
+def stop_process(conf, timeout=5):
+    latency, killed = stop_processes({None: conf}, timeout)[None]
     if killed:
         raise OSError("Process has been killed")
+    return latency
+
+
+def teardown_report(report):
+    return ['%s %.3f%s' % (key, latency, ' killed' if killed else '')
+            for key, (latency, killed) in sorted(report.items())]
 
 
 def stop_all(manager):
-    for run in manager.instances.values():
+    keys = sorted(manager.instances.keys())
+    locks = [manager.instance_lock(key) for key in keys]
+    for lock in locks:
+        lock.acquire()
+    try:
+        runs = {}
+        for key in keys:
+            manager.monitor.unwatch(key)
+            run = manager.instances.pop(key, None)
+            manager.release(key)
+            if run is not None:
+                runs[key] = run
+        manager.invalidate_queries()
+        report = stop_processes(runs)
+    finally:
+        for lock in locks:
+            lock.release()
+    for key, (latency, killed) in sorted(report.items()):
+        manager.report_teardown(key, latency, killed)
+    return teardown_report(report)
+
+
+def parse_request(msg):
+    if msg.startswith('{'):
+        return parse_structured_request(msg)
+
+    req = msg.split(':')
+    if len(req) > 2 and req[1] == 'logs':
+        if len(req) < 5:
+            raise ClaraManagerError('Bad request: "%s"' % msg)
+        req = msg.split(':', 5) + [None]
+        _, action, command, lang, instance, arg = req[:6]
+        if command == 'tail':
+            args = {'command': command, 'lines': arg}
+        else:
+            args = {'command': command, 'pattern': arg}
+        return None, action, lang, instance, args
+
+    if len(req) != 4:
+        raise ClaraManagerError('Bad request: "%s"' % msg)
+    _, action, lang, instance = req
+    if action not in actions:
+        raise ClaraManagerError('Unsupported action: %s' % action)
+    return None, action, lang, instance, {}
+
+
+def parse_structured_request(msg):
+    try:
+        req = json.loads(msg)
+    except ValueError:
+        raise ClaraManagerError('Bad request: "%s"' % msg)
+    if not isinstance(req, dict):
+        raise ClaraManagerError('Bad request: "%s"' % msg)
+
+    version = req.get('version')
+    if version != protocol_version:
+        raise ClaraManagerError('Unsupported protocol version: %s' % version)
+
+    action = req.get('action')
+    if action not in actions:
+        raise ClaraManagerError('Unsupported action: %s' % action)
+
+    target = req.get('target')
+    if not isinstance(target, dict):
+        raise ClaraManagerError('Bad target: %s' % target)
+    lang, instance = target.get('lang'), target.get('instance')
+    if not isinstance(lang, basestring) or \
+            not isinstance(instance, basestring):
+        raise ClaraManagerError('Bad target: %s' % json.dumps(target))
+    if target.get('id') is not None:
+        instance = '%s.%s' % (instance, target['id'])
+
+    args = req.get('args', {})
+    if not isinstance(args, dict):
+        raise ClaraManagerError('Bad arguments: %s' % json.dumps(args))
+    for name, kind in numeric_args.items():
+        if args.get(name) is None:
+            continue
         try:
-            stop_process(run)
-        except Exception:
-            pass
-    manager.instances.clear()
+            value = kind(args[name])
+        except (TypeError, ValueError):
+            value = -1
+        if value < 0:
+            raise ClaraManagerError('Bad %s: %s' % (name, args[name]))
+        args[name] = value
+
+    return req.get('id'), action, str(lang), str(instance), args
+
+
+def split_instance(instance):
+    match = re.match(r'^([^.]+)(?:\.(\w+))?$', instance)
+    if not match:
+        raise ClaraManagerError('Bad instance: %s' % instance)
+    return match.group(1), match.group(2)
+
+
+def check_instance(instance):
+    base, _ = split_instance(instance)
+    if base != 'platform' and base != 'dpe':
+        raise ClaraManagerError('Bad instance: %s' % instance)
+
+
+def port_available(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def allocate_port(ports, used):
+    for slot in range(1, ports.get('slots', 16)):
+        port = ports['base'] + slot * ports.get('step', 10)
+        if port not in used and port_available(port):
+            return port
+    raise ClaraManagerError('No free ports')
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in filter(None, text.strip().split(',')):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_cpus(node):
+    path = '/sys/devices/system/node/node%s/cpulist' % node
+    try:
+        with open(path) as f:
+            return parse_cpulist(f.read())
+    except IOError:
+        raise ClaraManagerError('Bad NUMA node: %s' % node)
+
+
+def allocate_cores(count, used, numa=None):
+    if numa is not None:
+        cpus = numa_cpus(numa)
+    else:
+        cpus = range(multiprocessing.cpu_count())
+    free = [cpu for cpu in cpus if cpu not in used]
+    if count > len(free):
+        raise ClaraManagerError('Not enough free cores: %d requested, '
+                                '%d available' % (count, len(free)))
+    return free[:count]
+
+
+def allocation_report(alloc):
+    lines = []
+    if alloc.get('port') is not None:
+        lines.append('port %s' % str(alloc['port']))
+    if alloc.get('cores'):
+        lines.append('cores %s' % ','.join(map(str, alloc['cores'])))
+    if alloc.get('numa') is not None:
+        lines.append('numa %s' % str(alloc['numa']))
+    return lines
+
+
+def encode_frame(frame):
+    if isinstance(frame, unicode):
+        return frame.encode('utf-8')
+    return str(frame)
+
+
+def encode_result(status, elapsed, text):
+    return '%s %.6f\n%s' % (status, elapsed, '\n'.join(text))
+
+
+def split_envelope(frames):
+    if '' not in frames:
+        return [], frames
+    delim = frames.index('') + 1
+    return frames[:delim], frames[delim:]
 
 
 class ClaraProcessConfig():
-    def __init__(self, clara, lang='java', instance='platform'):
+    def __init__(self, clara, lang='java', instance='platform', args=None,
+                 cores=None, numa=None):
         self._conf = clara[lang]
         self._logs = clara['logs']
+        self._capture = clara.get('capture', {})
         self._lang = lang
         self._instance = instance
+        base, _ = split_instance(instance)
+
+        self.args = dict(self._conf.get('defaults', {}).get(base, {}))
+        self.args.update(args or {})
+        self.flags, self.env_args = self._arguments()
+        self.port = self.args.get('port')
+        self.cores = cores
+        self.numa = numa
 
-        self.cmd = self._conf[instance].split()
+        self.cmd = self._pinning() + self._conf[base].split() + self.flags
         self.cwd = self._conf['fullpath']
         self.proc = None
-        self.out = None
-        self.err = None
+        self.stopping = False
+        self.logs = None
         self.env = self._env()
 
     def open_logs(self):
-        self.out = self._open_log('log')
-        self.err = self._open_log('err')
+        self.logs = LogCapture(self.log_file('log'),
+                               self.log_file('err'),
+                               **self._capture)
 
-    def close_logs(self):
-        self.out.close()
-        self.err.close()
+    def attach_logs(self, out=None, err=None):
+        self.logs.attach(out, err)
 
-        self.out = None
-        self.err = None
+    def close_logs(self):
+        self.logs.close()
+        self.logs = None
 
     def set_proc(self, proc):
         self.proc = proc
 
-    def _open_log(self, ext):
+    def log_file(self, ext):
         name = '%s-%s-%s.%s' % (host_ip, self._lang, self._instance, ext)
-        return open(os.path.join(self._logs, name), "w+")
+        return os.path.join(self._logs, name)
+
+    def _arguments(self):
+        spec = self._conf.get('args', {})
+        flags, env = [], {}
+        for name, value in sorted(self.args.items()):
+            if name not in spec:
+                raise ClaraManagerError('Unsupported argument: %s' % name)
+            option = spec[name]
+            if option.startswith('$'):
+                env[option[1:]] = str(value)
+            else:
+                flags += [option, str(value)]
+        return flags, env
+
+    def _pinning(self):
+        prefix = []
+        if self.numa is not None:
+            prefix += ['numactl',
+                       '--cpunodebind=%s' % self.numa,
+                       '--membind=%s' % self.numa]
+        if self.cores:
+            prefix += ['taskset', '-c', ','.join(map(str, self.cores))]
+        return prefix
 
     def _env(self):
         env = os.environ.copy()
+        env.update(self.env_args)
         if self._lang == 'python':
             fullpath = self._conf['fullpath']
             if 'PYTHONPATH' in env:
@@ -115,52 +400,448 @@ class ClaraProcessConfig():
         return env
 
 
+class AliveProbe():
+    def __init__(self, delay):
+        self._delay = delay
+        self._start = time.time()
+
+    def __call__(self, conf, proc):
+        return time.time() - self._start >= self._delay
+
+
+class LogProbe():
+    def __init__(self, pattern, stream='out'):
+        self._regex = re.compile(pattern)
+        self._stream = stream
+        self._seq = 0
+
+    def __call__(self, conf, proc):
+        lines = conf.logs.since(self._seq, self._stream)
+        if lines:
+            self._seq = lines[-1][0]
+        return any(self._regex.search(l) for _, l in lines)
+
+
+# The port must be listened by the started process tree, since several
+# instances (e.g. the Java platform and DPE) can share the same port.
+class PortProbe():
+    def __init__(self, port):
+        self._port = int(port)
+
+    def __call__(self, conf, proc):
+        for process in process_tree(conf):
+            try:
+                connections = process.get_connections('inet')
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            for conn in connections:
+                if conn.status == psutil.CONN_LISTEN and \
+                        conn.laddr[1] == self._port:
+                    return True
+        return False
+
+
+class TreeProbe():
+    def __init__(self, procs):
+        self._procs = int(procs)
+
+    def __call__(self, conf, proc):
+        try:
+            children = psutil.Process(proc.pid).get_children(recursive=True)
+        except psutil.NoSuchProcess:
+            return False
+        return len(children) + 1 >= self._procs
+
+
+def readiness_probe(clara, lang, instance, port=None):
+    base, _ = split_instance(instance)
+    ready = clara[lang].get('ready', {}).get(base) or {}
+    if 'log' in ready:
+        probe = LogProbe(ready['log'])
+    elif 'port' in ready:
+        probe = PortProbe(port or ready['port'])
+    elif 'procs' in ready:
+        probe = TreeProbe(ready['procs'])
+    else:
+        probe = AliveProbe(ready.get('alive', 2.0))
+    return probe, ready.get('timeout', 30)
+
+
 class ClaraManagerError(Exception):
     pass
 
 
-class ClaraManager():
+# Events are queued by any thread and sent by the thread that owns the
+# PUB socket, as a [kind, json] multipart message.
+class EventPublisher():
+    def __init__(self):
+        self._events = Queue.Queue()
+        self._socket = None
+
+    def publish(self, kind, key, **fields):
+        event = dict(fields, event=kind, instance=key, host=host_ip,
+                     time=time.time())
+        self._events.put(event)
+
+    def start(self, context, addr):
+        self._socket = context.socket(zmq.PUB)
+        self._socket.bind(addr)
+        thread = threading.Thread(target=self._send)
+        thread.daemon = True
+        thread.start()
+
+    def _send(self):
+        while True:
+            event = self._events.get()
+            self._socket.send_multipart([event['event'], json.dumps(event)])
+
+
+# A long-lived query helper reads one request per line from stdin and
+# replies with the output lines followed by "%%END <exit code>".
+# CLARA has no such helper, so only the fake profile sets a "query"
+# command, and the real DPEs run the orchestrator for every request.
+class QueryChannel():
+    end_mark = '%%END'
+
+    def __init__(self, conf, timeout=30):
+        self._conf = conf
+        self._timeout = timeout
+        self._proc = None
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def request(self, request):
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            try:
+                self._proc.stdin.write(request + '\n')
+                self._proc.stdin.flush()
+                return self._read_reply()
+            except Exception:
+                self._stop()
+                raise
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def _start(self):
+        self._stop()
+        self._conf.open_logs()
+        self._proc = subprocess.Popen(self._conf.cmd,
+                                      cwd=self._conf.cwd,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      env=self._conf.env)
+        self._conf.attach_logs(err=self._proc.stderr)
+        self._conf.set_proc(self._proc)
+
+    def _stop(self):
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdin.close()
+        self._proc.stdout.close()
+        self._conf.close_logs()
+        self._proc = None
+        self._buffer = ''
+
+    def _read_reply(self):
+        deadline = time.time() + self._timeout
+        lines = []
+        while True:
+            line = self._read_line(deadline)
+            if line.startswith(self.end_mark):
+                return lines, [], int(line.split()[1])
+            lines.append(line)
+
+    def _read_line(self, deadline):
+        fd = self._proc.stdout.fileno()
+        while '\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ClaraManagerError('Query timeout')
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            data = os.read(fd, 4096)
+            if not data:
+                raise ClaraManagerError('Query channel closed')
+            self._buffer += data
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line
+
+
+def standby_command(cmd, settings):
+    if 'cmd' in settings:
+        return settings['cmd'].split()
+    for i, arg in enumerate(cmd):
+        if arg.endswith('.py'):
+            preload = ','.join(settings.get('preload', []))
+            launcher = [standby_launcher]
+            if preload:
+                launcher += ['--preload', preload]
+            return cmd[:i] + launcher + cmd[i:]
+    raise ClaraManagerError('Cannot keep on standby: %s' % ' '.join(cmd))
+
+
+class StandbyPool():
     def __init__(self, clara):
+        self.clara = clara
+        self._pool = {}
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+
+    def settings(self):
+        for lang, conf in self.clara.items():
+            if not isinstance(conf, dict):
+                continue
+            for instance, settings in conf.get('standby', {}).items():
+                yield lang, instance, settings
+
+    def fill(self):
+        for lang, instance, settings in self.settings():
+            key = '%s/%s' % (lang, instance)
+            missing = settings.get('size', 1) - self._available(key)
+            for _ in range(missing):
+                try:
+                    standby = self._spawn(lang, instance, settings)
+                except Exception as e:
+                    log.warning("Could not spawn standby %s: %s" % (key, e))
+                    break
+                with self._lock:
+                    self._pool.setdefault(key, []).append(standby)
+
+    def claim(self, key):
+        with self._lock:
+            pool = self._pool.get(key, [])
+            while pool:
+                conf, proc = pool.pop(0)
+                if proc.poll() is None:
+                    self._refill.set()
+                    return conf, proc
+        return None
+
+    def run(self):
+        while True:
+            self.fill()
+            self._refill.wait()
+            self._refill.clear()
+
+    def start(self):
+        filler = threading.Thread(target=self.run)
+        filler.daemon = True
+        filler.start()
+        return filler
+
+    def close(self):
+        with self._lock:
+            pools, self._pool = self._pool.values(), {}
+        for conf, proc in sum(pools, []):
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    def _available(self, key):
+        with self._lock:
+            pool = self._pool.setdefault(key, [])
+            pool[:] = [(c, p) for c, p in pool if p.poll() is None]
+            return len(pool)
+
+    def _spawn(self, lang, instance, settings):
+        conf = ClaraProcessConfig(self.clara, lang, instance)
+        conf.cmd = standby_command(conf.cmd, settings)
+        proc = subprocess.Popen(conf.cmd,
+                                cwd=conf.cwd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                preexec_fn=os.setsid,
+                                env=conf.env)
+        conf.set_proc(proc)
+        return conf, proc
+
+
+class ClaraManager():
+    def __init__(self, clara, workers=8):
         self.clara = clara
         self.instances = {}
         self.orchestrators = []
-        self.logs = []
+        self.logs = {}
+        self.teardown = {}
+        self.workers = workers
+        self.monitor = ClaraMonitor(**clara.get('monitor', {}))
+        self.standby = StandbyPool(clara)
+        self.events = EventPublisher()
 
-    def run(self):
+        self._channels = {}
+        self._queries = {}
+        self._queries_gen = 0
+        self._queries_lock = threading.Lock()
+
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+        self.allocations = {}
+        self._alloc_lock = threading.Lock()
+
+    def instance_lock(self, key):
+        with self._locks_guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def invalidate_queries(self):
+        with self._queries_lock:
+            self._queries_gen += 1
+            self._queries.clear()
+
+    def close_channels(self):
+        for channel in self._channels.values():
+            channel.close()
+
+    def report_teardown(self, key, latency, killed=False):
+        self.teardown[key] = latency
+        if killed:
+            log.warning("%s killed after %.3f s" % (key, latency))
+        else:
+            log.info("%s stopped in %.3f s" % (key, latency))
+
+    def run(self, host='*'):
         context = zmq.Context()
-        socket = context.socket(zmq.REP)
-        socket.bind("tcp://*:%s" % port)
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind("tcp://%s:%s" % (host, port))
+        replies = context.socket(zmq.PULL)
+        replies.bind(replies_addr)
+        self.events.start(context, "tcp://%s:%s" % (host, events_port))
+
+        requests = Queue.Queue()
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self.process_requests,
+                                      args=(context, requests))
+            worker.daemon = True
+            worker.start()
+
+        self.monitor.start()
+        self.standby.start()
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+
         time.sleep(0.1)
         while True:
-            msg = socket.recv()
-            res = self.dispatch_request(msg)
-            socket.send_multipart(res)
+            events = dict(poller.poll())
+            if frontend in events:
+                requests.put(frontend.recv_multipart())
+            if replies in events:
+                frontend.send_multipart(replies.recv_multipart())
+
+    def process_requests(self, context, requests):
+        socket = context.socket(zmq.PUSH)
+        socket.connect(replies_addr)
+        while True:
+            frames = requests.get()
+            try:
+                socket.send_multipart(self.handle_request(frames))
+            except Exception as e:
+                log.exception("Could not reply to %s" % frames[-1:])
+                envelope, _ = split_envelope(frames)
+                error = encode_frame("Unexpected exception: %s" % e)
+                socket.send_multipart(envelope + ['ERROR', error])
+
+    def handle_request(self, frames):
+        envelope, body = split_envelope(frames)
+        if body and body[0] == batch_request:
+            reply = self.dispatch_batch(body[1:])
+        else:
+            reply = self.dispatch_request(body[0] if body else '')
+        return envelope + map(encode_frame, reply)
+
+    def dispatch_batch(self, msgs):
+        if not msgs:
+            return ['ERROR', 'Empty batch']
+
+        steps = []
+        for msg in msgs:
+            independent = msg.startswith(parallel_mark)
+            if independent:
+                msg = msg[len(parallel_mark):]
+            if independent and steps and steps[-1][0]:
+                steps[-1][1].append(msg)
+            else:
+                steps.append((independent, [msg]))
+
+        results = []
+        failed = False
+        for _, group in steps:
+            if failed:
+                results.extend(('SKIPPED', 0.0, []) for _ in group)
+                continue
+            replies = self._dispatch_group(group)
+            failed = any(status != 'SUCCESS' for status, _, _ in replies)
+            results.extend(replies)
+
+        return ['SUCCESS'] + [encode_result(*r) for r in results]
+
+    def _dispatch_group(self, group):
+        if len(group) == 1:
+            return [self._timed_dispatch(group[0])]
+
+        replies = [None] * len(group)
+
+        def dispatch(i):
+            replies[i] = self._timed_dispatch(group[i])
+
+        threads = [threading.Thread(target=dispatch, args=(i,))
+                   for i in range(len(group))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return replies
+
+    def _timed_dispatch(self, msg):
+        start = time.time()
+        res = self.dispatch_request(msg)
+        return res[0], time.time() - start, res[1:]
 
     def dispatch_request(self, msg):
         try:
             if not msg:
                 return ['ERROR', 'Empty request']
-            req = msg.split(':')
 
-            if len(req) != 4:
-                return ['ERROR', 'Bad request: "%s"' % msg]
+            req_id, action, lang, instance, args = parse_request(msg)
+            if req_id is not None:
+                log.debug("Request %s: %s %s/%s" %
+                          (req_id, action, lang, instance))
 
-            _, action, lang, instance = req
             if action == 'start':
-                self.start_clara(lang, instance)
+                lines = self.start_clara(lang, instance, args)
+                return ['SUCCESS'] + (lines or [''])
             elif action == 'stop':
                 if lang == 'all' or instance == 'all':
-                    stop_all(self)
+                    lines = stop_all(self)
                 else:
-                    self.stop_clara(lang, instance)
+                    lines = self.stop_clara(lang, instance)
+                return ['SUCCESS'] + (lines or [''])
+            elif action == 'stats':
+                return ['SUCCESS'] + self.instance_stats(lang, instance)
+            elif action == 'logs':
+                lines = self.read_logs(lang, instance, args)
+                return ['SUCCESS'] + (lines or [''])
             elif action == 'request':
-                out, err, ec = self.standard_request(lang, instance)
+                out, err, ec = self.standard_request(
+                    lang, instance, args.get('cache', True) is not False)
                 if ec == 0:
-                    return ['SUCCESS'] + out
+                    return ['SUCCESS'] + (out or [''])
                 else:
                     return ['ERROR'] + out + err
-            else:
-                return ['ERROR', 'Unsupported action: %s' % action]
 
             return ['SUCCESS', '']
 
@@ -169,57 +850,213 @@ class ClaraManager():
         except Exception as e:
             return ['ERROR', "Unexpected exception: " + str(e)]
 
-    def start_clara(self, clara_lang, clara_instance):
+    def start_clara(self, clara_lang, clara_instance, args=None):
         if clara_lang not in self.clara:
             raise ClaraManagerError('Bad language: %s' % clara_lang)
 
-        if clara_instance != 'platform' and clara_instance != 'dpe':
-            raise ClaraManagerError('Bad instance: %s' % clara_instance)
+        check_instance(clara_instance)
+
+        args = dict(args or {})
+        timeout = args.pop('timeout', None)
 
         key = '%s/%s' % (clara_lang, clara_instance)
-        if key in self.instances:
-            raise ClaraManagerError('%s already running!' % key)
+        with self.instance_lock(key):
+            if key in self.instances:
+                raise ClaraManagerError('%s already running!' % key)
+            self.invalidate_queries()
+            alloc = self.allocate(key, clara_lang, clara_instance, args)
+            try:
+                self._start_process(key, clara_lang, clara_instance,
+                                    args, timeout, alloc)
+            except Exception:
+                self.release(key)
+                raise
+            return allocation_report(alloc)
 
-        clara_conf = ClaraProcessConfig(self.clara,
-                                        clara_lang,
-                                        clara_instance)
-        clara_conf.open_logs()
+    def allocate(self, key, clara_lang, clara_instance, args):
+        _, inst_id = split_instance(clara_instance)
+        cores = args.pop('cores', None)
+        numa = args.pop('numa', None)
+        ports = self.clara[clara_lang].get('ports')
+        with self._alloc_lock:
+            used_ports = set()
+            used_cores = set()
+            for other in self.allocations.values():
+                used_ports.add(other['port'])
+                used_cores.update(other['cores'] or [])
+            if 'port' not in args and inst_id is not None and ports:
+                args['port'] = allocate_port(ports, used_ports)
+            if cores is not None:
+                cores = allocate_cores(int(cores), used_cores, numa)
+            alloc = {'port': args.get('port'), 'cores': cores, 'numa': numa}
+            self.allocations[key] = alloc
+        return alloc
 
-        clara_proc = subprocess.Popen(clara_conf.cmd,
-                                      cwd=clara_conf.cwd,
-                                      stdout=clara_conf.out,
-                                      stderr=clara_conf.err,
-                                      preexec_fn=os.setsid,
-                                      env=clara_conf.env)
+    def release(self, key):
+        with self._alloc_lock:
+            self.allocations.pop(key, None)
 
-        for i in range(5):
-            if clara_proc.poll() is not None:
+    def _start_process(self, key, clara_lang, clara_instance,
+                       args=None, timeout=None, alloc=None):
+        if key in self.instances:
+            raise ClaraManagerError('%s already running!' % key)
+
+        alloc = alloc or {}
+        pinned = alloc.get('cores') or alloc.get('numa') is not None
+        standby = self.standby.claim(key) if not (args or pinned) else None
+        if standby:
+            clara_conf, clara_proc = standby
+            clara_conf.open_logs()
+            clara_proc.stdin.write('\n')
+            clara_proc.stdin.close()
+        else:
+            clara_conf = ClaraProcessConfig(self.clara,
+                                            clara_lang,
+                                            clara_instance,
+                                            args,
+                                            alloc.get('cores'),
+                                            alloc.get('numa'))
+            clara_conf.open_logs()
+            try:
+                clara_proc = subprocess.Popen(clara_conf.cmd,
+                                              cwd=clara_conf.cwd,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.PIPE,
+                                              preexec_fn=os.setsid,
+                                              env=clara_conf.env)
+            except Exception:
                 clara_conf.close_logs()
-                raise ClaraManagerError('Could not start %s' % key)
-            time.sleep(0.4)
+                raise
 
         clara_conf.set_proc(clara_proc)
+        try:
+            clara_conf.attach_logs(clara_proc.stdout, clara_proc.stderr)
+            self.logs[key] = clara_conf.logs
+            self.events.publish('start', key, pid=clara_proc.pid)
+            self._watch_exit(key, clara_conf, clara_proc)
+            start = time.time()
+            self._wait_ready(key, clara_conf, clara_proc, timeout)
+            self.events.publish('ready', key, pid=clara_proc.pid,
+                                elapsed=time.time() - start)
+
+            self.instances[key] = clara_conf
+            self.monitor.watch(key, clara_proc.pid)
+        except Exception:
+            self.instances.pop(key, None)
+            stop_processes({key: clara_conf})
+            raise
 
-        self.instances[key] = clara_conf
+    # A blocking wait per child reports its exit as soon as it happens,
+    # without a SIGCHLD handler interrupting the other threads.
+    def _watch_exit(self, key, clara_conf, clara_proc):
+        def wait():
+            code = clara_proc.wait()
+            if not clara_conf.stopping:
+                log.warning("%s exited with code %s" % (key, code))
+            self.events.publish('exit', key, pid=clara_proc.pid, code=code,
+                                expected=clara_conf.stopping)
+
+        watcher = threading.Thread(target=wait)
+        watcher.daemon = True
+        watcher.start()
+        return watcher
+
+    def _wait_ready(self, key, clara_conf, clara_proc, timeout=None):
+        lang, instance = key.split('/')
+        probe, default_timeout = readiness_probe(self.clara, lang, instance,
+                                                 clara_conf.port)
+        timeout = timeout or default_timeout
+        deadline = time.time() + timeout
+        interval = 0.01
+        while True:
+            if clara_proc.poll() is not None:
+                raise ClaraManagerError('Could not start %s' % key)
+            if probe(clara_conf, clara_proc) and clara_proc.poll() is None:
+                return
+            if time.time() >= deadline:
+                raise ClaraManagerError('Timeout: %s not ready after %s s' %
+                                        (key, timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, 0.2)
 
     def stop_clara(self, clara_lang, clara_instance):
         if clara_lang not in self.clara:
             raise ClaraManagerError('Bad language: %s' % clara_lang)
 
-        if clara_instance != 'platform' and clara_instance != 'dpe':
-            raise ClaraManagerError('Bad instance: %s' % clara_instance)
+        check_instance(clara_instance)
 
         key = '%s/%s' % (clara_lang, clara_instance)
-        if key not in self.instances:
-            raise ClaraManagerError('%s is not running!' % key)
+        with self.instance_lock(key):
+            if key not in self.instances:
+                raise ClaraManagerError('%s is not running!' % key)
 
-        run = self.instances.pop(key)
-        stop_process(run)
+            self.invalidate_queries()
+            self.monitor.unwatch(key)
+            run = self.instances.pop(key)
+            report = stop_processes({key: run})
+            latency, killed = report[key]
+            self.release(key)
+            self.report_teardown(key, latency, killed)
+            if killed:
+                raise OSError("Process has been killed")
+            return teardown_report(report)
 
-    def standard_request(self, clara_lang, request):
+    def read_logs(self, clara_lang, clara_instance, args):
+        key = '%s/%s' % (clara_lang, clara_instance)
+        logs = self.logs.get(key)
+        if logs is None:
+            raise ClaraManagerError('No logs for %s' % key)
+        command = args.get('command')
+        if command == 'tail':
+            return logs.tail(int(args.get('lines') or 20))
+        if command == 'grep':
+            if not args.get('pattern'):
+                raise ClaraManagerError('Missing grep pattern')
+            return logs.grep(args['pattern'])
+        raise ClaraManagerError('Unsupported logs command: %s' % command)
+
+    def instance_stats(self, clara_lang, clara_instance):
+        key = '%s/%s' % (clara_lang, clara_instance)
+        stats = self.monitor.report(key)
+        if stats is None:
+            raise ClaraManagerError('No stats for %s' % key)
+        return stats
+
+    # The cache is only invalidated by the starts and stops on this daemon,
+    # so it misses the DPEs registered from other nodes until the TTL
+    # expires. Requests with "cache": false in their arguments skip it.
+    def standard_request(self, clara_lang, request, cache=True):
         if clara_lang not in self.clara:
             raise ClaraManagerError('Bad language: %s' % clara_lang)
 
+        ttl = self.clara[clara_lang].get('query_ttl', 0) if cache else 0
+        key = (clara_lang, request)
+        with self._queries_lock:
+            gen = self._queries_gen
+            cached = self._queries.get(key)
+        if cached and time.time() - cached[0] < ttl:
+            return cached[1]
+
+        if 'query' in self.clara[clara_lang]:
+            result = self._query_channel(clara_lang).request(request)
+        else:
+            result = self._run_orchestrator(clara_lang, request)
+
+        if ttl and result[2] == 0:
+            with self._queries_lock:
+                if gen == self._queries_gen:
+                    self._queries[key] = (time.time(), result)
+        return result
+
+    def _query_channel(self, clara_lang):
+        with self._queries_lock:
+            channel = self._channels.get(clara_lang)
+            if channel is None:
+                conf = ClaraProcessConfig(self.clara, clara_lang, 'query')
+                channel = self._channels[clara_lang] = QueryChannel(conf)
+            return channel
+
+    def _run_orchestrator(self, clara_lang, request):
         clara_conf = ClaraProcessConfig(self.clara,
                                         clara_lang,
                                         'orchestrator')
@@ -240,11 +1077,88 @@ class ClaraManager():
         return out_lines, err_lines, errcode
 
 
+# Stand-in executables to run the daemon on a single box without CLARA.
+# The fake DPEs are tuned with the CLARA_FAKE_* environment variables.
+# Several daemons can share the box, each one bound to its own loopback
+# address, and their fake DPEs register in the same directory.
+def fake_profile(root, host='*'):
+    fake = '%s -u %s --registry %s' % (sys.executable, fake_launcher,
+                                       os.path.join(root, 'registry'))
+    logs = os.path.join(root, 'log')
+    if host != '*':
+        fake += ' --host %s' % host
+        logs = os.path.join(logs, host)
+    return {
+        'services': root,
+        'logs': logs,
+        'capture': dict(clara['capture']),
+        'monitor': dict(clara['monitor']),
+        'java': {
+            'fullpath': root,
+            'platform': fake + ' dpe',
+            'dpe': fake + ' dpe',
+            'orchestrator': fake + ' orchestrator',
+            'query': fake + ' query',
+            'args': dict(clara['java']['args']),
+            'ports': {'base': 7781, 'step': 10, 'slots': 16},
+            'defaults': {
+                'dpe': {'port': 7781},
+            },
+            'ready': {
+                'platform': {'port': 7771, 'timeout': 30},
+                'dpe': {'port': 7781, 'timeout': 30},
+            },
+        },
+        'python': {
+            'fullpath': root,
+            'platform': fake + ' dpe',
+            'dpe': fake + ' dpe',
+            'orchestrator': fake + ' orchestrator',
+            'query': fake + ' query',
+            'args': {'port': '-port'},
+            'ports': {'base': 7801, 'step': 10, 'slots': 16},
+            'defaults': {
+                'dpe': {'port': 7801},
+            },
+            'ready': {
+                'platform': {'log': 'DPE ready', 'timeout': 30},
+                'dpe': {'log': 'DPE ready', 'timeout': 30},
+            },
+            'standby': {
+                'dpe': {'size': 1},
+            },
+        },
+    }
+
+
+profiles = {
+    'vagrant': lambda args: clara,
+    'fake': lambda args: fake_profile(args.fake_root, args.host),
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", choices=sorted(profiles),
+                        default="vagrant")
+    parser.add_argument("--fake-root", default="/tmp/clara-fake")
+    parser.add_argument("--host", default="*")
+
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    manager = ClaraManager(clara)
+    args = get_arguments()
+    config = profiles[args.profile](args)
+    if not os.path.isdir(config['logs']):
+        os.makedirs(config['logs'])
+    manager = ClaraManager(config)
 
+    log.setLevel(logging.INFO)
     atexit.register(stop_all, manager)
+    atexit.register(manager.close_channels)
+    atexit.register(manager.standby.close)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, lambda num, frame: sys.exit(1))
 
-    manager.run()
+    manager.run(args.host)
@@ -0,0 +1,126 @@
+import collections
+import psutil
+import threading
+import time
+
+Sample = collections.namedtuple('Sample', [
+    'time', 'cpu', 'rss', 'threads', 'ctx_switches',
+    'read_bytes', 'write_bytes', 'fds',
+])
+
+
+class ProcessTreeStats():
+    def __init__(self, pid, size):
+        self.pid = pid
+        self.samples = collections.deque(maxlen=size)
+        self._procs = {}
+
+    def sample(self):
+        try:
+            root = self._process(self.pid)
+            tree = [root] + root.get_children(recursive=True)
+        except psutil.NoSuchProcess:
+            return None
+
+        values = [0.0, 0, 0, 0, 0, 0, 0]
+        alive = {}
+        for proc in tree:
+            proc = self._process(proc.pid, proc)
+            try:
+                values = [a + b for a, b in zip(values, _measure(proc))]
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            alive[proc.pid] = proc
+        self._procs = alive
+
+        sample = Sample(time.time(), *values)
+        self.samples.append(sample)
+        return sample
+
+    def summary(self):
+        samples = list(self.samples)
+        if not samples:
+            return []
+        first, last = samples[0], samples[-1]
+        cpu = [s.cpu for s in samples]
+        return [
+            ('samples', len(samples)),
+            ('cpu_mean', round(sum(cpu) / len(cpu), 2)),
+            ('cpu_max', max(cpu)),
+            ('rss_peak', max(s.rss for s in samples)),
+            ('threads_max', max(s.threads for s in samples)),
+            ('fds_max', max(s.fds for s in samples)),
+            ('ctx_switches', last.ctx_switches - first.ctx_switches),
+            ('read_bytes', last.read_bytes - first.read_bytes),
+            ('write_bytes', last.write_bytes - first.write_bytes),
+        ]
+
+    def _process(self, pid, proc=None):
+        if pid not in self._procs:
+            proc = proc or psutil.Process(pid)
+            proc.get_cpu_percent(interval=None)
+            self._procs[pid] = proc
+        return self._procs[pid]
+
+
+def _measure(proc):
+    ctx = proc.get_num_ctx_switches()
+    try:
+        io = proc.get_io_counters()
+        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+    except (AttributeError, psutil.AccessDenied):
+        read_bytes, write_bytes = 0, 0
+    return (proc.get_cpu_percent(interval=None),
+            proc.get_memory_info().rss,
+            proc.get_num_threads(),
+            ctx.voluntary + ctx.involuntary,
+            read_bytes,
+            write_bytes,
+            proc.get_num_fds())
+
+
+class ClaraMonitor():
+    def __init__(self, interval=1.0, samples=600):
+        self.interval = interval
+        self.size = samples
+        self._stats = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def watch(self, key, pid):
+        with self._lock:
+            self._stats[key] = ProcessTreeStats(pid, self.size)
+            self._watched.add(key)
+
+    def unwatch(self, key):
+        with self._lock:
+            self._watched.discard(key)
+
+    def sample_all(self):
+        with self._lock:
+            stats = [self._stats[key] for key in self._watched]
+        for tree in stats:
+            tree.sample()
+
+    def run(self):
+        while True:
+            start = time.time()
+            self.sample_all()
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        sampler = threading.Thread(target=self.run)
+        sampler.daemon = True
+        sampler.start()
+        return sampler
+
+    def report(self, key):
+        with self._lock:
+            tree = self._stats.get(key)
+        if tree is None:
+            return None
+        lines = ['%s %s' % item for item in tree.summary()]
+        lines.append(' '.join(Sample._fields))
+        for sample in list(tree.samples):
+            lines.append('%.3f %.1f %d %d %d %d %d %d' % sample)
+        return lines
@@ -0,0 +1,131 @@
+import json
+import math
+import xml.etree.ElementTree as ET
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def action_stats(suites):
+    durations = {}
+    for suite in suites:
+        for test in suite['tests']:
+            for action in test['actions']:
+                durations.setdefault(action['type'], []).append(
+                    action['duration'])
+    stats = {}
+    for kind, values in durations.items():
+        stats[kind] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': max(values),
+        }
+    return stats
+
+
+def build_report(suites, duration):
+    return {
+        'passed': all(s['passed'] for s in suites),
+        'duration': duration,
+        'suites': suites,
+        'actions': action_stats(suites),
+    }
+
+
+def compare_reports(current, previous, threshold=0.2, min_delta=0.05):
+    slowdowns = []
+    old_actions = previous.get('actions', {})
+    for kind, stats in sorted(current['actions'].items()):
+        old = old_actions.get(kind)
+        if not old:
+            continue
+        for key in ('p50', 'p95'):
+            delta = stats[key] - old[key]
+            if delta > min_delta and delta > old[key] * threshold:
+                slowdowns.append({
+                    'type': kind,
+                    'stat': key,
+                    'previous': old[key],
+                    'current': stats[key],
+                })
+    return slowdowns
+
+
+def read_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+# A failed suite without failed tests gets a "setup" testcase with the
+# error, so the totals always match the testcases.
+def junit_xml(report):
+    root = ET.Element('testsuites', time='%.3f' % report['duration'])
+    totals = {'tests': 0, 'failures': 0, 'errors': 0}
+    for suite in report['suites']:
+        tests = suite['tests']
+        failures = sum(1 for t in tests if t['error'])
+        errors = int(not suite['passed'] and not failures)
+        count = len(tests) + int(errors or not tests)
+        node = ET.SubElement(root, 'testsuite',
+                             name=suite['name'],
+                             tests=str(count),
+                             failures=str(failures),
+                             errors=str(errors),
+                             time='%.3f' % suite['duration'])
+        totals['tests'] += count
+        totals['failures'] += failures
+        totals['errors'] += errors
+        for test in tests:
+            case = ET.SubElement(node, 'testcase',
+                                 classname=suite['name'],
+                                 name=test['name'],
+                                 time='%.3f' % test['duration'])
+            if test['error']:
+                ET.SubElement(case, 'failure', message=test['error'])
+        if errors or not tests:
+            case = ET.SubElement(node, 'testcase',
+                                 classname=suite['name'],
+                                 name='setup',
+                                 time='0.000')
+            if errors:
+                ET.SubElement(case, 'error',
+                              message=suite['error'] or 'Suite failed')
+    for key, value in totals.items():
+        root.set(key, str(value))
+    return ET.tostring(root)
+
+
+def write_junit(report, path):
+    with open(path, 'w') as f:
+        f.write(junit_xml(report))
+
+
+def format_report(report):
+    lines = []
+    for suite in report['suites']:
+        status = 'PASS' if suite['passed'] else 'FAIL'
+        lines.append('%s  %-40s %8.3f s' %
+                     (status, suite['name'], suite['duration']))
+    lines.append('')
+    lines.append('%-24s %6s %8s %8s %8s' %
+                 ('action', 'count', 'p50', 'p95', 'max'))
+    for kind, stats in sorted(report['actions'].items()):
+        lines.append('%-24s %6d %8.3f %8.3f %8.3f' %
+                     (kind, stats['count'],
+                      stats['p50'], stats['p95'], stats['max']))
+    for slow in report.get('slowdowns', []):
+        lines.append('SLOWER  %s %s: %.3f s -> %.3f s' %
+                     (slow['type'], slow['stat'],
+                      slow['previous'], slow['current']))
+    return lines
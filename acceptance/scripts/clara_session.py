@@ -67,7 +67,7 @@ def create_session(tw):
     tw.new_window(5, 'python', '~/clara/dev/clara-python', True)
 
     tw.new_window(7, 'services', '~/clara/services')
-    tw.new_window(9, 'log', '~/clara/services/log')
+    tw.new_window(9, 'log', '/vagrant/acceptance/log')
 
     tw.select_window(1)
 
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib
+import os
+import runpy
+import sys
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preload", default="")
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+
+    for module in filter(None, args.preload.split(',')):
+        importlib.import_module(module)
+
+    claim = sys.stdin.readline()
+    if not claim:
+        sys.exit(0)
+
+    sys.argv = [args.script] + args.args + claim.split()
+    sys.path[0] = os.path.dirname(os.path.abspath(args.script))
+    runpy.run_path(args.script, run_name='__main__')
@@ -1,17 +1,74 @@
+import argparse
+import collections
+import itertools
+import json
 import logging
 import os
 import re
+import shlex
+import sys
+import threading
+import time
 import zmq
 
+from clara_bench import format_bench
+from clara_bench import parse_mix
+from clara_bench import run_bench
 from clara_common import get_base_dir
 from clara_common import get_config_file
 from clara_common import get_config_section
 from clara_common import read_yaml
+from clara_report import build_report
+from clara_report import compare_reports
+from clara_report import format_report
+from clara_report import read_report
+from clara_report import write_json
+from clara_report import write_junit
 
 logging.basicConfig()
 log = logging.getLogger("ACCEPTANCE")
 
 port = "7788"
+events_port = "7789"
+protocol_version = 1
+batch_request = "clara:batch"
+parallel_mark = "&"
+broadcast_timeout = 30
+request_timeout = 30
+request_retries = 2
+# A start waits for the readiness of the process (30 s unless the action
+# sets a timeout), and a failed one is stopped with SIGTERM, then SIGKILL,
+# waiting up to 5 s each.
+ready_timeout = 30
+stop_grace = 10
+idempotent_actions = ('stats', 'request', 'logs')
+fe_host_langs = ('java',)
+
+action_re = '(start|stop)'
+lang_re = '(java|python|cpp)'
+args_action = re.compile(r'\s+with\s+(.*)$')
+platform_action = re.compile(r'%s\s+(%s\s+)?platform' % (action_re, lang_re))
+dpe_action = re.compile(r'%s\s+%s\s+dpe(\s+\w+)?\s+on\s+(\w+)' %
+                        (action_re, lang_re))
+request_action = re.compile(r'request\s+(%s\s+)?(list\s+(dpes))'
+                            r'(\s+on\s+(\w+))?' % lang_re)
+wait_action = re.compile(r'^wait\s+until\s+(.+?)\s+equals\s+(.*?)'
+                         r'\s+within\s+(\d+(?:\.\d+)?)\s*s?\s*$')
+wait_interval = 0.05
+wait_max_interval = 1.0
+
+TestStep = collections.namedtuple('TestStep', [
+    'action', 'node', 'msg', 'expect', 'within',
+])
+TestPlan = collections.namedtuple('TestPlan', [
+    'item', 'steps', 'result', 'timeout',
+])
+SuitePlan = collections.namedtuple('SuitePlan', [
+    'name', 'roles', 'setup', 'tests', 'error',
+])
+
+_plans = {}
+_plans_lock = threading.Lock()
 standard_requests = (
     'list-dpes'
 )
@@ -23,28 +80,101 @@ class ClaraRequestError(Exception):
 
 class ClaraDaemonClient():
 
-    def __init__(self, context, nodes):
+    def __init__(self, context, nodes,
+                 timeout=request_timeout, retries=request_retries):
+        self.timeout = timeout
+        self.retries = retries
+        self._context = context
+        self._nodes = nodes
         self._sockets = {}
-        for name, ip in nodes.items():
-            socket = context.socket(zmq.REQ)
-            socket.connect("tcp://%s:%s" % (ip, port))
-            self._sockets[name] = socket
-
-    def request(self, node, msg):
-        socket = self._sockets.get(node)
-        if not socket:
+        for name in nodes:
+            self._connect(name)
+
+    def request(self, node, msg, timeout=None):
+        if node not in self._sockets:
             raise ClaraRequestError('Bad node: "%s"' % node)
         if not msg:
             raise ClaraRequestError('Empty message')
-        return self._request(socket, msg)
+        timeout = timeout or request_deadline(msg, self.timeout)
+        return self._request(node, msg, timeout)
 
-    def request_all(self, msg):
+    def request_batch(self, node, msgs, timeout=None):
+        if node not in self._sockets:
+            raise ClaraRequestError('Bad node: "%s"' % node)
+        if not msgs or not all(msgs):
+            raise ClaraRequestError('Empty message')
+        timeout = timeout or sum(request_deadline(m, self.timeout)
+                                 for m in msgs)
+        text = self._request(node, [batch_request] + list(msgs), timeout)
+        return [decode_result(frame) for frame in text]
+
+    def request_all(self, msg, timeout=broadcast_timeout):
+        poller = zmq.Poller()
+        pending = {}
+        for node, socket in self._sockets.items():
+            socket.send(msg)
+            poller.register(socket, zmq.POLLIN)
+            pending[socket] = node
+
+        results = {}
+        deadline = time.time() + timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for socket, _ in poller.poll(remaining * 1000):
+                node = pending.pop(socket)
+                poller.unregister(socket)
+                try:
+                    text = self._reply(socket.recv_multipart())
+                    results[node] = ('SUCCESS', text)
+                except ClaraRequestError as e:
+                    results[node] = ('ERROR', str(e))
+
+        for socket, node in pending.items():
+            results[node] = ('TIMEOUT', 'No reply after %s s' % timeout)
+            self._connect(node)
+        return results
+
+    def subscribe(self, kinds=('',), nodes=None):
+        addrs = [self._nodes[n] for n in (nodes or self._nodes)]
+        return ClaraEventStream(self._context, addrs, kinds)
+
+    def close(self):
         for socket in self._sockets.values():
-            self._request(socket, msg)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
+        self._sockets = {}
 
-    def _request(self, socket, msg):
-        socket.send(msg)
-        res = socket.recv_multipart()
+    def _connect(self, node):
+        old = self._sockets.get(node)
+        if old is not None:
+            old.setsockopt(zmq.LINGER, 0)
+            old.close()
+        socket = self._context.socket(zmq.REQ)
+        socket.connect("tcp://%s:%s" % (self._nodes[node], port))
+        self._sockets[node] = socket
+        return socket
+
+    def _request(self, node, msg, timeout=None):
+        timeout = timeout or self.timeout
+        retries = self.retries if is_idempotent(msg) else 0
+        while True:
+            socket = self._sockets[node]
+            if isinstance(msg, list):
+                socket.send_multipart(msg)
+            else:
+                socket.send(msg)
+            if socket.poll(timeout * 1000, zmq.POLLIN):
+                return self._reply(socket.recv_multipart())
+            self._connect(node)
+            if retries <= 0:
+                raise ClaraRequestError('Timeout: no reply from %s after '
+                                        '%s s' % (node, timeout))
+            retries -= 1
+            log.warning("No reply from %s, retrying" % node)
+
+    def _reply(self, res):
         if not res:
             raise ClaraRequestError('Empty response')
         if len(res) < 2:
@@ -59,9 +189,68 @@ class ClaraDaemonClient():
         return text
 
 
-def get_all_files(base_dir):
+class ClaraEventStream():
+
+    def __init__(self, context, addrs, kinds=('',)):
+        self._socket = context.socket(zmq.SUB)
+        for kind in kinds:
+            self._socket.setsockopt(zmq.SUBSCRIBE, kind)
+        for addr in addrs:
+            self._socket.connect("tcp://%s:%s" % (addr, events_port))
+
+    def receive(self, timeout=None):
+        ms = None if timeout is None else int(timeout * 1000)
+        if not self._socket.poll(ms, zmq.POLLIN):
+            return None
+        _, data = self._socket.recv_multipart()
+        return json.loads(data)
+
+    def close(self):
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.close()
+
+
+def msg_action(msg):
+    msg = msg.lstrip(parallel_mark)
+    if msg.startswith('{'):
+        try:
+            req = json.loads(msg)
+        except ValueError:
+            return None, {}
+        args = req.get('args')
+        return req.get('action'), args if isinstance(args, dict) else {}
+    return (msg.split(':') + [None])[1], {}
+
+
+def is_idempotent(msg):
+    if isinstance(msg, list):
+        return all(is_idempotent(m) for m in msg[1:])
+    return msg_action(msg)[0] in idempotent_actions
+
+
+def request_deadline(msg, default=request_timeout):
+    action, args = msg_action(msg)
+    if action != 'start':
+        return default
+    try:
+        ready = float(args.get('timeout') or ready_timeout)
+    except (TypeError, ValueError):
+        ready = ready_timeout
+    return max(default, ready + stop_grace)
+
+
+def decode_result(frame):
+    header, _, body = frame.partition('\n')
+    try:
+        status, elapsed = header.split()
+        return status, float(elapsed), body.split('\n')
+    except ValueError:
+        raise ClaraRequestError('Bad batch result: "%s"' % frame)
+
+
+def get_all_files(base_dir, tests_dir='tests'):
     all_tests = []
-    td = os.path.join(base_dir, 'tests')
+    td = os.path.join(base_dir, tests_dir)
     for f in os.listdir(td):
         if f.endswith(".yaml"):
             tf = os.path.join(td, f)
@@ -69,16 +258,36 @@ def get_all_files(base_dir):
     return all_tests
 
 
+def parse_arguments(text):
+    args = {}
+    for arg in shlex.split(text):
+        name, sep, value = arg.partition('=')
+        if not name or not sep:
+            raise ClaraRequestError('Malformed argument: "%s"' % arg)
+        args[name] = value
+    return args
+
+
 def parse_action(action, item='java'):
 
     def create_msg(action, lang, instance):
-        return ':'.join(['clara', action, lang, instance])
+        if not args:
+            return ':'.join(['clara', action, lang, instance])
+        return json.dumps({
+            'version': protocol_version,
+            'action': action,
+            'target': {'lang': lang, 'instance': instance},
+            'args': args,
+        }, sort_keys=True)
 
     action = action.replace('{{item}}', item)
-    act_re = '(start|stop)'
-    lang_re = '(java|python|cpp)'
+    args = {}
+    m = args_action.search(action)
+    if m:
+        args = parse_arguments(m.group(1))
+        action = action[:m.start()]
 
-    m = re.search(r'%s\s+(%s\s+)?platform' % (act_re, lang_re), action)
+    m = platform_action.search(action)
     if m:
         if m.group(3):
             lang = m.group(3)
@@ -86,13 +295,14 @@ def parse_action(action, item='java'):
             lang = 'java'
         return 'platform', create_msg(m.group(1), lang, 'platform')
 
-    m = re.search(r'%s\s+%s\s+dpe\s+on\s+(\w+)' % (act_re, lang_re), action)
+    m = dpe_action.search(action)
     if m:
-        return m.group(3), create_msg(m.group(1), m.group(2), 'dpe')
+        instance = 'dpe'
+        if m.group(3):
+            instance = 'dpe.' + m.group(3).strip()
+        return m.group(4), create_msg(m.group(1), m.group(2), instance)
 
-    req_re = '(list\s+(dpes))'
-    m = re.search(r'request\s+(%s\s+)?%s(\s+on\s+(\w+))?' % (lang_re, req_re),
-                  action)
+    m = request_action.search(action)
     if m:
         if m.group(2):
             lang = m.group(2)
@@ -110,96 +320,645 @@ def parse_action(action, item='java'):
     raise ClaraRequestError('Malformed action: "%s"' % action)
 
 
+# The polls of a wait skip the cached replies of the daemon, which do not
+# see the DPEs registered from other nodes.
+def parse_step(action, item='java', result=None):
+    m = wait_action.match(action.replace('{{item}}', item))
+    if not m:
+        node, msg = parse_action(action, item)
+        return TestStep(action, node, msg, None, None)
+    node, msg = parse_action(m.group(1), item)
+    if msg_action(msg)[0] == 'request':
+        req = structured_msg(msg)
+        req.setdefault('args', {})['cache'] = False
+        msg = json.dumps(req, sort_keys=True)
+    expect = m.group(2).strip()
+    if expect == 'result':
+        if result is None:
+            raise ClaraRequestError('The test has no result')
+        expect = result
+    else:
+        expect = [e.strip() for e in expect.strip('[]').split(',')]
+        expect = [e for e in expect if e]
+    return TestStep(action, node, msg, expect, float(m.group(3)))
+
+
+def step_target(step):
+    if step.msg.startswith('{'):
+        req = json.loads(step.msg)
+        target = req['target']
+        return req['action'], target['lang'], target['instance']
+    parts = step.msg.split(':', 3) + [None] * 3
+    return parts[1], parts[2], parts[3]
+
+
+def structured_msg(msg):
+    if msg.startswith('{'):
+        return json.loads(msg)
+    _, action, lang, instance = msg.split(':', 3)
+    return {
+        'version': protocol_version,
+        'action': action,
+        'target': {'lang': lang, 'instance': instance},
+    }
+
+
+def needs_fe_host(step):
+    action, lang, instance = step_target(step)
+    return step.expect is None and action == 'start' and \
+        lang in fe_host_langs and instance.split('.')[0] == 'dpe'
+
+
+def with_fe_host(step, fe_host):
+    if not needs_fe_host(step):
+        return step
+    req = structured_msg(step.msg)
+    req.setdefault('args', {}).setdefault('fe_host', fe_host)
+    return step._replace(msg=json.dumps(req, sort_keys=True))
+
+
+def action_type(step):
+    action, _, target = step_target(step)
+    if action == 'request':
+        kind = target.replace('-', ' ')
+    elif target is not None:
+        kind = '%s %s' % (action, target.split('.')[0])
+    else:
+        kind = step.msg
+    if step.expect is not None:
+        kind = 'wait ' + kind
+    return kind
+
+
+def compile_test(data, item):
+    actions = data.get('actions')
+    result = data.get('result')
+    if not actions:
+        raise ClaraRequestError('The test has no actions')
+    if result is None:
+        raise ClaraRequestError('The test has no result')
+    steps = [parse_step(a, item, result) for a in actions]
+    return TestPlan(item, steps, result, data.get('timeout'))
+
+
+def compile_suite(test_file):
+    data = read_yaml(test_file)
+    name = os.path.basename(test_file).replace('.yaml', '')
+    name = data.get('name', name)
+    roles = data.get('nodes')
+
+    tests = data.get('tests')
+    if not tests:
+        return SuitePlan(name, roles, {}, [], 'Missing tests')
+    setup = {}
+    plans = []
+    for item in data.get('with', ['java']):
+        try:
+            setup[item] = compile_setup(data.get('setup', []), item)
+        except ClaraRequestError as e:
+            error = 'Setup (%s): %s' % (item, e)
+            return SuitePlan(name, roles, {}, [], error)
+        for index, test in enumerate(tests, 1):
+            try:
+                test_name = 'test %d [%s]' % (index, item)
+                plans.append((item, test_name, compile_test(test, item)))
+            except ClaraRequestError as e:
+                error = 'Test %d (%s): %s' % (index, item, e)
+                return SuitePlan(name, roles, {}, [], error)
+    # Java DPEs register with the platform, keep it for the suite
+    if roles is not None and 'platform' not in roles and \
+            any(needs_fe_host(s) for s in suite_steps(setup, plans)):
+        roles = list(roles) + ['platform']
+    if roles is not None:
+        unknown = suite_nodes(setup, plans) - set(roles)
+        if unknown:
+            error = 'Unknown nodes: %s' % ', '.join(sorted(unknown))
+            return SuitePlan(name, roles, {}, [], error)
+    return SuitePlan(name, roles, setup, plans, None)
+
+
+def suite_steps(setup, plans):
+    for steps in setup.values():
+        for step in steps:
+            yield step
+    for _, _, plan in plans:
+        for step in plan.steps:
+            yield step
+
+
+def suite_nodes(setup, plans):
+    return set(step.node for step in suite_steps(setup, plans))
+
+
+def compile_setup(actions, item):
+    steps = [parse_step(a, item) for a in actions]
+    for step in steps:
+        if step.expect is not None or step_target(step)[0] != 'start':
+            raise ClaraRequestError('Only start actions are supported: '
+                                    '"%s"' % step.action)
+    return steps
+
+
+def load_suite(test_file):
+    try:
+        key = (os.path.abspath(test_file), os.path.getmtime(test_file))
+    except OSError:
+        return compile_suite(test_file)
+    with _plans_lock:
+        suite = _plans.get(key)
+    if suite is None:
+        suite = compile_suite(test_file)
+        with _plans_lock:
+            _plans[key] = suite
+    return suite
+
+
+class NodeState():
+
+    def __init__(self):
+        self.known = False
+        self.running = {}
+
+    def reset(self):
+        self.known = True
+        self.running = {}
+
+
+class ClusterState():
+
+    def __init__(self, nodes=None):
+        self.nodes = nodes if nodes is not None else {}
+
+    def node(self, role):
+        return self.nodes.setdefault(role, NodeState())
+
+    def track(self, step):
+        if step.expect is not None:
+            return
+        action, lang, instance = step_target(step)
+        node = self.node(step.node)
+        if action == 'start':
+            node.running[(lang, instance)] = step.msg
+        elif action == 'stop':
+            if lang == 'all' or instance == 'all':
+                node.running = {}
+            else:
+                node.running.pop((lang, instance), None)
+
+
 class ClaraTest:
 
-    def __init__(self, client, data, item):
+    def __init__(self, client, plan, state=None):
         self._client = client
-        self._actions = data.get('actions')
-        self._result = data.get('result')
-        self._item = item
+        self._plan = plan
+        self._state = state
+        self.convergence = []
+        self.timings = []
 
     def run(self):
         result = None
-        if not self._actions:
-            raise ClaraRequestError('The test has no actions')
-        if self._result is None:
-            raise ClaraRequestError('The test has no result')
-        for action in self._actions:
-            log.info("Request '%s'" % action)
-            node, msg = parse_action(action, self._item)
-            result = self._client.request(node, msg)
-        if result == self._result:
+        timeout = self._plan.timeout
+        steps = self._plan.steps
+        batches = itertools.groupby(steps,
+                                    lambda s: (s.node, s.expect is None))
+        for (node, batch), group in batches:
+            group = list(group)
+            for step in group:
+                log.info("Request '%s'" % step.action)
+            if not batch:
+                for step in group:
+                    result = self._wait(step)
+                continue
+            if len(group) == 1:
+                start = time.time()
+                result = self._client.request(node, group[0].msg, timeout)
+                self._record(group[0], time.time() - start)
+                self._track(group[0])
+                continue
+            msgs = [step.msg for step in group]
+            batch_timeout = timeout and timeout * len(msgs)
+            start = time.time()
+            results = self._client.request_batch(node, msgs, batch_timeout)
+            elapsed = time.time() - start
+            for step, (status, server, text) in zip(group, results):
+                self._record(step, elapsed, server)
+                if status != 'SUCCESS':
+                    raise ClaraRequestError('\n'.join(text))
+                self._track(step)
+                result = text
+        if result == self._plan.result:
             log.info("Result %s" % result)
             return result
         else:
             raise ClaraRequestError('Wrong result: "%s". Expected: "%s"' %
-                                    (result, self._result))
+                                    (result, self._plan.result))
+
+    def _wait(self, step):
+        start = time.time()
+        deadline = start + step.within
+        interval = wait_interval
+        while True:
+            remaining = deadline - time.time()
+            try:
+                result = self._client.request(step.node, step.msg,
+                                              max(remaining, wait_interval))
+            except ClaraRequestError as e:
+                result = 'error: %s' % e
+            if result == step.expect:
+                elapsed = time.time() - start
+                log.info("Converged after %.3f s" % elapsed)
+                self.convergence.append((step.action, elapsed))
+                self._record(step, elapsed)
+                return result
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ClaraRequestError('Timeout: no convergence after %s s. '
+                                        'Last result: "%s". Expected: "%s"' %
+                                        (step.within, result, step.expect))
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, wait_max_interval)
+
+    def _track(self, step):
+        if self._state is not None:
+            self._state.track(step)
+
+    def _record(self, step, elapsed, server=None):
+        self.timings.append({
+            'action': step.action,
+            'type': action_type(step),
+            'client': elapsed,
+            'server': server,
+            'duration': elapsed if server is None else server,
+        })
 
 
 class ClaraTestSuite:
 
     def __init__(self, client, test_file):
-        data = read_yaml(test_file)
-        test_name = os.path.basename(test_file).replace('.yaml', '')
-
-        self._name = data.get("name", test_name)
-        self._tests = data.get("tests")
-        self._context = data.get("with", ['java'])
+        suite = load_suite(test_file)
+
+        self.name = suite.name
+        self.roles = suite.roles
+        self.error = suite.error
+        self.convergence = []
+        self.results = []
+        self.duration = 0.0
+        self._setup = suite.setup
+        self._plans = suite.tests
         self._client = client
 
-    def run_tests(self):
-        if not self._tests:
-            log.error("Missing tests")
-            return (False, self._name)
+    def nodes(self):
+        return sorted(suite_nodes(self._setup, self._plans))
+
+    def run_tests(self, client=None, state=None, fe_host=None):
+        if client is not None:
+            self._client = client
+        if self.error:
+            log.error(self.error)
+            return (False, self.name)
+        setup, plans = self._setup, self._plans
+        if fe_host is not None:
+            setup, plans = self._with_fe_host(fe_host)
+        shared = state is not None
+        state = state if shared else ClusterState()
+        passed = False
+        suite_start = time.time()
         try:
-            log.info("Running %s" % self._name)
-            for item in self._context:
-                for data in self._tests:
-                    test = ClaraTest(self._client, data, item)
-                    test.run()
-            return (True, self._name)
+            log.info("Running %s" % self.name)
+            current = None
+            for item, test_name, plan in plans:
+                if item != current:
+                    self._reset(state, setup.get(item, []))
+                    current = item
+                self._run_test(test_name, plan, state)
+            passed = True
+            return (True, self.name)
         except ClaraRequestError as e:
             log.error(str(e))
-            return (False, self._name)
+            self.error = str(e)
+            return (False, self.name)
         finally:
-            self._client.request_all('clara:stop:all:all')
+            self.duration = time.time() - suite_start
+            if not (shared and passed):
+                self._stop_all(state)
+
+    def _with_fe_host(self, fe_host):
+        setup = dict((item, [with_fe_host(s, fe_host) for s in steps])
+                     for item, steps in self._setup.items())
+        plans = []
+        for item, test_name, plan in self._plans:
+            steps = [with_fe_host(s, fe_host) for s in plan.steps]
+            plans.append((item, test_name, plan._replace(steps=steps)))
+        return setup, plans
+
+    def _reset(self, state, setup):
+        desired = {}
+        for step in setup:
+            _, lang, instance = step_target(step)
+            desired.setdefault(step.node, {})[(lang, instance)] = step.msg
+
+        for role in sorted(set(desired) | set(state.nodes)):
+            node = state.node(role)
+            if not node.known:
+                self._client.request(role, 'clara:stop:all:all')
+                node.reset()
+            wanted = desired.get(role, {})
+            for key, msg in sorted(node.running.items()):
+                if wanted.get(key) != msg:
+                    self._stop(role, key)
+                    node.running.pop(key)
+
+        for step in setup:
+            _, lang, instance = step_target(step)
+            node = state.node(step.node)
+            if (lang, instance) in node.running:
+                if self._healthy(step.node, lang, instance):
+                    log.info("Reuse %s/%s on %s" % (lang, instance,
+                                                    step.node))
+                    continue
+                log.warning("Restart %s/%s on %s" % (lang, instance,
+                                                     step.node))
+                try:
+                    self._stop(step.node, (lang, instance))
+                except ClaraRequestError:
+                    pass
+                node.running.pop((lang, instance))
+            log.info("Request '%s'" % step.action)
+            self._client.request(step.node, step.msg)
+            state.track(step)
+
+    def _stop(self, role, key):
+        log.info("Stop %s/%s on %s" % (key[0], key[1], role))
+        self._client.request(role, 'clara:stop:%s:%s' % key)
+
+    def _healthy(self, role, lang, instance):
+        if instance != 'platform':
+            return True
+        try:
+            self._client.request(role, 'clara:request:%s:list-dpes' % lang)
+            return True
+        except ClaraRequestError as e:
+            log.warning("Health check failed on %s: %s" % (role, e))
+            return False
+
+    def _stop_all(self, state):
+        results = self._client.request_all('clara:stop:all:all')
+        for node, (status, text) in sorted(results.items()):
+            if status == 'SUCCESS':
+                state.node(node).reset()
+            else:
+                state.node(node).known = False
+                log.warning("Could not reset %s: %s %s" %
+                            (node, status, text))
+
+    def _run_test(self, test_name, plan, state=None):
+        test = ClaraTest(self._client, plan, state)
+        record = {'name': test_name, 'error': None}
+        start = time.time()
+        try:
+            test.run()
+        except ClaraRequestError as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            record['duration'] = time.time() - start
+            record['actions'] = test.timings
+            self.results.append(record)
+            self.convergence.extend(test.convergence)
+
+
+class ClaraNodePool():
+
+    def __init__(self, groups):
+        self._groups = groups
+        self._busy = [set() for _ in groups]
+        self.cond = threading.Condition()
+
+    def fits(self, roles):
+        return any(self._wanted(g, roles) <= set(g) for g in self._groups)
+
+    def acquire(self, roles):
+        for index, group in enumerate(self._groups):
+            wanted = self._wanted(group, roles)
+            if wanted <= set(group) and not wanted & self._busy[index]:
+                self._busy[index] |= wanted
+                return index, dict((r, group[r]) for r in wanted)
+        return None
+
+    def release(self, index, nodes):
+        with self.cond:
+            self._busy[index] -= set(nodes)
+            self.cond.notify_all()
+
+    def _wanted(self, group, roles):
+        return set(group) if roles is None else set(roles)
 
 
 class ClaraTestRunner():
 
     def __init__(self, nodes, tests):
-        self._nodes = nodes
+        self._groups = nodes if isinstance(nodes, list) else [nodes]
         self._tests = tests
         self._report = []
-        self._client = None
+        self._suites = []
+        self._states = {}
+        self._context = None
+        self._duration = 0.0
 
     def start_client(self):
-        ctx = zmq.Context()
-        self._client = ClaraDaemonClient(ctx, self._nodes)
+        self._context = zmq.Context()
 
     def stop_client(self):
-        pass
+        if self._context is not None:
+            self._context.destroy(linger=0)
+            self._context = None
 
     def run_all_tests(self):
-        self._report = []
-        for test_file in self._tests:
-            test_suite = ClaraTestSuite(self._client, test_file)
-            status = test_suite.run_tests()
-            self._report.append(status)
+        start = time.time()
+        suites = [ClaraTestSuite(None, f) for f in self._tests]
+        self._suites = suites
+        self._report = [None] * len(suites)
+
+        pool = ClaraNodePool(self._groups)
+        pending = []
+        for index, suite in enumerate(suites):
+            if not suite.error:
+                suite.error = self._check_nodes(pool, suite)
+            if suite.error:
+                log.error("%s: %s" % (suite.name, suite.error))
+                self._report[index] = (False, suite.name)
+            else:
+                pending.append(index)
+
+        workers = []
+        with pool.cond:
+            while pending:
+                for index in pending:
+                    alloc = pool.acquire(suites[index].roles)
+                    if alloc:
+                        break
+                else:
+                    pool.cond.wait()
+                    continue
+                pending.remove(index)
+                worker = threading.Thread(target=self._run_suite,
+                                          args=(pool, index, suites[index],
+                                                alloc))
+                worker.start()
+                workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+        self._stop_all()
+        self._duration = time.time() - start
         return self._report
 
-    def print_report(self):
-        pass
+    def _check_nodes(self, pool, suite):
+        if not pool.fits(suite.roles):
+            return 'No node group for roles: %s' % suite.roles
+        unknown = [n for n in suite.nodes() if not pool.fits([n])]
+        if unknown:
+            return 'Unknown nodes: %s' % ', '.join(unknown)
+        return None
+
+    def _run_suite(self, pool, index, suite, alloc):
+        group, nodes = alloc
+        client = ClaraDaemonClient(self._context, nodes)
+        state = ClusterState(dict(
+            (role, self._states.setdefault((group, role), NodeState()))
+            for role in nodes))
+        fe_host = nodes.get('platform')
+        try:
+            self._report[index] = suite.run_tests(client, state, fe_host)
+        except Exception as e:
+            log.error("%s: %s" % (suite.name, e))
+            suite.error = str(e)
+            self._report[index] = (False, suite.name)
+        finally:
+            client.close()
+            pool.release(group, nodes)
+
+    def _stop_all(self):
+        for index, group in enumerate(self._groups):
+            roles = [role for role in group
+                     if (index, role) in self._states]
+            if not roles:
+                continue
+            client = ClaraDaemonClient(self._context,
+                                       dict((r, group[r]) for r in roles))
+            try:
+                results = client.request_all('clara:stop:all:all')
+                for node, (status, text) in sorted(results.items()):
+                    if status != 'SUCCESS':
+                        log.warning("Could not stop %s: %s %s" %
+                                    (node, status, text))
+            finally:
+                client.close()
+        self._states = {}
+
+    def report(self):
+        suites = []
+        for suite, (passed, name) in zip(self._suites, self._report):
+            suites.append({
+                'name': name,
+                'passed': passed,
+                'duration': suite.duration,
+                'error': suite.error,
+                'tests': suite.results,
+            })
+        return build_report(suites, self._duration)
+
+    def print_report(self, report=None):
+        for line in format_report(report or self.report()):
+            print line
+
+
+def get_arguments(base):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=get_config_file(base))
+    parser.add_argument("--tests", default="tests")
+    parser.add_argument("--json-report")
+    parser.add_argument("--junit-report")
+    parser.add_argument("--compare")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--fail-on-slowdown", action="store_true")
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--bench-node", default="platform")
+    parser.add_argument("--bench-lang", default="java")
+    parser.add_argument("--bench-mix", default="list=8,cycle=2")
+    parser.add_argument("--bench-label")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30.0)
+
+    args = parser.parse_args()
+    try:
+        args.bench_mix = parse_mix(args.bench_mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+    return args
+
+
+def bench(group, args):
+    context = zmq.Context()
+    try:
+        result = run_bench(lambda: ClaraDaemonClient(context, group),
+                           args.bench_node, args.clients, args.duration,
+                           args.bench_mix, args.bench_lang)
+    finally:
+        context.destroy(linger=0)
+    result['label'] = args.bench_label
+    return result
 
 
 if __name__ == '__main__':
 
     base = get_base_dir()
-    nodes = get_config_section(get_config_file(base), 'nodes')
-    tests = get_all_files(base)
+    args = get_arguments(base)
+    nodes = get_config_section(args.config, 'nodes')
+    tests = get_all_files(base, args.tests)
 
     log.setLevel(logging.INFO)
 
+    if args.bench:
+        group = nodes[0] if isinstance(nodes, list) else nodes
+        if args.bench_node not in group:
+            log.error("Unknown bench node: %s" % args.bench_node)
+            sys.exit(1)
+        result = bench(group, args)
+        if args.compare:
+            result['slowdowns'] = compare_reports(result,
+                                                  read_report(args.compare),
+                                                  args.threshold)
+        print '\n'.join(format_bench(result))
+        if args.json_report:
+            write_json(result, args.json_report)
+        if result['errors']:
+            sys.exit(1)
+        if args.fail_on_slowdown and result.get('slowdowns'):
+            sys.exit(1)
+        sys.exit(0)
+
     tr = ClaraTestRunner(nodes, tests)
     tr.start_client()
-    tr.run_all_tests()
+    try:
+        tr.run_all_tests()
+    finally:
+        tr.stop_client()
+
+    report = tr.report()
+    if args.compare:
+        report['slowdowns'] = compare_reports(report,
+                                              read_report(args.compare),
+                                              args.threshold)
+    tr.print_report(report)
+    if args.json_report:
+        write_json(report, args.json_report)
+    if args.junit_report:
+        write_junit(report, args.junit_report)
+
+    if not report['passed']:
+        sys.exit(1)
+    if args.fail_on_slowdown and report.get('slowdowns'):
+        sys.exit(1)
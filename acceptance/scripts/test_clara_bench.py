@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+
+from clara_bench import BenchClient
+from clara_bench import bench_stats
+from clara_bench import format_bench
+from clara_bench import parse_mix
+from clara_bench import run_bench
+
+
+class FakeClient():
+
+    def __init__(self, fail=()):
+        self.messages = []
+        self.closed = False
+        self._fail = fail
+        self._lock = threading.Lock()
+
+    def request(self, node, msg):
+        with self._lock:
+            self.messages.append((node, msg))
+        if msg.split(':')[1] in self._fail:
+            raise Exception('Timeout: no reply from %s' % node)
+        return ['']
+
+    def close(self):
+        self.closed = True
+
+
+class TestClaraBench(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix('list=8,cycle=2'),
+                         [('list', 8), ('cycle', 2)])
+        self.assertEqual(parse_mix('list'), [('list', 1)])
+        self.assertEqual(parse_mix('list=3,cycle=0'), [('list', 3)])
+
+    def test_parse_mix_errors(self):
+        self.assertRaises(ValueError, parse_mix, 'deploy=1')
+        self.assertRaises(ValueError, parse_mix, 'list=x')
+        self.assertRaises(ValueError, parse_mix, 'list=0')
+        self.assertRaises(ValueError, parse_mix, '')
+
+    def test_client_cycles_own_instance(self):
+        client = FakeClient()
+        worker = BenchClient(client, 'dpe1', 'java', 3, [('cycle', 1)], 1)
+
+        worker.run(time.time() + 0.01)
+
+        self.assertEqual(client.messages[:2],
+                         [('dpe1', 'clara:start:java:dpe.bench3'),
+                          ('dpe1', 'clara:stop:java:dpe.bench3')])
+        self.assertEqual(len(client.messages), len(worker.samples))
+        self.assertTrue(all(ok for _, _, ok in worker.samples))
+
+    def test_client_stops_instance_left_running(self):
+        client = FakeClient(fail=('stop',))
+        worker = BenchClient(client, 'dpe1', 'java', 0, [('cycle', 1)], 1)
+
+        worker.run(time.time() + 0.01)
+
+        self.assertEqual(client.messages[-1],
+                         ('dpe1', 'clara:stop:java:dpe.bench0'))
+        self.assertEqual(len(client.messages), len(worker.samples) + 1)
+
+    def test_bench_stats(self):
+        samples = [('list', 0.1, True), ('list', 0.3, False),
+                   ('start', 1.0, True)]
+
+        stats = bench_stats(samples, 2.0)
+
+        self.assertEqual(stats['list']['count'], 2)
+        self.assertEqual(stats['list']['errors'], 1)
+        self.assertEqual(stats['list']['throughput'], 1.0)
+        self.assertEqual(stats['list']['p50'], 0.1)
+        self.assertEqual(stats['list']['p99'], 0.3)
+        self.assertEqual(stats['start']['max'], 1.0)
+
+    def test_run_bench(self):
+        clients = []
+
+        def make_client():
+            clients.append(FakeClient(fail=('stop',)))
+            return clients[-1]
+
+        result = run_bench(make_client, 'platform', clients=3, duration=0.05,
+                           mix=[('list', 1), ('cycle', 1)], seed=7)
+
+        self.assertEqual(len(clients), 3)
+        self.assertTrue(all(c.closed for c in clients))
+        self.assertEqual(result['clients'], 3)
+        self.assertEqual(result['mix'], {'list': 1, 'cycle': 1})
+        self.assertEqual(result['requests'],
+                         sum(s['count'] for s in result['actions'].values()))
+        self.assertEqual(result['errors'], result['actions']['stop']['errors'])
+        self.assertTrue(result['throughput'] > 0)
+        for index, client in enumerate(clients):
+            instances = set(m.split(':')[3] for _, m in client.messages
+                            if not m.startswith('clara:request'))
+            self.assertLessEqual(instances, set(['dpe.bench%d' % index]))
+
+    def test_format_bench(self):
+        result = {
+            'clients': 2, 'node': 'platform', 'elapsed': 10.0,
+            'requests': 30, 'errors': 1, 'throughput': 3.0,
+            'actions': bench_stats([('list', 0.1, True)], 10.0),
+            'slowdowns': [{'type': 'list', 'stat': 'p95',
+                           'previous': 0.05, 'current': 0.1}],
+        }
+
+        lines = format_bench(result)
+
+        self.assertEqual(lines[0], '2 clients on platform for 10.0 s: '
+                                   '30 requests, 1 errors, 3.0 req/s')
+        self.assertTrue(lines[3].startswith('list'))
+        self.assertEqual(lines[-1], 'SLOWER  list p95: 0.0500 s -> 0.1000 s')
+
+
+if __name__ == '__main__':
+    unittest.main()
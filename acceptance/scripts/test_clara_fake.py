@@ -0,0 +1,91 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from clara_fake import dpe_name
+from clara_fake import get_arguments
+from clara_fake import host_ip
+from clara_fake import log_line
+from clara_fake import register
+from clara_fake import registered_dpes
+from clara_fake import run_request
+from clara_fake import unregister
+
+
+class TestClaraFake(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.registry)
+
+    def test_accepts_java_dpe_flags(self):
+        args = get_arguments(['-fe_host', '10.11.1.100', '-port', '7781',
+                              '-poolsize', '4', 'dpe'])
+
+        self.assertEqual(args.role, 'dpe')
+        self.assertEqual(args.port, 7781)
+
+    def test_dpe_name(self):
+        self.assertEqual(dpe_name(7771), '%s_admin' % host_ip())
+        self.assertEqual(dpe_name(7781), '%s%%7781_admin' % host_ip())
+        self.assertEqual(dpe_name(7771, '127.0.0.2'), '127.0.0.2_admin')
+        self.assertEqual(dpe_name(7781, '127.0.0.2'), '127.0.0.2%7781_admin')
+
+    def test_list_registered_dpes(self):
+        register(self.registry, 'b_admin')
+        register(self.registry, 'a_admin')
+        with open(os.path.join(self.registry, 'c_admin'), 'w') as f:
+            f.write('999999999')
+        args = get_arguments(['--registry', self.registry, 'orchestrator'])
+
+        self.assertEqual(run_request(args, 'list-dpes'),
+                         (['a_admin', 'b_admin'], 0))
+
+        unregister(self.registry, 'a_admin')
+        self.assertEqual(registered_dpes(self.registry), ['b_admin'])
+
+    def test_dpe_that_cannot_bind_keeps_the_registry(self):
+        other = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        other.bind(('127.0.0.1', 0))
+        other.listen(1)
+        self.addCleanup(other.close)
+        port = other.getsockname()[1]
+        name = dpe_name(port, '127.0.0.1')
+        register(self.registry, name)
+
+        script = os.path.join(os.path.dirname(__file__), 'clara_fake.py')
+        with open(os.devnull, 'w') as devnull:
+            code = subprocess.call([sys.executable, script,
+                                    '--registry', self.registry,
+                                    '--host', '127.0.0.1',
+                                    '--startup-delay', '0',
+                                    '--shutdown-delay', '0',
+                                    '-port', str(port), 'dpe'],
+                                   stdout=devnull, stderr=devnull)
+
+        self.assertNotEqual(code, 0)
+        self.assertEqual(registered_dpes(self.registry), [name])
+
+    def test_list_fixed_dpes(self):
+        args = get_arguments(['--dpes', 'x_admin,y_admin', 'orchestrator'])
+
+        self.assertEqual(run_request(args, 'list-dpes'),
+                         (['x_admin', 'y_admin'], 0))
+
+    def test_unsupported_request(self):
+        args = get_arguments(['orchestrator'])
+
+        self.assertEqual(run_request(args, 'deploy'),
+                         (['Unsupported request: deploy'], 1))
+
+    def test_log_line_size(self):
+        self.assertEqual(len(log_line(12, 100)), 101)
+        self.assertTrue(log_line(12, 10).startswith('INFO: fake DPE'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,669 @@
+import itertools
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from clara_install import BuildCache
+from clara_install import Project
+from clara_install import ProjectManager
+from clara_install import StagedInstall
+from clara_install import build_key
+from clara_install import check_dependencies
+from clara_install import parse_ccache_stats
+from clara_install import parse_gradle_stats
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def names(projects):
+    return [p.name for p in projects]
+
+
+def project_data(name, build, depends_on=None):
+    return {'name': name, 'url': 'git@example.org:clara/%s.git' % name,
+            'build': build, 'clean': [], 'depends_on': depends_on or []}
+
+
+class TestDependencies(unittest.TestCase):
+
+    def projects(self, *deps):
+        return [Project('/src', project_data(name, [], depends_on))
+                for name, depends_on in deps]
+
+    def test_dependencies_order(self):
+        projects = self.projects(('cpp', ['xmsg-cpp']),
+                                 ('java', []),
+                                 ('xmsg-cpp', []),
+                                 ('webapp', ['java', 'cpp']))
+
+        order = names(check_dependencies(projects))
+
+        self.assertEqual(order, ['java', 'xmsg-cpp', 'cpp', 'webapp'])
+
+    def test_dependencies_raise_on_cycle(self):
+        projects = self.projects(('java', []),
+                                 ('a', ['c']),
+                                 ('b', ['a']),
+                                 ('c', ['b']))
+
+        with self.assertRaisesRegexp(RuntimeError, 'cycle between a, b, c'):
+            check_dependencies(projects)
+
+    def test_dependencies_raise_on_unknown(self):
+        projects = self.projects(('java', []), ('cpp', ['xmsg-cpp']))
+
+        with self.assertRaisesRegexp(RuntimeError,
+                                     "Unknown dependency of 'cpp'"):
+            check_dependencies(projects)
+
+
+class TestBuildKey(unittest.TestCase):
+
+    def test_key_changes_with_inputs(self):
+        state = {'head': 'abc', 'changes': 'def'}
+        key = build_key(state, ['make'], [])
+
+        self.assertEqual(key, build_key(dict(state), ['make'], []))
+        self.assertNotEqual(key, build_key({'head': 'abd', 'changes': 'def'},
+                                           ['make'], []))
+        self.assertNotEqual(key, build_key(state, ['make install'], []))
+        self.assertNotEqual(key, build_key(state, ['make'], ['123']))
+
+    def test_key_unknown_without_state(self):
+        self.assertIsNone(build_key(None, ['make'], []))
+        self.assertIsNone(build_key({'head': 'abc'}, ['make'], [None]))
+
+
+class TestProjectManager(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        for p in ('print_c', 'sys.stdout'):
+            patcher = mock.patch('clara_install.%s' % p)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        state = mock.patch.object(Project, 'source_state',
+                                  return_value={'head': 'abc'})
+        state.start()
+        self.addCleanup(state.stop)
+
+    def manager(self, *projects, **kwargs):
+        kwargs.setdefault('install_dir', os.path.join(self.src, 'home'))
+        pm = ProjectManager(self.src, **kwargs)
+        pm.projects = [Project(self.src, project_data(*p)) for p in projects]
+        for p in pm.projects:
+            os.mkdir(p.path)
+        return pm
+
+    def built(self):
+        path = os.path.join(self.src, 'order')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            order = f.read().split()
+        os.remove(path)
+        return order
+
+    def build(self, pm, clean=False, force=None):
+        built = pm.build_projects(clean, pm.plan_builds(clean, force))
+        self.assertEqual(sorted(built), sorted(self.built()))
+        return sorted(built)
+
+    def log(self, name):
+        return ['echo %s >> ../order' % name]
+
+    def test_build_follows_dependencies(self):
+        pm = self.manager(('cpp', ['echo cpp >> ../order'], ['xmsg']),
+                          ('xmsg', ['sleep 0.2; echo xmsg >> ../order']),
+                          ('java', ['echo java >> ../order']),
+                          build_jobs=4)
+
+        pm.build_projects(False, pm.plan_builds(False))
+
+        order = self.built()
+        self.assertEqual(sorted(order), ['cpp', 'java', 'xmsg'])
+        self.assertLess(order.index('xmsg'), order.index('cpp'))
+
+    def test_build_skips_up_to_date_projects(self):
+        pm = self.manager(('java', self.log('java')),
+                          ('cpp', self.log('cpp'), ['java']))
+
+        self.assertEqual(self.build(pm), ['cpp', 'java'])
+        self.assertEqual(pm.plan_builds(False), {})
+        self.assertEqual(self.build(pm), [])
+
+    def test_build_rebuilds_dependents_of_changed_projects(self):
+        pm = self.manager(('java', self.log('java')),
+                          ('cpp', self.log('cpp'), ['java']),
+                          ('python', self.log('python')))
+        self.build(pm)
+
+        pm.projects[0].build_cmds.append('true')
+
+        self.assertEqual(self.build(pm), ['cpp', 'java'])
+
+    def test_build_forces_projects(self):
+        pm = self.manager(('java', self.log('java')),
+                          ('cpp', self.log('cpp')))
+        self.build(pm)
+
+        self.assertEqual(self.build(pm, force=['cpp']), ['cpp'])
+        self.assertEqual(self.build(pm, force=[]), ['cpp', 'java'])
+        self.assertEqual(self.build(pm, clean=True), ['cpp', 'java'])
+
+    def test_build_into_install_dir(self):
+        pm = self.manager(('java', ['echo $CLARA_HOME > ../clara_home']))
+
+        self.assertEqual(pm.build_projects(False, pm.plan_builds(False)),
+                         ['java'])
+
+        with open(os.path.join(self.src, 'clara_home')) as f:
+            self.assertEqual(f.read().strip(), pm.install_dir)
+        self.assertTrue(os.path.isfile(os.path.join(pm.install_dir,
+                                                    '.clara-build',
+                                                    'java.json')))
+
+    def test_build_without_install_never_skips(self):
+        pm = self.manager(('java', self.log('java')), install_dir=None)
+        self.build(pm)
+
+        self.assertEqual(self.build(pm), ['java'])
+
+    def test_build_raises_on_missing_project(self):
+        pm = self.manager(('java', ['true']))
+        pm.projects.append(Project(self.src, project_data('cpp', ['true'])))
+
+        with self.assertRaisesRegexp(RuntimeError, "'cpp' is not on disk"):
+            pm.plan_builds(False)
+
+    def test_build_writes_logs(self):
+        pm = self.manager(('java', ['echo building java']))
+
+        pm.build_projects(False, pm.plan_builds(False))
+
+        with open(os.path.join(self.src, '.build-logs', 'java.log')) as f:
+            self.assertEqual(f.read(),
+                             '$ echo building java\nbuilding java\n')
+
+    def test_build_failure_cancels_others(self):
+        pm = self.manager(('java', ['sleep 0.1; exit 1']),
+                          ('cpp', ['sleep 10', 'touch ../cpp-done']),
+                          ('webapp', ['touch ../webapp-done'], ['java']),
+                          build_jobs=4)
+
+        start = time.time()
+        with self.assertRaisesRegexp(RuntimeError, 'Could no build java$'):
+            self.build(pm)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(pm.projects[1].cancelled)
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'cpp-done')))
+        self.assertFalse(os.path.exists(os.path.join(self.src,
+                                                     'webapp-done')))
+
+    def test_build_failure_removes_manifest(self):
+        pm = self.manager(('java', self.log('java')))
+        self.build(pm)
+        pm.projects[0].build_cmds = ['false']
+
+        self.assertRaises(RuntimeError, self.build, pm)
+
+        pm.projects[0].build_cmds = self.log('java')
+        self.assertEqual(self.build(pm), ['java'])
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        self.cache = os.path.join(self.src, '.git-cache')
+        self.git = ['git', '-c', 'credential.helper=cache']
+        self.patch('clara_install.print_c')
+        self.patch('clara_install.sys.stdout')
+        self.version = self.patch('clara_install.subprocess.check_output')
+        self.version.return_value = 'git version 2.20.1\n'
+        self.call = self.patch('clara_install.subprocess.call')
+        self.call.return_value = 0
+        self.clone = self.patch('clara_install.subprocess.check_call')
+        self.clone.return_value = 0
+
+    def patch(self, target):
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def manager(self, *projects, **kwargs):
+        pm = ProjectManager(self.src, **kwargs)
+        pm.projects = [Project(self.src, p) for p in projects]
+        return pm
+
+    def project(self, name, url=None, **data):
+        data.update(project_data(name, []))
+        if url is not None:
+            data['url'] = url
+        return data
+
+    def cloned(self):
+        return [c[0][0][-1] for c in self.clone.call_args_list]
+
+    def test_clone_command(self):
+        pm = self.manager(self.project('a', depth=1, filter='blob:none'))
+
+        pm.download_projects()
+
+        self.clone.assert_called_once_with(self.git + [
+            'clone', '--depth', '1', '--filter', 'blob:none',
+            'git@example.org:clara/a.git', os.path.join(self.src, 'a')])
+        self.assertFalse(self.call.called)
+
+    def test_clone_without_filter_on_old_git(self):
+        self.version.return_value = 'git version 2.17.1\n'
+        pm = self.manager(self.project('a', filter='blob:none'))
+
+        pm.download_projects()
+
+        self.assertNotIn('--filter', self.clone.call_args[0][0])
+
+    def test_clone_from_cache(self):
+        pm = self.manager(self.project('a'), cache_dir=self.cache)
+        mirror = os.path.join(self.cache, 'a.git')
+        url = 'git@example.org:clara/a.git'
+
+        pm.download_projects()
+
+        self.call.assert_called_once_with(self.git + [
+            'clone', '--mirror', url, mirror])
+        self.clone.assert_called_once_with(self.git + [
+            'clone', '--reference-if-able', mirror, '--dissociate',
+            url, os.path.join(self.src, 'a')])
+
+    def test_fetch_into_existing_cache(self):
+        pm = self.manager(self.project('a'), cache_dir=self.cache)
+        mirror = os.path.join(self.cache, 'a.git')
+        os.makedirs(mirror)
+
+        pm.download_projects()
+
+        self.call.assert_called_once_with(self.git + [
+            '--git-dir', mirror, 'fetch', '--prune'])
+
+    def test_reference_existing_cache_on_old_git(self):
+        self.version.return_value = 'git version 2.7.4\n'
+        pm = self.manager(self.project('a'), self.project('b'),
+                          cache_dir=self.cache)
+        mirror = os.path.join(self.cache, 'a.git')
+        os.makedirs(mirror)
+        self.call.side_effect = [0, 1]
+
+        pm.download_projects()
+
+        args = [c[0][0] for c in self.clone.call_args_list]
+        self.assertEqual(args[0][4:7], ['--reference', mirror,
+                                        '--dissociate'])
+        self.assertNotIn('--reference', args[1])
+
+    def test_skip_cache_without_dissociate(self):
+        self.version.return_value = 'git version 1.9.1\n'
+        pm = self.manager(self.project('a'), cache_dir=self.cache)
+
+        pm.download_projects()
+
+        self.assertFalse(self.call.called)
+        self.clone.assert_called_once_with(self.git + [
+            'clone', 'git@example.org:clara/a.git',
+            os.path.join(self.src, 'a')])
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_skip_cache_for_shallow_projects(self):
+        pm = self.manager(self.project('a', depth=1), cache_dir=self.cache)
+
+        pm.download_projects()
+
+        self.assertFalse(self.call.called)
+        self.assertNotIn('--reference-if-able', self.clone.call_args[0][0])
+
+    def test_download_first_project_of_each_server_alone(self):
+        pm = self.manager(self.project('a', 'https://u@one.org/a.git'),
+                          self.project('b', 'https://u@one.org/b.git'),
+                          self.project('c'),
+                          self.project('d', 'https://u@two.org/d.git'),
+                          jobs=1)
+
+        pm.download_projects()
+
+        self.assertEqual(self.cloned(), [os.path.join(self.src, n)
+                                         for n in 'adbc'])
+
+    def test_skip_projects_on_disk(self):
+        pm = self.manager(self.project('a'), self.project('b'))
+        os.mkdir(os.path.join(self.src, 'a'))
+
+        pm.download_projects()
+
+        self.assertEqual(self.cloned(), [os.path.join(self.src, 'b')])
+
+    def test_report_all_failed_downloads(self):
+        def clone(cmd):
+            if cmd[-1][-1] in 'ab':
+                raise subprocess.CalledProcessError(128, cmd)
+            return 0
+
+        self.clone.side_effect = clone
+        pm = self.manager(self.project('a'), self.project('b'),
+                          self.project('c', 'https://u@one.org/c.git'))
+
+        with self.assertRaises(RuntimeError) as cm:
+            pm.download_projects()
+
+        self.assertEqual(str(cm.exception), 'Could no download a, b')
+        self.assertEqual(len(self.cloned()), 3)
+
+
+class TestStagedInstall(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.home = os.path.join(self.tmp, 'services')
+        patcher = mock.patch('clara_install.print_c')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('clara_install.subprocess.Popen')
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        clock = itertools.count()
+        patcher = mock.patch('clara_install.time.strftime',
+                             side_effect=lambda f: '20260101-%06d' %
+                             next(clock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def install(self, files, keep=2, clean=False):
+        install = StagedInstall(self.home, keep)
+        stage = install.begin(clean)
+        for name, content in files.items():
+            write(os.path.join(stage, name), content)
+        install.commit()
+        return install
+
+    def read(self, name):
+        with open(os.path.join(self.home, name)) as f:
+            return f.read()
+
+    def test_migrate_existing_home(self):
+        write(os.path.join(self.home, 'lib', 'clara.jar'), 'v1')
+        write(os.path.join(self.home, 'log', 'dpe.log'), 'old log')
+
+        install = self.install({'lib/clara.jar': 'v2'})
+
+        self.assertTrue(os.path.islink(self.home))
+        self.assertEqual(len(install.installs()), 2)
+        self.assertEqual(self.read('lib/clara.jar'), 'v2')
+        self.assertEqual(os.listdir(os.path.join(self.home, 'log')), [])
+        first = os.path.join(install.root, install.installs()[0])
+        with open(os.path.join(first, 'lib', 'clara.jar')) as f:
+            self.assertEqual(f.read(), 'v1')
+        self.assertTrue(os.path.isfile(os.path.join(first, 'log', 'dpe.log')))
+
+    def test_begin_copies_current_install(self):
+        self.install({'lib/clara.jar': 'v1', 'plugins/grapes.jar': 'g1'})
+        self.install({'lib/clara.jar': 'v2'})
+
+        self.assertEqual(self.read('lib/clara.jar'), 'v2')
+        self.assertEqual(self.read('plugins/grapes.jar'), 'g1')
+
+    def test_begin_clean_starts_empty(self):
+        self.install({'lib/clara.jar': 'v1', 'plugins/grapes.jar': 'g1'})
+        self.install({'lib/clara.jar': 'v2'}, clean=True)
+
+        self.assertEqual(sorted(os.listdir(self.home)),
+                         ['.clara-installed', 'lib', 'log'])
+
+    def test_abort_keeps_current_install(self):
+        install = self.install({'lib/clara.jar': 'v1'})
+        current = install.current()
+
+        stage = install.begin(False)
+        write(os.path.join(stage, 'lib', 'clara.jar'), 'broken')
+        install.abort()
+
+        self.assertEqual(install.current(), current)
+        self.assertEqual(self.read('lib/clara.jar'), 'v1')
+        self.assertFalse(os.path.exists(stage))
+        self.assertEqual(install.installs(), [current])
+
+    def test_rollback_to_previous_install(self):
+        for v in ('v1', 'v2', 'v3'):
+            install = self.install({'lib/clara.jar': v}, keep=3)
+
+        install.rollback()
+        self.assertEqual(self.read('lib/clara.jar'), 'v2')
+        install.rollback()
+        self.assertEqual(self.read('lib/clara.jar'), 'v1')
+        with self.assertRaisesRegexp(RuntimeError, 'No previous install'):
+            install.rollback()
+
+    def test_rollback_without_installs(self):
+        with self.assertRaisesRegexp(RuntimeError, 'No previous install'):
+            StagedInstall(self.home).rollback()
+
+    def test_prune_old_installs(self):
+        for v in ('v1', 'v2', 'v3', 'v4'):
+            install = self.install({'lib/clara.jar': v}, keep=1)
+
+        installs = install.installs()
+        self.assertEqual(len(installs), 2)
+        self.assertEqual(installs[-1], install.current())
+        old = sorted(d for d in os.listdir(install.root)
+                     if d.endswith('.old'))
+        self.assertEqual(len(old), 2)
+        args = self.popen.call_args[0][0]
+        self.assertEqual(args[:2], ['rm', '-rf'])
+        self.assertEqual(sorted(args[2:]),
+                         [os.path.join(install.root, d) for d in old])
+
+    def test_stage_installs_in_the_same_second(self):
+        with mock.patch('clara_install.time.strftime',
+                        return_value='20260101-000000'):
+            for v in ('v1', 'v2', 'v3'):
+                install = self.install({'lib/clara.jar': v}, keep=3)
+
+        self.assertEqual(install.installs(), ['20260101-000000',
+                                              '20260101-000000-1',
+                                              '20260101-000000-2'])
+        self.assertEqual(self.read('lib/clara.jar'), 'v3')
+
+    def test_manage_linked_directory(self):
+        shared = os.path.join(self.tmp, 'vagrant', 'services')
+        write(os.path.join(shared, 'lib', 'clara.jar'), 'v1')
+        os.symlink(shared, self.home)
+
+        install = self.install({'lib/clara.jar': 'v2'})
+
+        self.assertEqual(install.home, shared)
+        self.assertEqual(os.readlink(self.home), shared)
+        self.assertTrue(os.path.islink(shared))
+        self.assertEqual(self.read('lib/clara.jar'), 'v2')
+        self.assertEqual(len(install.installs()), 2)
+
+    def test_manage_home_with_install_link(self):
+        install = self.install({'lib/clara.jar': 'v1'})
+
+        self.assertEqual(StagedInstall(self.home).home, self.home)
+        self.assertEqual(install.root,
+                         os.path.join(self.tmp, '.services-installs'))
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.project = Project(self.tmp, project_data('java', []))
+        patcher = mock.patch('clara_install.find_executable')
+        self.find = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tools = {'ccache': '/usr/bin/ccache'}
+        self.find.side_effect = self.tools.get
+        patcher = mock.patch('clara_install.subprocess.check_output')
+        self.output = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.output.return_value = 'Gradle 4.10.2\n'
+
+    def cache(self):
+        return BuildCache(os.path.join(self.tmp, 'cache'))
+
+    def test_init_script_points_inside_cache(self):
+        cache = self.cache()
+
+        with open(cache.init_script) as f:
+            script = f.read()
+        self.assertIn(os.path.join(self.tmp, 'cache', 'gradle',
+                                   'build-cache'), script)
+
+    def test_env_uses_ccache_dir_per_project(self):
+        env = self.cache().env(self.project, {})
+
+        self.assertEqual(env['CCACHE_DIR'],
+                         os.path.join(self.tmp, 'cache', 'ccache', 'java'))
+        self.assertEqual(env['CCACHE_BASEDIR'], self.project.path)
+
+    def test_env_without_cmake_project(self):
+        env = self.cache().env(self.project, {})
+
+        self.assertNotIn('CC', env)
+        self.assertFalse(self.output.called)
+
+    def test_env_old_cmake_uses_ccache_as_compiler(self):
+        self.output.return_value = 'cmake version 2.8.12.2\n'
+        self.project.build_cmds = ['cmake ..', 'make']
+
+        env = self.cache().env(self.project, {'CXX': 'clang++'})
+
+        self.assertEqual(env['CC'], 'ccache gcc')
+        self.assertEqual(env['CXX'], 'ccache clang++')
+        self.assertEqual(self.output.call_args[0][0], ['cmake', '--version'])
+
+    def test_env_new_cmake_keeps_compiler(self):
+        self.output.return_value = 'cmake version 3.10.2\n'
+        self.project.build_cmds = ['cmake ..', 'make']
+
+        self.assertNotIn('CC', self.cache().env(self.project, {}))
+
+    def test_command_cmake_uses_ccache(self):
+        self.output.return_value = 'cmake version 3.10.2\n'
+
+        cmd = self.cache().command(self.project, 'cmake ..')
+
+        self.assertEqual(cmd, 'cmake .. -DCMAKE_C_COMPILER_LAUNCHER=ccache'
+                              ' -DCMAKE_CXX_COMPILER_LAUNCHER=ccache')
+
+    def test_command_old_cmake_has_no_launchers(self):
+        self.output.return_value = 'cmake version 2.8.12.2\n'
+        cache = self.cache()
+
+        self.assertEqual(cache.command(self.project, 'cmake ..'), 'cmake ..')
+        cache.command(self.project, 'cmake ../other')
+        self.assertEqual(self.output.call_count, 1)
+
+    def test_command_cmake_without_ccache(self):
+        del self.tools['ccache']
+
+        self.assertEqual(self.cache().command(self.project, 'cmake ..'),
+                         'cmake ..')
+
+    def test_command_gradle_uses_build_cache(self):
+        cache = self.cache()
+
+        cmd = cache.command(self.project, './gradlew install')
+
+        self.assertEqual(cmd, './gradlew install --daemon --build-cache '
+                              '--init-script %s' % cache.init_script)
+        self.assertEqual(self.output.call_args[0][0],
+                         ['./gradlew', '--version'])
+
+    def test_command_old_gradle_only_uses_daemon(self):
+        self.output.return_value = 'Gradle 2.3\n'
+        cache = self.cache()
+
+        self.assertEqual(cache.command(self.project, 'gradle install'),
+                         'gradle install --daemon')
+        cache.command(self.project, 'gradle test')
+        self.assertEqual(self.output.call_count, 1)
+
+    def test_command_gradle_without_version(self):
+        self.output.side_effect = OSError
+
+        self.assertEqual(self.cache().command(self.project, 'gradle build'),
+                         'gradle build --daemon')
+
+    def test_command_maven_uses_shared_repository(self):
+        repo = os.path.join(self.tmp, 'cache', 'maven')
+
+        self.assertEqual(self.cache().command(self.project, 'mvn install'),
+                         'mvn install -Dmaven.repo.local=%s' % repo)
+        self.tools['mvnd'] = '/usr/bin/mvnd'
+        self.assertEqual(self.cache().command(self.project, 'mvn install'),
+                         'mvnd install -Dmaven.repo.local=%s' % repo)
+
+    def test_command_keeps_other_commands(self):
+        self.assertEqual(self.cache().command(self.project, 'make install'),
+                         'make install')
+
+    def test_report_counts_hits_and_tasks(self):
+        log = os.path.join(self.tmp, 'java.log')
+        write(log, '3 actionable tasks: 1 executed, 2 up-to-date\n')
+        self.output.return_value = 'cache_miss\t4\ndirect_cache_hit\t9\n'
+
+        report = self.cache().report(self.project, (5, 1), log)
+
+        self.assertEqual(report, 'ccache 4 hits, 3 misses; '
+                                 'gradle 1 executed, 2 up-to-date')
+
+
+class TestBuildStats(unittest.TestCase):
+
+    def test_parse_ccache_stats(self):
+        old = ('cache directory                     /home/vagrant/.ccache\n'
+               'cache hit (direct)                    12\n'
+               'cache hit (preprocessed)               3\n'
+               'cache miss                             5\n'
+               'files in cache                       102\n')
+        new = ('direct_cache_hit\t7\n'
+               'preprocessed_cache_hit\t1\n'
+               'cache_miss\t2\n'
+               'files_in_cache\t40\n')
+
+        self.assertEqual(parse_ccache_stats(old), (15, 5))
+        self.assertEqual(parse_ccache_stats(new), (8, 2))
+        self.assertEqual(parse_ccache_stats(''), (0, 0))
+
+    def test_parse_gradle_summary(self):
+        text = ('BUILD SUCCESSFUL in 4s\n'
+                '12 actionable tasks: 3 executed, 2 from cache, '
+                '7 up-to-date\n'
+                '1 actionable task: 1 executed\n')
+
+        self.assertEqual(parse_gradle_stats(text),
+                         {'executed': 4, 'from cache': 2, 'up-to-date': 7})
+
+    def test_parse_gradle_tasks(self):
+        text = (':compileJava UP-TO-DATE\n'
+                ':processResources\n'
+                '> Task :jar FROM-CACHE\n'
+                ':test SKIPPED\n'
+                'BUILD SUCCESSFUL\n')
+
+        self.assertEqual(parse_gradle_stats(text),
+                         {'executed': 1, 'from cache': 1, 'up-to-date': 1})
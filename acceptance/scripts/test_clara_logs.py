@@ -0,0 +1,125 @@
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from clara_logs import LogCapture
+from clara_logs import RotatingLog
+
+
+class TestRotatingLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'dpe.log')
+
+    def _read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path) as f:
+            return f.read()
+
+    def test_write_without_limit(self):
+        log = RotatingLog(self.path)
+        for _ in range(100):
+            log.write('0123456789\n')
+        log.close()
+
+        self.assertEqual(os.listdir(self.tmp), ['dpe.log'])
+        self.assertEqual(os.path.getsize(self.path), 1100)
+
+    def test_rotate_when_full(self):
+        log = RotatingLog(self.path, max_bytes=10, backups=2)
+        for line in ['aaaa\n', 'bbbb\n', 'cccc\n', 'dddd\n', 'eeee\n']:
+            log.write(line)
+        log.close()
+
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['dpe.log', 'dpe.log.1', 'dpe.log.2'])
+        self.assertEqual(self._read(self.path), 'eeee\n')
+        self.assertEqual(self._read(self.path + '.1'), 'cccc\ndddd\n')
+        self.assertEqual(self._read(self.path + '.2'), 'aaaa\nbbbb\n')
+
+    def test_rotate_compressed(self):
+        log = RotatingLog(self.path, max_bytes=10, backups=1, compress=True)
+        for line in ['aaaa\n', 'bbbb\n', 'cccc\n', 'dddd\n', 'eeee\n']:
+            log.write(line)
+        log.close()
+
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['dpe.log', 'dpe.log.1.gz'])
+        self.assertEqual(self._read(self.path + '.1.gz'), 'cccc\ndddd\n')
+
+    def test_rotate_without_backups(self):
+        log = RotatingLog(self.path, max_bytes=10, backups=0)
+        for line in ['aaaa\n', 'bbbb\n', 'cccc\n']:
+            log.write(line)
+        log.close()
+
+        self.assertEqual(os.listdir(self.tmp), ['dpe.log'])
+        self.assertEqual(self._read(self.path), 'cccc\n')
+
+    def test_ignore_writes_after_close(self):
+        log = RotatingLog(self.path)
+        log.close()
+
+        log.write('late\n')
+
+        self.assertEqual(self._read(self.path), '')
+
+
+class TestLogCapture(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.out = os.path.join(tmp, 'dpe.log')
+        self.err = os.path.join(tmp, 'dpe.err')
+
+    def test_keep_last_lines_in_memory(self):
+        capture = LogCapture(self.out, self.err, tail=3)
+        for i in range(5):
+            capture.append('out', 'line %d' % i)
+
+        self.assertEqual(capture.tail(10), ['line 2', 'line 3', 'line 4'])
+        self.assertEqual(capture.tail(1), ['line 4'])
+        self.assertEqual(capture.tail(0), [])
+
+    def test_lines_since_sequence(self):
+        capture = LogCapture(self.out, self.err)
+        capture.append('out', 'one')
+        capture.append('err', 'two')
+        capture.append('out', 'three')
+
+        self.assertEqual(capture.since(0), [(1, 'one'), (3, 'three')])
+        self.assertEqual(capture.since(1, 'err'), [(2, 'two')])
+        self.assertEqual(capture.since(3), [])
+
+    def test_grep(self):
+        capture = LogCapture(self.out, self.err)
+        for line in ['INFO start', 'ERROR boom', 'INFO done', 'ERROR bang']:
+            capture.append('out', line)
+
+        self.assertEqual(capture.grep('^ERROR'),
+                         ['2:ERROR boom', '4:ERROR bang'])
+
+    def test_capture_process_output(self):
+        capture = LogCapture(self.out, self.err, tail=10)
+        proc = subprocess.Popen(['sh', '-c', 'echo out1; echo err1 >&2'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        capture.attach(proc.stdout, proc.stderr)
+        proc.wait()
+        capture.close()
+
+        self.assertEqual(sorted(capture.tail(10)), ['err1', 'out1'])
+        with open(self.out) as f:
+            self.assertEqual(f.read(), 'out1\n')
+        with open(self.err) as f:
+            self.assertEqual(f.read(), 'err1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
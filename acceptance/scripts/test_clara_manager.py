@@ -1,16 +1,39 @@
+import itertools
+import json
 import unittest
 import mock
 import os
+import psutil
+import shutil
+import signal
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
 import zmq
 
+from clara_manager import AliveProbe
 from clara_manager import ClaraManager
 from clara_manager import ClaraManagerError
 from clara_manager import ClaraProcessConfig
+from clara_manager import EventPublisher
+from clara_manager import LogProbe
+from clara_manager import QueryChannel
+from clara_manager import StandbyPool
+from clara_manager import PortProbe
+from clara_manager import TreeProbe
+from clara_manager import fake_launcher
+from clara_manager import fake_profile
+from clara_manager import parse_cpulist
+from clara_manager import parse_request
+from clara_manager import readiness_probe
+from clara_manager import standby_command
+from clara_manager import standby_launcher
 from clara_manager import stop_process
+from clara_manager import stop_processes
 from clara_manager import stop_all
 from clara_manager import host_ip
-from clara_manager import __name__ as cm
 
 from test_clara_testing import patch_on_setup
 
@@ -51,10 +74,86 @@ class TestClaraProcessConfig(unittest.TestCase):
             env = {'CLARA_HOME': '/clara/services'}
             self._assert_clara_config('java', 'dpe', cmd, wd, env)
 
+    def test_clara_config_with_arguments(self):
+        conf = dict(clara)
+        conf['java'] = dict(clara['java'], args={
+            'fe_host': '-fe_host',
+            'pool_size': '-poolsize',
+            'jvm_opts': '$JAVA_OPTS',
+        }, defaults={'dpe': {'fe_host': '10.1.1.1'}})
+
+        dpe = ClaraProcessConfig(conf, 'java', 'dpe', {'pool_size': 4,
+                                                       'jvm_opts': '-Xmx1g'})
+        self.assertEqual(dpe.cmd, ['./bin/clara-dpe', '-p', 'platform',
+                                   '-fe_host', '10.1.1.1', '-poolsize', '4'])
+        self.assertEqual(dpe.env['JAVA_OPTS'], '-Xmx1g')
+
+        dpe = ClaraProcessConfig(conf, 'java', 'dpe', {'fe_host': '10.2.2.2'})
+        self.assertEqual(dpe.cmd, ['./bin/clara-dpe', '-p', 'platform',
+                                   '-fe_host', '10.2.2.2'])
+
+        platform = ClaraProcessConfig(conf, 'java', 'platform')
+        self.assertEqual(platform.cmd, ['./bin/clara-platform'])
+
+    def test_clara_config_raises_on_unsupported_argument(self):
+        self.assertRaisesRegexp(ClaraManagerError,
+                                'Unsupported argument: pool_size',
+                                ClaraProcessConfig, clara, 'java', 'dpe',
+                                {'pool_size': 4})
+
+    def test_clara_config_with_instance_id(self):
+        conf = ClaraProcessConfig(clara, 'java', 'dpe.2')
+
+        self.assertEqual(conf.cmd, ['./bin/clara-dpe', '-p', 'platform'])
+        self.assertTrue(conf.log_file('log').endswith('-java-dpe.2.log'))
+
+    def test_clara_config_with_pinning(self):
+        conf = ClaraProcessConfig(clara, 'java', 'dpe', cores=[2, 3], numa=1)
+
+        self.assertEqual(conf.cmd, ['numactl', '--cpunodebind=1',
+                                    '--membind=1', 'taskset', '-c', '2,3',
+                                    './bin/clara-dpe', '-p', 'platform'])
+
     def test_standard_request_config(self):
         conf = ClaraProcessConfig(clara, 'java', 'orchestrator')
         self.assertEqual(conf.cmd, ['./bin/standard-orchestrator'])
 
+    def test_fake_profile_config(self):
+        fake = fake_profile('/tmp/fake')
+        conf = ClaraProcessConfig(fake, 'java', 'dpe.2', {'port': 7791})
+
+        self.assertEqual(conf.cmd, [sys.executable, '-u', fake_launcher,
+                                    '--registry', '/tmp/fake/registry',
+                                    'dpe', '-port', '7791'])
+        self.assertEqual(conf.cwd, '/tmp/fake')
+        self.assertEqual(conf.log_file('log'),
+                         '/tmp/fake/log/%s-java-dpe.2.log' % host_ip)
+
+    def test_fake_profile_keeps_python_dpe_on_standby(self):
+        fake = fake_profile('/tmp/fake')
+        conf = ClaraProcessConfig(fake, 'python', 'dpe')
+
+        self.assertEqual(standby_command(conf.cmd, fake['python']['standby']
+                                         ['dpe'])[:4],
+                         [sys.executable, '-u', standby_launcher,
+                          fake_launcher])
+        self.assertEqual(conf.cmd[-3:], ['dpe', '-port', '7801'])
+        self.assertIsInstance(readiness_probe(fake, 'python', 'dpe')[0],
+                              LogProbe)
+
+    def test_fake_profile_on_a_loopback_address(self):
+        fake = fake_profile('/tmp/fake', '127.0.0.2')
+        platform = ClaraProcessConfig(fake, 'java', 'platform')
+        dpe = ClaraProcessConfig(fake, 'java', 'dpe')
+
+        self.assertEqual(platform.cmd[-3:], ['--host', '127.0.0.2', 'dpe'])
+        self.assertEqual(dpe.cmd[-5:], ['--host', '127.0.0.2', 'dpe',
+                                        '-port', '7781'])
+        self.assertEqual(dpe.log_file('log'),
+                         '/tmp/fake/log/127.0.0.2/%s-java-dpe.log' % host_ip)
+        self.assertEqual(readiness_probe(fake, 'java', 'dpe',
+                                         dpe.port)[0]._port, 7781)
+
     def _assert_clara_config(self, lang, instance, command, working_dir,
                              env=os.environ):
         conf = ClaraProcessConfig(clara, lang, instance)
@@ -63,39 +162,117 @@ class TestClaraProcessConfig(unittest.TestCase):
         self.assertEqual(conf.cwd, working_dir)
         self.assertEqual(conf.env, env)
 
-    def test_open_logs(self):
+    @mock.patch('clara_manager.LogCapture')
+    def test_open_logs(self, mock_lc):
         out_log = "/clara/logs/%s-%s-%s.log" % (host_ip, 'java', 'dpe')
         err_log = "/clara/logs/%s-%s-%s.err" % (host_ip, 'java', 'dpe')
         conf = ClaraProcessConfig(clara, 'java', 'dpe')
 
-        with mock.patch('%s.open' % cm, mock.mock_open(), create=True) as o:
+        conf.open_logs()
+
+        mock_lc.assert_called_once_with(out_log, err_log)
+        self.assertEqual(conf.logs, mock_lc.return_value)
 
-            o.side_effect = lambda *args: args[0]
+    @mock.patch('clara_manager.LogCapture')
+    def test_open_logs_with_capture_settings(self, mock_lc):
+        capture = {'max_bytes': 1024, 'backups': 2, 'tail': 10}
+        conf = ClaraProcessConfig(dict(clara, capture=capture), 'java', 'dpe')
 
-            conf.open_logs()
+        conf.open_logs()
 
-            log_calls = [mock.call(out_log, 'w+'), mock.call(err_log, 'w+')]
-            o.assert_has_calls(log_calls)
+        self.assertEqual(mock_lc.call_args[1], capture)
 
-            self.assertEqual(conf.out, out_log)
-            self.assertEqual(conf.err, err_log)
+    @mock.patch('clara_manager.LogCapture')
+    def test_attach_logs(self, mock_lc):
+        conf = ClaraProcessConfig(clara, 'java', 'dpe')
+        conf.open_logs()
 
-    def test_close_logs(self):
-        with mock.patch('%s.open' % cm, mock.mock_open(), create=True) as o:
-            out_mock = mock.Mock()
-            err_mock = mock.Mock()
+        conf.attach_logs('OUT', 'ERR')
 
-            o.side_effect = [out_mock, err_mock]
+        mock_lc.return_value.attach.assert_called_once_with('OUT', 'ERR')
+
+    @mock.patch('clara_manager.LogCapture')
+    def test_close_logs(self, mock_lc):
+        conf = ClaraProcessConfig(clara, 'java', 'dpe')
+        conf.open_logs()
+        conf.close_logs()
 
-            conf = ClaraProcessConfig(clara, 'java', 'dpe')
-            conf.open_logs()
-            conf.close_logs()
+        mock_lc.return_value.close.assert_called_once_with()
 
-            out_mock.close.assert_called_with()
-            err_mock.close.assert_called_with()
+        self.assertEqual(conf.logs, None)
 
-            self.assertEqual(conf.out, None)
-            self.assertEqual(conf.err, None)
+
+class TestParseRequest(unittest.TestCase):
+
+    def _request(self, **kwargs):
+        req = {
+            'version': 1,
+            'action': 'start',
+            'target': {'lang': 'java', 'instance': 'dpe'},
+        }
+        req.update(kwargs)
+        return json.dumps(req)
+
+    def test_parse_colon_request(self):
+        self.assertEqual(parse_request('clara:start:java:dpe'),
+                         (None, 'start', 'java', 'dpe', {}))
+
+    def test_parse_colon_logs_request(self):
+        self.assertEqual(parse_request('clara:logs:tail:java:dpe:5'),
+                         (None, 'logs', 'java', 'dpe',
+                          {'command': 'tail', 'lines': '5'}))
+        self.assertEqual(parse_request('clara:logs:grep:java:dpe:a:b'),
+                         (None, 'logs', 'java', 'dpe',
+                          {'command': 'grep', 'pattern': 'a:b'}))
+
+    def test_parse_structured_request(self):
+        msg = self._request(id='r1', args={'pool_size': 2})
+
+        self.assertEqual(parse_request(msg),
+                         ('r1', 'start', 'java', 'dpe', {'pool_size': 2}))
+
+    def test_parse_structured_request_without_args(self):
+        self.assertEqual(parse_request(self._request()),
+                         (None, 'start', 'java', 'dpe', {}))
+
+    def test_parse_structured_request_with_numeric_arguments(self):
+        msg = self._request(args={'timeout': '10', 'cores': '2',
+                                  'numa': 0, 'pool_size': '4'})
+
+        _, _, _, _, args = parse_request(msg)
+
+        self.assertEqual(args, {'timeout': 10.0, 'cores': 2, 'numa': 0,
+                                'pool_size': '4'})
+        self.assertIsInstance(args['timeout'], float)
+
+    def test_parse_structured_request_with_instance_id(self):
+        msg = self._request(target={'lang': 'java', 'instance': 'dpe',
+                                    'id': 2})
+
+        self.assertEqual(parse_request(msg),
+                         (None, 'start', 'java', 'dpe.2', {}))
+
+    def test_parse_raises_on_bad_requests(self):
+        bad_requests = [
+            ('clara:start', 'Bad request'),
+            ('clara:logs:tail', 'Bad request'),
+            ('clara:logs:grep:java', 'Bad request'),
+            ('clara:launch:java:dpe', 'Unsupported action: launch'),
+            ('{"version": 1', 'Bad request'),
+            ('{}', 'Unsupported protocol version: None'),
+            (self._request(version=2), 'Unsupported protocol version: 2'),
+            (self._request(action='launch'), 'Unsupported action: launch'),
+            (self._request(target='java'), 'Bad target'),
+            (self._request(target={'lang': 'java'}), 'Bad target'),
+            (self._request(args=[1, 2]), 'Bad arguments'),
+            (self._request(args={'timeout': 'soon'}), 'Bad timeout: soon'),
+            (self._request(args={'timeout': -1}), 'Bad timeout: -1'),
+            (self._request(args={'cores': '1.5'}), 'Bad cores: 1.5'),
+            (self._request(args={'numa': [0]}), r'Bad numa: \[0\]'),
+        ]
+        for msg, error in bad_requests:
+            self.assertRaisesRegexp(ClaraManagerError, error,
+                                    parse_request, msg)
 
 
 class TestClaraManagerStart(unittest.TestCase):
@@ -104,13 +281,16 @@ class TestClaraManagerStart(unittest.TestCase):
         self.manager = ClaraManager(clara)
 
         self.mock_t = patch_on_setup(self, 'time.sleep')
+        self.mock_tm = patch_on_setup(self, 'time.time')
         self.mock_po = patch_on_setup(self, 'subprocess.Popen')
         self.mock_cc = patch_on_setup(self, 'clara_manager.ClaraProcessConfig')
+        self.mock_sp = patch_on_setup(self, 'clara_manager.stop_processes')
 
         self.ps = self.mock_po.return_value
         self.cc = self.mock_cc.return_value
 
         self.ps.poll.return_value = None
+        self.mock_tm.side_effect = itertools.count(0, 0.5)
 
     def test_start_clara_raises_on_bad_instance(self):
         self.assertRaisesRegexp(ClaraManagerError, 'Bad instance: monitor',
@@ -128,7 +308,62 @@ class TestClaraManagerStart(unittest.TestCase):
     def test_start_clara_creates_config(self):
         self.manager.start_clara('python', 'dpe')
 
-        self.mock_cc.assert_called_once_with(clara, 'python', 'dpe')
+        self.mock_cc.assert_called_once_with(clara, 'python', 'dpe', {},
+                                             None, None)
+
+    def test_start_clara_with_arguments(self):
+        self.manager.standby = mock.Mock()
+
+        self.manager.start_clara('java', 'dpe', {'pool_size': 4})
+
+        self.mock_cc.assert_called_once_with(clara, 'java', 'dpe',
+                                             {'pool_size': 4}, None, None)
+        self.assertFalse(self.manager.standby.claim.called)
+
+    @mock.patch('clara_manager.readiness_probe')
+    def test_start_clara_overrides_ready_timeout(self, mock_rp):
+        mock_rp.return_value = mock.Mock(return_value=False), 10
+
+        self.assertRaisesRegexp(ClaraManagerError,
+                                'java/dpe not ready after 60 s',
+                                self.manager.start_clara, 'java', 'dpe',
+                                {'timeout': 60})
+        self.mock_cc.assert_called_once_with(clara, 'java', 'dpe', {},
+                                             None, None)
+
+    def test_start_clara_publishes_events(self):
+        self.manager.events = mock.Mock()
+        self.manager._watch_exit = mock.Mock()
+
+        self.manager.start_clara('python', 'dpe')
+
+        pid = self.ps.pid
+        self.manager._watch_exit.assert_called_once_with('python/dpe',
+                                                         self.cc, self.ps)
+        self.manager.events.publish.assert_has_calls([
+            mock.call('start', 'python/dpe', pid=pid),
+            mock.call('ready', 'python/dpe', pid=pid, elapsed=mock.ANY),
+        ])
+
+    def test_watch_exit_publishes_crash(self):
+        self.manager.events = mock.Mock()
+        self.cc.stopping = False
+        self.ps.wait.return_value = -9
+
+        self.manager._watch_exit('java/dpe', self.cc, self.ps).join()
+
+        self.manager.events.publish.assert_called_once_with(
+            'exit', 'java/dpe', pid=self.ps.pid, code=-9, expected=False)
+
+    def test_watch_exit_publishes_stop(self):
+        self.manager.events = mock.Mock()
+        self.cc.stopping = True
+        self.ps.wait.return_value = 0
+
+        self.manager._watch_exit('java/dpe', self.cc, self.ps).join()
+
+        self.manager.events.publish.assert_called_once_with(
+            'exit', 'java/dpe', pid=self.ps.pid, code=0, expected=True)
 
     def test_start_clara_open_logs_before_running_process(self):
         def assert_open_logs(*args, **kwargs):
@@ -148,8 +383,15 @@ class TestClaraManagerStart(unittest.TestCase):
                                              env=self.cc.env,
                                              cwd=self.cc.cwd,
                                              preexec_fn=os.setsid,
-                                             stdout=self.cc.out,
-                                             stderr=self.cc.err)
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE)
+
+    def test_start_clara_capture_process_output(self):
+        self.manager.start_clara('python', 'dpe')
+
+        self.cc.attach_logs.assert_called_once_with(self.ps.stdout,
+                                                    self.ps.stderr)
+        self.assertEqual(self.manager.logs['python/dpe'], self.cc.logs)
 
     def test_start_clara_store_process(self):
         self.manager.start_clara('python', 'platform')
@@ -165,6 +407,31 @@ class TestClaraManagerStart(unittest.TestCase):
         clara_run = self.manager.instances[key]
         self.assertEquals(clara_run, self.cc)
 
+    def test_start_clara_claims_standby_process(self):
+        standby_conf, standby_proc = mock.Mock(), mock.Mock()
+        standby_proc.poll.return_value = None
+        self.manager.standby = mock.Mock()
+        self.manager.standby.claim.return_value = standby_conf, standby_proc
+
+        self.manager.start_clara('python', 'dpe')
+
+        self.manager.standby.claim.assert_called_once_with('python/dpe')
+        self.assertFalse(self.mock_po.called)
+        standby_conf.open_logs.assert_called_once_with()
+        standby_proc.stdin.write.assert_called_once_with('\n')
+        standby_proc.stdin.close.assert_called_once_with()
+        standby_conf.attach_logs.assert_called_once_with(standby_proc.stdout,
+                                                         standby_proc.stderr)
+        self.assertEqual(self.manager.instances['python/dpe'], standby_conf)
+
+    def test_start_clara_starts_monitoring(self):
+        self.manager.monitor = mock.Mock()
+
+        self.manager.start_clara('python', 'platform')
+
+        self.manager.monitor.watch.assert_called_once_with('python/platform',
+                                                           self.ps.pid)
+
     def test_start_clara_raises_on_process_error(self):
         self.ps.poll.return_value = 1
 
@@ -181,13 +448,358 @@ class TestClaraManagerStart(unittest.TestCase):
             pass
         self.assertNotIn('python/platform', self.manager.instances)
 
-    def test_start_clara_close_logs_on_process_error(self):
+    def test_start_clara_stops_process_on_process_error(self):
         self.ps.poll.return_value = 1
         try:
             self.manager.start_clara('python', 'platform')
         except:
             pass
+        self.mock_sp.assert_called_once_with({'python/platform': self.cc})
+
+    def test_start_clara_stops_process_on_unexpected_error(self):
+        self.manager.monitor = mock.Mock()
+        self.manager.monitor.watch.side_effect = OSError('No such process')
+
+        self.assertRaisesRegexp(OSError, 'No such process',
+                                self.manager.start_clara, 'java', 'dpe')
+
+        self.mock_sp.assert_called_once_with({'java/dpe': self.cc})
+        self.assertNotIn('java/dpe', self.manager.instances)
+        self.assertNotIn('java/dpe', self.manager.allocations)
+
+    def test_start_clara_close_logs_if_process_cannot_run(self):
+        self.mock_po.side_effect = OSError('No such file')
+
+        self.assertRaises(OSError, self.manager.start_clara, 'java', 'dpe')
+
         self.cc.close_logs.assert_called_once_with()
+        self.assertFalse(self.mock_sp.called)
+
+    @mock.patch('clara_manager.readiness_probe')
+    def test_start_clara_returns_as_soon_as_ready(self, mock_rp):
+        probe = mock.Mock(side_effect=[False, False, True])
+        mock_rp.return_value = probe, 30
+
+        self.manager.start_clara('java', 'dpe')
+
+        mock_rp.assert_called_once_with(clara, 'java', 'dpe', self.cc.port)
+        probe.assert_called_with(self.cc, self.ps)
+        self.assertEqual(probe.call_count, 3)
+        self.assertEqual(self.mock_t.call_count, 2)
+        self.assertIn('java/dpe', self.manager.instances)
+
+    @mock.patch('clara_manager.readiness_probe')
+    def test_start_clara_raises_if_process_exits_when_ready(self, mock_rp):
+        mock_rp.return_value = mock.Mock(return_value=True), 30
+        self.ps.poll.side_effect = [None, 1, 1]
+
+        self.assertRaisesRegexp(ClaraManagerError,
+                                'Could not start java/dpe',
+                                self.manager.start_clara, 'java', 'dpe')
+
+        self.assertNotIn('java/dpe', self.manager.instances)
+
+    @mock.patch('clara_manager.readiness_probe')
+    def test_start_clara_raises_on_ready_timeout(self, mock_rp):
+        mock_rp.return_value = mock.Mock(return_value=False), 10
+
+        self.assertRaisesRegexp(ClaraManagerError,
+                                'java/dpe not ready after 10 s',
+                                self.manager.start_clara, 'java', 'dpe')
+
+        self.mock_sp.assert_called_once_with({'java/dpe': self.cc})
+        self.assertNotIn('java/dpe', self.manager.instances)
+
+
+class TestClaraManagerAllocation(unittest.TestCase):
+
+    def setUp(self):
+        conf = dict(clara)
+        conf['java'] = dict(clara['java'], args={'port': '-port'},
+                            ports={'base': 7771, 'step': 10, 'slots': 4})
+        self.clara = conf
+        self.manager = ClaraManager(conf)
+
+        patch_on_setup(self, 'time.sleep')
+        self.mock_tm = patch_on_setup(self, 'time.time')
+        self.mock_po = patch_on_setup(self, 'subprocess.Popen')
+        self.mock_cc = patch_on_setup(self, 'clara_manager.ClaraProcessConfig')
+        self.mock_pa = patch_on_setup(self, 'clara_manager.port_available')
+        self.mock_cpu = patch_on_setup(self, 'multiprocessing.cpu_count')
+        patch_on_setup(self, 'clara_manager.stop_processes')
+
+        self.mock_po.return_value.poll.return_value = None
+        self.mock_tm.side_effect = itertools.count(0, 0.5)
+        self.mock_pa.return_value = True
+        self.mock_cpu.return_value = 4
+
+    def test_default_instance_keeps_default_port(self):
+        res = self.manager.start_clara('java', 'dpe')
+
+        self.assertEqual(res, [])
+        self.mock_cc.assert_called_once_with(self.clara, 'java', 'dpe', {},
+                                             None, None)
+
+    def test_report_is_encoded_for_requested_port(self):
+        res = self.manager.start_clara('java', 'dpe.1', {'port': u'7771'})
+
+        self.assertEqual(res, ['port 7771'])
+        self.assertIs(type(res[0]), str)
+
+    def test_instances_get_distinct_ports(self):
+        res1 = self.manager.start_clara('java', 'dpe.1')
+        res2 = self.manager.start_clara('java', 'dpe.2')
+
+        self.assertEqual(res1, ['port 7781'])
+        self.assertEqual(res2, ['port 7791'])
+        self.assertIn('java/dpe.1', self.manager.instances)
+        self.assertIn('java/dpe.2', self.manager.instances)
+
+    def test_allocation_skips_ports_in_use(self):
+        self.mock_pa.side_effect = lambda port: port != 7781
+
+        res = self.manager.start_clara('java', 'dpe.1')
+
+        self.assertEqual(res, ['port 7791'])
+
+    def test_allocation_raises_when_no_ports_left(self):
+        self.mock_pa.return_value = False
+
+        self.assertRaisesRegexp(ClaraManagerError, 'No free ports',
+                                self.manager.start_clara, 'java', 'dpe.1')
+        self.assertEqual(self.manager.allocations, {})
+
+    def test_instances_get_disjoint_cores(self):
+        res1 = self.manager.start_clara('java', 'dpe.1', {'cores': 2})
+        res2 = self.manager.start_clara('java', 'dpe.2', {'cores': 2})
+
+        self.assertEqual(res1, ['port 7781', 'cores 0,1'])
+        self.assertEqual(res2, ['port 7791', 'cores 2,3'])
+        self.mock_cc.assert_called_with(self.clara, 'java', 'dpe.2',
+                                        {'port': 7791}, [2, 3], None)
+        self.assertRaisesRegexp(ClaraManagerError, 'Not enough free cores',
+                                self.manager.start_clara, 'java', 'dpe.3',
+                                {'cores': 1})
+
+    def test_cores_are_restricted_to_numa_node(self):
+        mo = mock.mock_open(read_data='2-3\n')
+        with mock.patch('clara_manager.open', mo, create=True):
+            res = self.manager.start_clara('java', 'dpe.1',
+                                           {'cores': 1, 'numa': 1})
+
+        mo.assert_called_once_with('/sys/devices/system/node/node1/cpulist')
+        self.assertEqual(res, ['port 7781', 'cores 2', 'numa 1'])
+
+    @mock.patch('clara_manager.stop_processes')
+    def test_stop_releases_allocation(self, mock_sp):
+        mock_sp.return_value = {'java/dpe.1': (0.1, False)}
+        self.manager.start_clara('java', 'dpe.1', {'cores': 4})
+
+        self.manager.stop_clara('java', 'dpe.1')
+        res = self.manager.start_clara('java', 'dpe.2', {'cores': 4})
+
+        self.assertEqual(res, ['port 7781', 'cores 0,1,2,3'])
+
+    def test_failed_start_releases_allocation(self):
+        self.mock_po.return_value.poll.return_value = 1
+
+        self.assertRaises(ClaraManagerError,
+                          self.manager.start_clara, 'java', 'dpe.1')
+        self.assertEqual(self.manager.allocations, {})
+
+    def test_parse_cpulist(self):
+        self.assertEqual(parse_cpulist('0-2,8,10-11\n'), [0, 1, 2, 8, 10, 11])
+
+
+class TestReadinessProbes(unittest.TestCase):
+
+    def test_default_probe_waits_for_process_alive(self):
+        with mock.patch('time.time') as mock_tm:
+            mock_tm.return_value = 100
+            probe, timeout = readiness_probe(clara, 'java', 'dpe')
+
+            self.assertIsInstance(probe, AliveProbe)
+            self.assertFalse(probe(None, None))
+
+            mock_tm.return_value = 102
+            self.assertTrue(probe(None, None))
+
+    def test_configured_probes(self):
+        conf = {'java': {'ready': {
+            'platform': {'log': 'Started', 'timeout': 5},
+            'dpe': {'port': 7771},
+            'monitor': {'procs': 3},
+        }}}
+
+        probe, timeout = readiness_probe(conf, 'java', 'platform')
+        self.assertIsInstance(probe, LogProbe)
+        self.assertEqual(timeout, 5)
+
+        probe, timeout = readiness_probe(conf, 'java', 'dpe')
+        self.assertIsInstance(probe, PortProbe)
+        self.assertEqual(timeout, 30)
+
+        probe, timeout = readiness_probe(conf, 'java', 'monitor')
+        self.assertIsInstance(probe, TreeProbe)
+
+    def test_port_probe_uses_allocated_port(self):
+        conf = {'java': {'ready': {'dpe': {'port': 7771}}}}
+
+        probe, _ = readiness_probe(conf, 'java', 'dpe.2', 7781)
+
+        self.assertEqual(probe._port, 7781)
+
+    def test_log_probe_matches_new_output_lines(self):
+        conf = mock.Mock()
+        conf.logs.since.side_effect = [
+            [],
+            [(1, 'Starting...'), (3, 'Loading')],
+            [(4, 'DPE 10.1.1.1 started')],
+        ]
+        probe = LogProbe('DPE .* started')
+
+        self.assertFalse(probe(conf, None))
+        self.assertFalse(probe(conf, None))
+        self.assertTrue(probe(conf, None))
+
+        conf.logs.since.assert_has_calls([mock.call(0, 'out'),
+                                          mock.call(0, 'out'),
+                                          mock.call(3, 'out')])
+
+    def test_port_probe_checks_the_process_tree(self):
+        other = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        other.bind(('127.0.0.1', 0))
+        other.listen(1)
+        self.addCleanup(other.close)
+
+        code = ('import socket, sys, time\n'
+                's = socket.socket()\n'
+                's.bind(("127.0.0.1", 0))\n'
+                's.listen(1)\n'
+                'print s.getsockname()[1]\n'
+                'sys.stdout.flush()\n'
+                'time.sleep(30)\n')
+        proc = subprocess.Popen([sys.executable, '-c', code],
+                                stdout=subprocess.PIPE, close_fds=True)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        port = int(proc.stdout.readline())
+        conf = mock.Mock(proc=proc)
+
+        self.assertTrue(PortProbe(port)(conf, proc))
+        self.assertFalse(PortProbe(other.getsockname()[1])(conf, proc))
+
+    @mock.patch('psutil.Process')
+    def test_tree_probe(self, mock_ps):
+        proc = mock.Mock()
+        probe = TreeProbe(3)
+
+        mock_ps.return_value.get_children.return_value = [proc]
+        self.assertFalse(probe(None, proc))
+
+        mock_ps.return_value.get_children.return_value = [proc, proc]
+        self.assertTrue(probe(None, proc))
+
+
+class TestStandbyPool(unittest.TestCase):
+
+    def setUp(self):
+        self.clara = {
+            'logs': '/clara/logs',
+            'python': dict(clara['python'], standby={
+                'dpe': {'size': 2, 'preload': ['zmq', 'yaml']},
+            }),
+            'java': dict(clara['java'], standby={
+                'platform': {'cmd': './bin/clara-standby platform'},
+            }),
+        }
+        self.pool = StandbyPool(self.clara)
+
+    def test_standby_command_wraps_python_script(self):
+        cmd = ['python', '-u', 'core/system/Dpe.py', '-p', '1']
+
+        self.assertEqual(standby_command(cmd, {'preload': ['zmq', 'yaml']}),
+                         ['python', '-u', standby_launcher,
+                          '--preload', 'zmq,yaml',
+                          'core/system/Dpe.py', '-p', '1'])
+        self.assertEqual(standby_command(cmd, {}),
+                         ['python', '-u', standby_launcher,
+                          'core/system/Dpe.py', '-p', '1'])
+
+    def test_standby_command_uses_configured_command(self):
+        self.assertEqual(standby_command(['./bin/j_dpe'],
+                                         {'cmd': './bin/standby dpe'}),
+                         ['./bin/standby', 'dpe'])
+
+    def test_standby_command_raises_if_not_supported(self):
+        self.assertRaisesRegexp(ClaraManagerError,
+                                'Cannot keep on standby: ./bin/j_dpe',
+                                standby_command, ['./bin/j_dpe'], {})
+
+    @mock.patch('subprocess.Popen')
+    def test_fill_spawns_configured_standby_processes(self, mock_po):
+        mock_po.return_value.poll.return_value = None
+
+        self.pool.fill()
+
+        self.assertEqual(mock_po.call_count, 3)
+        cmds = sorted(c[0][0][-1] for c in mock_po.call_args_list)
+        self.assertEqual(cmds, ['core/system/Dpe.py',
+                                'core/system/Dpe.py',
+                                'platform'])
+        kwargs = mock_po.call_args[1]
+        self.assertEqual(kwargs['stdin'], subprocess.PIPE)
+        self.assertEqual(kwargs['preexec_fn'], os.setsid)
+
+    @mock.patch('subprocess.Popen')
+    def test_fill_replaces_dead_standby_processes(self, mock_po):
+        mock_po.return_value.poll.return_value = None
+        self.pool.fill()
+
+        mock_po.return_value.poll.return_value = 1
+        self.pool.fill()
+
+        self.assertEqual(mock_po.call_count, 6)
+
+    @mock.patch('subprocess.Popen')
+    def test_claim_returns_live_standby(self, mock_po):
+        mock_po.return_value.poll.return_value = None
+        self.pool.fill()
+
+        conf, proc = self.pool.claim('python/dpe')
+
+        self.assertEqual(proc, mock_po.return_value)
+        self.assertEqual(conf.proc, proc)
+        self.assertTrue(self.pool._refill.is_set())
+        self.assertIsNotNone(self.pool.claim('python/dpe'))
+        self.assertIsNone(self.pool.claim('python/dpe'))
+
+    def test_claim_without_standby(self):
+        self.assertIsNone(self.pool.claim('java/dpe'))
+
+    def test_standby_launcher_runs_script_when_claimed(self):
+        script = tempfile.NamedTemporaryFile(suffix='.py')
+        self.addCleanup(script.close)
+        script.write('import sys, json\n'
+                     'print(json.dumps(sys.argv[1:]))\n')
+        script.flush()
+
+        cmd = standby_command([sys.executable, script.name, '-p', '1'],
+                              {'preload': ['json']})
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        out, _ = proc.communicate('--extra\n')
+
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(out.strip(), '["-p", "1", "--extra"]')
+
+    def test_standby_launcher_exits_if_never_claimed(self):
+        cmd = standby_command([sys.executable, '/no/such/script.py'], {})
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        proc.communicate('')
+
+        self.assertEqual(proc.returncode, 0)
 
 
 class TestClaraManagerStop(unittest.TestCase):
@@ -210,7 +822,7 @@ class TestClaraManagerStop(unittest.TestCase):
         self.assertRaisesRegexp(ClaraManagerError, 'python/dpe is not run',
                                 manager.stop_clara, 'python', 'dpe')
 
-    @mock.patch('clara_manager.stop_process')
+    @mock.patch('clara_manager.stop_processes')
     def test_stop_clara_stops_process(self, mock_stop):
         run1 = ClaraProcessConfig(clara)
         run2 = ClaraProcessConfig(clara)
@@ -220,160 +832,393 @@ class TestClaraManagerStop(unittest.TestCase):
             'python/dpe': run1, 'python/platform': run2, 'java/dpe': run3
         }
         result = {'python/platform': run2, 'java/dpe': run3}
+        mock_stop.return_value = {'python/dpe': (0.25, False)}
 
-        manager.stop_clara('python', 'dpe')
+        lines = manager.stop_clara('python', 'dpe')
 
-        mock_stop.assert_called_once_with(run1)
+        mock_stop.assert_called_once_with({'python/dpe': run1})
         self.assertDictEqual(manager.instances, result)
+        self.assertEqual(manager.teardown, {'python/dpe': 0.25})
+        self.assertEqual(lines, ['python/dpe 0.250'])
+
+    @mock.patch('clara_manager.stop_processes')
+    def test_stop_clara_stops_monitoring(self, mock_stop):
+        manager = ClaraManager(clara)
+        manager.instances = {'python/dpe': mock.Mock()}
+        manager.monitor = mock.Mock()
+        mock_stop.return_value = {'python/dpe': (0.1, False)}
+
+        manager.stop_clara('python', 'dpe')
+
+        manager.monitor.unwatch.assert_called_once_with('python/dpe')
+
+    @mock.patch('clara_manager.stop_processes')
+    def test_stop_clara_raises_on_forced_kill(self, mock_stop):
+        manager = ClaraManager(clara)
+        manager.instances = {'python/dpe': mock.Mock()}
+        mock_stop.return_value = {'python/dpe': (5.1, True)}
+
+        self.assertRaises(OSError, manager.stop_clara, 'python', 'dpe')
+        self.assertEqual(manager.teardown, {'python/dpe': 5.1})
+
+
+class TestClaraManagerConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = ClaraManager(clara)
+
+        patch_on_setup(self, 'time.sleep')
+        patch_on_setup(self, 'time.time').side_effect = itertools.count()
+        patch_on_setup(self, 'clara_manager.ClaraProcessConfig')
+
+        mock_po = patch_on_setup(self, 'subprocess.Popen')
+        mock_po.return_value.poll.return_value = None
+
+    def test_start_other_instance_while_one_is_locked(self):
+        with self.manager.instance_lock('java/platform'):
+            worker = threading.Thread(target=self.manager.start_clara,
+                                      args=('java', 'dpe'))
+            worker.start()
+            worker.join(1)
+
+            self.assertFalse(worker.is_alive())
+            self.assertIn('java/dpe', self.manager.instances)
+
+    def test_start_same_instance_waits_for_lock(self):
+        lock = self.manager.instance_lock('java/dpe')
+        lock.acquire()
+        worker = threading.Thread(target=self.manager.start_clara,
+                                  args=('java', 'dpe'))
+        worker.start()
+        worker.join(0.1)
+
+        self.assertTrue(worker.is_alive())
+        self.assertNotIn('java/dpe', self.manager.instances)
+
+        lock.release()
+        worker.join(1)
+
+        self.assertIn('java/dpe', self.manager.instances)
 
 
 class TestStopProcess(unittest.TestCase):
 
-    @mock.patch('psutil.Process')
-    def test_stop_process_terminates_the_process(self, mock_ps):
-        proc = mock_ps.return_value
-        conf = mock.Mock()
-        conf.proc = proc
+    def setUp(self):
+        self.mock_ps = patch_on_setup(self, 'psutil.Process')
+        self.mock_wp = patch_on_setup(self, 'psutil.wait_procs')
+        self.mock_kg = patch_on_setup(self, 'os.killpg')
 
-        proc.is_running.return_value = False
-        proc.get_children.return_value = []
-        stop_process(conf)
+        self.proc = self.mock_ps.return_value
+        self.proc.pid = 100
+        self.proc.get_children.return_value = []
 
-        proc.terminate.assert_called_once_with()
-        self.assertTrue(not proc.kill.called)
+        self.conf = mock.Mock()
+        self.conf.proc.pid = 100
 
-    @mock.patch('time.sleep')
-    @mock.patch('psutil.Process')
-    def test_stop_process_with_forced_kill(self, mock_ps, mock_t):
-        proc = mock_ps.return_value
-        conf = mock.Mock()
-        conf.proc = proc
+        self.mock_wp.return_value = [self.proc], []
 
-        proc.is_running.return_value = True
-        proc.get_children.return_value = []
+    def _child(self, pid):
+        child = mock.Mock()
+        child.pid = pid
+        return child
 
-        self.assertRaises(OSError, stop_process, conf)
+    def test_stop_process_signals_the_process_group(self):
+        stop_process(self.conf)
 
-        proc.kill.assert_called_once_with()
-        proc.wait.assert_called_once_with()
+        self.mock_kg.assert_called_once_with(100, signal.SIGTERM)
+        self.assertFalse(self.proc.kill.called)
 
-    @mock.patch('psutil.Process')
-    def test_stop_process_close_logs(self, mock_ps):
-        proc = mock_ps.return_value
-        conf = mock.Mock()
-        conf.proc = proc
+    def test_stop_process_waits_for_the_whole_tree(self):
+        children = [self._child(101), self._child(102)]
+        self.proc.get_children.return_value = children
 
-        proc.is_running.return_value = False
-        proc.get_children.return_value = []
+        stop_process(self.conf, timeout=3)
 
-        stop_process(conf)
+        self.proc.get_children.assert_called_once_with(recursive=True)
+        procs, timeout = self.mock_wp.call_args[0]
+        self.assertEqual(procs, [self.proc] + children)
+        self.assertEqual(timeout, 3)
 
-        conf.close_logs.assert_called_once_with()
+    def test_stop_process_with_forced_kill(self):
+        bad_proc = self._child(101)
+        self.proc.get_children.return_value = [bad_proc]
+        self.mock_wp.side_effect = [([self.proc], [bad_proc]), ([], [])]
 
-    @mock.patch('psutil.Process')
-    def test_stop_process_stop_all_children(self, mock_ps):
-        proc = mock_ps.return_value
-        conf = mock.Mock()
-        conf.proc = proc
+        self.assertRaises(OSError, stop_process, self.conf)
 
-        proc.is_running.return_value = False
-        proc.get_children.return_value = [proc] * 2
+        bad_proc.kill.assert_called_once_with()
+        self.assertFalse(self.proc.kill.called)
+        self.assertEqual(self.mock_wp.call_count, 2)
+        self.assertEqual(self.mock_wp.call_args[0][0], [bad_proc])
 
-        stop_process(conf)
+    def test_stop_process_close_logs(self):
+        stop_process(self.conf)
 
-        self.assertEqual(proc.terminate.call_count, 2)
+        self.conf.close_logs.assert_called_once_with()
 
-    @mock.patch('time.sleep')
-    def test_stop_process_force_children_kill(self, mock_t):
-        with mock.patch('psutil.Process') as mock_bp, \
-                mock.patch('psutil.Process') as mock_ps:
-            bad_proc = mock_bp.return_value
-            proc = mock_ps.return_value
+    def test_stop_process_already_finished(self):
+        self.mock_ps.side_effect = psutil.NoSuchProcess(100)
+        self.mock_wp.return_value = [], []
 
-            bad_proc.is_running.return_value = True
-            proc.is_running.return_value = False
+        self.assertEqual(stop_process(self.conf), 0.0)
+        self.conf.close_logs.assert_called_once_with()
 
-            proc.get_children.return_value = [bad_proc]
+    @mock.patch('time.time')
+    def test_stop_processes_reports_latency_per_instance(self, mock_tm):
+        conf1, conf2 = mock.Mock(), mock.Mock()
+        conf1.proc.pid, conf2.proc.pid = 100, 200
+        procs = {100: self.proc, 200: self._child(200)}
+        self.mock_ps.side_effect = lambda pid: procs[pid]
+        procs[200].get_children.return_value = []
 
-            conf = mock.Mock()
-            conf.proc = proc
+        def wait_procs(procs, timeout, callback):
+            for t, p in zip([0.5, 1.5], procs):
+                mock_tm.return_value = t
+                callback(p)
+            return procs, []
 
-            self.assertRaises(OSError, stop_process, conf)
+        mock_tm.return_value = 0.0
+        self.mock_wp.side_effect = wait_procs
 
-            bad_proc.kill.assert_called_once_with()
-            bad_proc.wait.assert_called_once_with()
+        report = stop_processes({'j/p': conf1, 'j/d': conf2})
 
-            self.assertFalse(proc.terminate.called)
+        self.assertEqual(self.mock_kg.call_count, 2)
+        self.assertEqual(self.mock_wp.call_count, 1)
+        self.assertEqual(sorted(report.values()), [(0.5, False),
+                                                   (1.5, False)])
+        conf1.close_logs.assert_called_once_with()
+        conf2.close_logs.assert_called_once_with()
 
-    @mock.patch('clara_manager.stop_process')
+    @mock.patch('clara_manager.stop_processes')
     def test_stop_all_processes(self, mock_sp):
         manager = ClaraManager(clara)
         manager.instances = {'p/d': 'p1', 'p/p': 'p2', 'j/d': 'p3'}
+        mock_sp.return_value = {'p/d': (0.1, False),
+                                'p/p': (0.2, False),
+                                'j/d': (0.3, False)}
 
-        stop_all(manager)
+        lines = stop_all(manager)
 
-        mock_sp.assert_any_call('p1')
-        mock_sp.assert_any_call('p2')
-        mock_sp.assert_any_call('p3')
-        self.assertEqual(mock_sp.call_count, 3)
+        mock_sp.assert_called_once_with({'p/d': 'p1', 'p/p': 'p2',
+                                         'j/d': 'p3'})
         self.assertTrue(not manager.instances)
+        self.assertEqual(manager.teardown,
+                         {'p/d': 0.1, 'p/p': 0.2, 'j/d': 0.3})
+        self.assertEqual(lines, ['j/d 0.300', 'p/d 0.100', 'p/p 0.200'])
 
-    @mock.patch('clara_manager.stop_process')
+    @mock.patch('clara_manager.stop_processes')
     def test_stop_all_processes_with_forced_kill(self, mock_sp):
         manager = ClaraManager(clara)
         manager.instances = {'p/d': 'p1', 'p/p': 'p2', 'j/d': 'p3'}
+        mock_sp.return_value = {'p/d': (5.0, True),
+                                'p/p': (0.2, False),
+                                'j/d': (5.0, True)}
 
-        mock_sp.side_effect = OSError
-
-        stop_all(manager)
+        lines = stop_all(manager)
 
-        mock_sp.assert_any_call('p1')
-        mock_sp.assert_any_call('p2')
-        mock_sp.assert_any_call('p3')
-        self.assertEqual(mock_sp.call_count, 3)
         self.assertTrue(not manager.instances)
+        self.assertEqual(manager.teardown,
+                         {'p/d': 5.0, 'p/p': 0.2, 'j/d': 5.0})
+        self.assertEqual(lines, ['j/d 5.000 killed', 'p/d 5.000 killed',
+                                 'p/p 0.200'])
+
+
+class TestEventPublisher(unittest.TestCase):
+
+    @mock.patch('time.time')
+    def test_publish_event(self, mock_tm):
+        mock_tm.return_value = 10.0
+        context = zmq.Context()
+        self.addCleanup(context.destroy, 0)
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, 'exit')
+        sub.connect('inproc://test-events')
+
+        events = EventPublisher()
+        events.start(context, 'inproc://test-events')
+        for _ in range(100):
+            events.publish('start', 'java/dpe', pid=10)
+            events.publish('exit', 'java/dpe', pid=10, code=1)
+            if sub.poll(20, zmq.POLLIN):
+                break
+
+        kind, data = sub.recv_multipart()
+        self.assertEqual(kind, 'exit')
+        self.assertEqual(json.loads(data), {
+            'event': 'exit', 'instance': 'java/dpe', 'host': host_ip,
+            'time': 10.0, 'pid': 10, 'code': 1,
+        })
 
 
 class TestClaraManagerDispatch(unittest.TestCase):
 
+    @mock.patch('threading.Thread')
+    @mock.patch('zmq.Poller')
     @mock.patch('zmq.Socket')
     @mock.patch('zmq.Context')
     @mock.patch('time.sleep')
-    def test_zmq_server_is_up(self, mock_t, mock_ctx, mock_sck):
-        manager = ClaraManager(clara)
+    def test_zmq_server_is_up(self, mock_t, mock_ctx, mock_sck, mock_pl,
+                              mock_th):
+        manager = ClaraManager(clara, workers=3)
 
         ctx = mock_ctx.return_value
         sck = mock_sck.return_value
 
         ctx.socket.return_value = sck
-        sck.recv.side_effect = NotImplementedError
+        mock_pl.return_value.poll.side_effect = NotImplementedError
 
         self.assertRaises(NotImplementedError, manager.run)
 
-        ctx.socket.assert_called_once_with(zmq.REP)
-        sck.bind.assert_called_once_with("tcp://*:7788")
+        ctx.socket.assert_any_call(zmq.ROUTER)
+        sck.bind.assert_any_call("tcp://*:7788")
+        ctx.socket.assert_any_call(zmq.PUB)
+        sck.bind.assert_any_call("tcp://*:7789")
+        self.assertEqual(mock_th.return_value.start.call_count, 3 + 3)
 
-    @mock.patch('clara_manager.ClaraManager.dispatch_request')
-    @mock.patch('zmq.Socket')
+    @mock.patch('threading.Thread')
+    @mock.patch('zmq.Poller')
     @mock.patch('zmq.Context')
     @mock.patch('time.sleep')
-    def test_zmq_server_reply(self, mock_t, mock_ctx, mock_sck, mock_dr):
+    def test_zmq_server_forwards_replies(self, mock_t, mock_ctx, mock_pl,
+                                         mock_th):
         manager = ClaraManager(clara)
-        msg = 'clara:start:python:dpe'
-        res = ["SUCCESS", ""]
-
-        sck = mock_sck.return_value
-        mock_ctx.return_value.socket.return_value = sck
+        frontend, replies, events = mock.Mock(), mock.Mock(), mock.Mock()
+        res = ['id', '', 'SUCCESS', '']
 
-        sck.recv.return_value = msg
-        mock_dr.return_value = res
-        sck.send_multipart.side_effect = NotImplementedError
+        mock_ctx.return_value.socket.side_effect = [frontend, replies, events]
+        mock_pl.return_value.poll.side_effect = [[(replies, zmq.POLLIN)],
+                                                 NotImplementedError]
+        replies.recv_multipart.return_value = res
 
         self.assertRaises(NotImplementedError, manager.run)
 
-        sck.recv.assert_called_once_with()
+        frontend.send_multipart.assert_called_once_with(res)
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_handle_request_keeps_envelope(self, mock_dr):
+        manager = ClaraManager(clara)
+        msg = 'clara:start:python:dpe'
+        mock_dr.return_value = ['SUCCESS', '']
+
+        res = manager.handle_request(['id', '', msg])
+
         mock_dr.assert_called_once_with(msg)
-        sck.send_multipart.assert_called_once_with(res)
+        self.assertSequenceEqual(res, ['id', '', 'SUCCESS', ''])
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_handle_request_encodes_reply_frames(self, mock_dr):
+        manager = ClaraManager(clara)
+        mock_dr.return_value = [u'SUCCESS', u'port 7771', u'caf\xe9']
+
+        res = manager.handle_request(['id', '', 'clara:start:java:dpe'])
+
+        self.assertEqual(res, ['id', '', 'SUCCESS', 'port 7771',
+                               'caf\xc3\xa9'])
+        self.assertTrue(all(type(f) is str for f in res))
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_handle_batch_request(self, mock_dr):
+        manager = ClaraManager(clara)
+        mock_dr.side_effect = [['SUCCESS', ''], ['SUCCESS', 'A', 'B']]
+
+        res = manager.handle_request(['id', '', 'clara:batch',
+                                      'clara:start:java:dpe',
+                                      'clara:request:java:list-dpes'])
+
+        self.assertEqual(mock_dr.call_args_list,
+                         [mock.call('clara:start:java:dpe'),
+                          mock.call('clara:request:java:list-dpes')])
+        self.assertEqual(res[:3], ['id', '', 'SUCCESS'])
+        self.assertRegexpMatches(res[3], r'^SUCCESS \d+\.\d{6}\n$')
+        self.assertRegexpMatches(res[4], r'^SUCCESS \d+\.\d{6}\nA\nB$')
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_batch_skips_actions_after_error(self, mock_dr):
+        manager = ClaraManager(clara)
+        mock_dr.side_effect = [['ERROR', 'Bad'], ['SUCCESS', '']]
+
+        res = manager.dispatch_batch(['clara:start:java:dpe',
+                                      'clara:stop:java:dpe',
+                                      '&clara:stop:java:platform'])
+
+        self.assertEqual(mock_dr.call_count, 1)
+        self.assertEqual(len(res), 4)
+        self.assertTrue(res[1].startswith('ERROR'))
+        self.assertEqual(res[2:], ['SKIPPED 0.000000\n'] * 2)
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_batch_runs_independent_actions_together(self, mock_dr):
+        manager = ClaraManager(clara)
+        barrier = threading.Semaphore(0)
+
+        def dispatch(msg):
+            if msg.endswith(':dpe'):
+                barrier.release()
+            elif msg.endswith(':platform'):
+                barrier.acquire()
+            return ['SUCCESS', msg]
+
+        mock_dr.side_effect = dispatch
+
+        res = manager.dispatch_batch(['&clara:start:java:platform',
+                                      '&clara:start:java:dpe',
+                                      'clara:request:java:list-dpes'])
+
+        self.assertEqual([r.split('\n')[1] for r in res[1:]],
+                         ['clara:start:java:platform',
+                          'clara:start:java:dpe',
+                          'clara:request:java:list-dpes'])
+
+    def test_empty_batch(self):
+        manager = ClaraManager(clara)
+
+        self.assertEqual(manager.dispatch_batch([]), ['ERROR', 'Empty batch'])
+
+    @mock.patch('clara_manager.ClaraManager.dispatch_request')
+    def test_worker_pushes_reply(self, mock_dr):
+        manager = ClaraManager(clara)
+        ctx = mock.Mock()
+        sck = ctx.socket.return_value
+        requests = mock.Mock()
+
+        requests.get.side_effect = [['id', '', 'clara:start:java:dpe'],
+                                    NotImplementedError]
+        mock_dr.return_value = ['SUCCESS', '']
+
+        self.assertRaises(NotImplementedError,
+                          manager.process_requests, ctx, requests)
+
+        ctx.socket.assert_called_once_with(zmq.PUSH)
+        sck.send_multipart.assert_called_once_with(['id', '', 'SUCCESS', ''])
+
+    @mock.patch('clara_manager.log')
+    @mock.patch('clara_manager.ClaraManager.handle_request')
+    def test_worker_survives_failed_request(self, mock_hr, mock_log):
+        manager = ClaraManager(clara)
+        ctx = mock.Mock()
+        sck = ctx.socket.return_value
+        requests = mock.Mock()
+
+        requests.get.side_effect = [['a', '', 'clara:start:java:dpe'],
+                                    ['b', '', 'clara:stop:java:dpe'],
+                                    NotImplementedError]
+        mock_hr.side_effect = [TypeError('Bad frame'), ['b', '', 'SUCCESS']]
+
+        self.assertRaises(NotImplementedError,
+                          manager.process_requests, ctx, requests)
+
+        sck.send_multipart.assert_has_calls([
+            mock.call(['a', '', 'ERROR', 'Unexpected exception: Bad frame']),
+            mock.call(['b', '', 'SUCCESS']),
+        ])
+
+    def test_instance_lock_per_key(self):
+        manager = ClaraManager(clara)
+
+        self.assertIs(manager.instance_lock('java/dpe'),
+                      manager.instance_lock('java/dpe'))
+        self.assertIsNot(manager.instance_lock('java/dpe'),
+                         manager.instance_lock('python/dpe'))
 
     def test_dispatch_returns_error_if_empty_request(self):
         manager = ClaraManager(clara)
@@ -401,23 +1246,43 @@ class TestClaraManagerDispatch(unittest.TestCase):
 
     @mock.patch('clara_manager.ClaraManager.start_clara')
     def test_dispatch_successful_start_request(self, mock_sc):
+        mock_sc.return_value = []
         manager = ClaraManager(clara)
         msg = 'clara:start:python:dpe'
 
         res = manager.dispatch_request(msg)
 
-        mock_sc.assert_called_once_with('python', 'dpe')
+        mock_sc.assert_called_once_with('python', 'dpe', {})
+        self.assertSequenceEqual(res, ['SUCCESS', ''])
+
+    @mock.patch('clara_manager.ClaraManager.start_clara')
+    def test_dispatch_structured_start_request(self, mock_sc):
+        mock_sc.return_value = []
+        manager = ClaraManager(clara)
+        msg = json.dumps({
+            'version': 1,
+            'id': 'r1',
+            'action': 'start',
+            'target': {'lang': 'java', 'instance': 'dpe'},
+            'args': {'pool_size': 8, 'jvm_opts': '-Xmx2g'},
+        })
+
+        res = manager.dispatch_request(msg)
+
+        mock_sc.assert_called_once_with('java', 'dpe', {'pool_size': 8,
+                                                        'jvm_opts': '-Xmx2g'})
         self.assertSequenceEqual(res, ['SUCCESS', ''])
 
     @mock.patch('clara_manager.ClaraManager.stop_clara')
     def test_dispatch_successful_stop_request(self, mock_sc):
         manager = ClaraManager(clara)
         msg = 'clara:stop:python:dpe'
+        mock_sc.return_value = ['python/dpe 0.250']
 
         res = manager.dispatch_request(msg)
 
         mock_sc.assert_called_once_with('python', 'dpe')
-        self.assertSequenceEqual(res, ['SUCCESS', ''])
+        self.assertSequenceEqual(res, ['SUCCESS', 'python/dpe 0.250'])
 
     @mock.patch('clara_manager.ClaraManager.standard_request')
     def test_dispatch_successful_standard_request(self, mock_sr):
@@ -427,20 +1292,88 @@ class TestClaraManagerDispatch(unittest.TestCase):
 
         res = manager.dispatch_request(msg)
 
-        mock_sr.assert_called_once_with('java', 'list-dpes')
+        mock_sr.assert_called_once_with('java', 'list-dpes', True)
         self.assertSequenceEqual(res, ['SUCCESS', 'OK'])
 
+    @mock.patch('clara_manager.ClaraManager.standard_request')
+    def test_dispatch_uncached_standard_request(self, mock_sr):
+        manager = ClaraManager(clara)
+        msg = json.dumps({'version': 1, 'action': 'request',
+                          'target': {'lang': 'java', 'instance': 'list-dpes'},
+                          'args': {'cache': False}})
+        mock_sr.return_value = ['OK'], [''], 0
+
+        manager.dispatch_request(msg)
+
+        mock_sr.assert_called_once_with('java', 'list-dpes', False)
+
     @mock.patch('clara_manager.stop_all')
     def test_dispatch_sucessful_stop_all_request(self, mock_sa):
         manager = ClaraManager(clara)
         msg = 'clara:stop:all:all'
+        mock_sa.return_value = ['java/dpe 0.100', 'java/platform 0.200']
 
         res = manager.dispatch_request(msg)
 
         mock_sa.assert_called_once_with(manager)
-        self.assertSequenceEqual(res, ['SUCCESS', ''])
+        self.assertSequenceEqual(res, ['SUCCESS', 'java/dpe 0.100',
+                                       'java/platform 0.200'])
         self.assertTrue(not manager.instances)
 
+    def test_dispatch_logs_tail_request(self):
+        manager = ClaraManager(clara)
+        logs = manager.logs['java/dpe'] = mock.Mock()
+        logs.tail.return_value = ['line 1', 'line 2']
+
+        res = manager.dispatch_request('clara:logs:tail:java:dpe:2')
+
+        logs.tail.assert_called_once_with(2)
+        self.assertSequenceEqual(res, ['SUCCESS', 'line 1', 'line 2'])
+
+    def test_dispatch_logs_grep_request(self):
+        manager = ClaraManager(clara)
+        logs = manager.logs['java/dpe'] = mock.Mock()
+        logs.grep.return_value = []
+
+        res = manager.dispatch_request('clara:logs:grep:java:dpe:a:b')
+
+        logs.grep.assert_called_once_with('a:b')
+        self.assertSequenceEqual(res, ['SUCCESS', ''])
+
+    def test_dispatch_logs_errors(self):
+        manager = ClaraManager(clara)
+        manager.logs['java/dpe'] = mock.Mock()
+
+        self.assertSequenceEqual(
+            manager.dispatch_request('clara:logs:tail:java:platform'),
+            ['ERROR', 'No logs for java/platform'])
+        self.assertSequenceEqual(
+            manager.dispatch_request('clara:logs:grep:java:dpe'),
+            ['ERROR', 'Missing grep pattern'])
+        self.assertSequenceEqual(
+            manager.dispatch_request('clara:logs:cat:java:dpe'),
+            ['ERROR', 'Unsupported logs command: cat'])
+        self.assertSequenceEqual(
+            manager.dispatch_request('clara:logs:tail'),
+            ['ERROR', 'Bad request: "clara:logs:tail"'])
+
+    def test_dispatch_successful_stats_request(self):
+        manager = ClaraManager(clara)
+        manager.monitor = mock.Mock()
+        manager.monitor.report.return_value = ['cpu_max 10.0', 'time cpu']
+
+        res = manager.dispatch_request('clara:stats:java:dpe')
+
+        manager.monitor.report.assert_called_once_with('java/dpe')
+        self.assertSequenceEqual(res, ['SUCCESS', 'cpu_max 10.0', 'time cpu'])
+
+    def test_dispatch_returns_error_if_no_stats(self):
+        manager = ClaraManager(clara)
+
+        res = manager.dispatch_request('clara:stats:java:dpe')
+
+        self.assertSequenceEqual(res, ['ERROR', 'No stats for java/dpe'])
+
     @mock.patch('clara_manager.ClaraManager.stop_clara')
     def test_dispatch_returns_error_if_request_failed(self, mock_sc):
         manager = ClaraManager(clara)
@@ -462,6 +1395,15 @@ class TestClaraManagerDispatch(unittest.TestCase):
         self.assertSequenceEqual(res, ['ERROR',
                                        'Unexpected exception: Popen error'])
 
+    @mock.patch('clara_manager.ClaraManager.standard_request')
+    def test_dispatch_standard_request_without_output(self, mock_sr):
+        manager = ClaraManager(clara)
+        mock_sr.return_value = [], [], 0
+
+        res = manager.dispatch_request('clara:request:java:list-dpes')
+
+        self.assertSequenceEqual(res, ['SUCCESS', ''])
+
     @mock.patch('clara_manager.ClaraManager.standard_request')
     def test_dispatch_returns_error_if_standard_request_failed(self, mock_sr):
         manager = ClaraManager(clara)
@@ -521,5 +1463,153 @@ class TestClaraManagerStandardRequest(unittest.TestCase):
         self.assertEqual(rc, 0)
 
 
+class TestClaraManagerQueries(unittest.TestCase):
+
+    helper = (
+        'import sys\n'
+        'for line in iter(sys.stdin.readline, ""):\n'
+        '    req = line.strip()\n'
+        '    if req == "crash":\n'
+        '        sys.exit(1)\n'
+        '    sys.stdout.write("%s\\n%s\\n%%%%END %d\\n" %\n'
+        '                     (req, req.upper(), req == "bad"))\n'
+        '    sys.stdout.flush()\n'
+    )
+
+    def setUp(self):
+        self.clara = {'logs': '/clara/logs', 'java': dict(clara['java'])}
+        self.manager = ClaraManager(self.clara)
+
+        self.mock_ro = patch_on_setup(self,
+                                      'clara_manager.ClaraManager.'
+                                      '_run_orchestrator')
+        self.mock_ro.return_value = ['DPE'], [], 0
+
+    def _helper_channel(self, timeout=5):
+        conf = mock.Mock()
+        conf.cmd = [sys.executable, '-c', self.helper]
+        conf.cwd = None
+        conf.env = None
+        conf.err = None
+        channel = QueryChannel(conf, timeout)
+        self.addCleanup(channel.close)
+        return channel
+
+    def test_query_not_cached_by_default(self):
+        self.manager.standard_request('java', 'list-dpes')
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 2)
+
+    @mock.patch('time.time')
+    def test_query_cached_until_ttl_expires(self, mock_tm):
+        self.clara['java']['query_ttl'] = 1.0
+
+        mock_tm.return_value = 10.0
+        res1 = self.manager.standard_request('java', 'list-dpes')
+        mock_tm.return_value = 10.5
+        res2 = self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 1)
+        self.assertEqual(res1, res2)
+
+        mock_tm.return_value = 11.5
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 2)
+
+    def test_query_skips_cache_if_requested(self):
+        self.clara['java']['query_ttl'] = 60
+
+        self.manager.standard_request('java', 'list-dpes')
+        self.manager.standard_request('java', 'list-dpes', cache=False)
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 2)
+
+    def test_query_errors_are_not_cached(self):
+        self.clara['java']['query_ttl'] = 60
+        self.mock_ro.return_value = [], ['ERR'], 1
+
+        self.manager.standard_request('java', 'list-dpes')
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 2)
+
+    @mock.patch('clara_manager.stop_processes')
+    @mock.patch('clara_manager.ClaraManager._start_process')
+    def test_start_and_stop_invalidate_cached_queries(self, mock_start,
+                                                      mock_stop):
+        self.clara['java']['query_ttl'] = 60
+        mock_stop.return_value = {'java/dpe': (0.1, False)}
+
+        self.manager.standard_request('java', 'list-dpes')
+        self.manager.start_clara('java', 'dpe')
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.manager.instances['java/dpe'] = mock.Mock()
+        self.manager.stop_clara('java', 'dpe')
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.manager.standard_request('java', 'list-dpes')
+
+        self.assertEqual(self.mock_ro.call_count, 3)
+
+    @mock.patch('clara_manager.QueryChannel')
+    @mock.patch('clara_manager.ClaraProcessConfig')
+    def test_query_uses_warm_channel_if_configured(self, mock_cc, mock_qc):
+        self.clara['java']['query'] = './bin/clara-query'
+        channel = mock_qc.return_value
+        channel.request.return_value = ['DPE'], [], 0
+
+        self.manager.standard_request('java', 'list-dpes')
+        res = self.manager.standard_request('java', 'list-dpes')
+
+        mock_cc.assert_called_once_with(self.clara, 'java', 'query')
+        mock_qc.assert_called_once_with(mock_cc.return_value)
+        self.assertEqual(channel.request.call_count, 2)
+        self.assertEqual(res, (['DPE'], [], 0))
+        self.assertFalse(self.mock_ro.called)
+
+    def test_query_channel_reuses_helper_process(self):
+        channel = self._helper_channel()
+
+        self.assertEqual(channel.request('list-dpes'),
+                         (['list-dpes', 'LIST-DPES'], [], 0))
+        proc = channel._conf.set_proc.call_args[0][0]
+
+        self.assertEqual(channel.request('bad'), (['bad', 'BAD'], [], 1))
+        self.assertEqual(channel._conf.set_proc.call_count, 1)
+        self.assertIsNone(proc.poll())
+
+    def test_fake_profile_answers_queries_on_a_warm_channel(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        fake = fake_profile(root)
+        os.makedirs(fake['logs'])
+        manager = ClaraManager(fake)
+        self.addCleanup(manager.close_channels)
+
+        self.assertEqual(manager.standard_request('java', 'list-dpes'),
+                         ([], [], 0))
+        os.makedirs(os.path.join(root, 'registry'))
+        with open(os.path.join(root, 'registry', 'x_admin'), 'w') as f:
+            f.write(str(os.getpid()))
+
+        self.assertEqual(manager.standard_request('java', 'list-dpes'),
+                         (['x_admin'], [], 0))
+        self.assertEqual(manager._channels.keys(), ['java'])
+        self.assertNotIn('query_ttl', fake['java'])
+
+    def test_query_channel_restarts_crashed_helper(self):
+        channel = self._helper_channel()
+
+        self.assertRaisesRegexp(ClaraManagerError, 'closed',
+                                channel.request, 'crash')
+        self.assertEqual(channel.request('list-dpes')[0],
+                         ['list-dpes', 'LIST-DPES'])
+        self.assertEqual(channel._conf.set_proc.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,164 @@
+import collections
+import mock
+import os
+import psutil
+import unittest
+
+from clara_monitor import ClaraMonitor
+from clara_monitor import ProcessTreeStats
+
+from test_clara_testing import patch_on_setup
+
+ctx = collections.namedtuple('ctx', 'voluntary involuntary')
+io = collections.namedtuple('io', 'read_bytes write_bytes')
+mem = collections.namedtuple('mem', 'rss vms')
+
+
+def fake_process(pid, cpu, rss, threads, switches, read, write, fds):
+    proc = mock.Mock()
+    proc.pid = pid
+    proc.get_cpu_percent.return_value = cpu
+    proc.get_memory_info.return_value = mem(rss, 0)
+    proc.get_num_threads.return_value = threads
+    proc.get_num_ctx_switches.return_value = ctx(switches, 0)
+    proc.get_io_counters.return_value = io(read, write)
+    proc.get_num_fds.return_value = fds
+    proc.get_children.return_value = []
+    return proc
+
+
+class TestProcessTreeStats(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_ps = patch_on_setup(self, 'psutil.Process')
+        self.mock_tm = patch_on_setup(self, 'time.time')
+
+        self.root = fake_process(10, 50.0, 1000, 4, 10, 100, 200, 8)
+        self.child = fake_process(11, 25.0, 500, 2, 5, 0, 50, 3)
+        self.root.get_children.return_value = [self.child]
+        self.mock_ps.return_value = self.root
+        self.mock_tm.return_value = 100.0
+
+    def test_sample_adds_the_whole_tree(self):
+        stats = ProcessTreeStats(10, 5)
+
+        sample = stats.sample()
+
+        self.mock_ps.assert_called_once_with(10)
+        self.root.get_children.assert_called_once_with(recursive=True)
+        self.assertEqual(tuple(sample),
+                         (100.0, 75.0, 1500, 6, 15, 100, 250, 11))
+
+    def test_samples_kept_in_ring_buffer(self):
+        stats = ProcessTreeStats(10, 3)
+
+        for t in range(5):
+            self.mock_tm.return_value = float(t)
+            stats.sample()
+
+        self.assertEqual([s.time for s in stats.samples], [2.0, 3.0, 4.0])
+
+    def test_sample_reuses_process_objects_for_cpu_usage(self):
+        stats = ProcessTreeStats(10, 3)
+
+        stats.sample()
+        stats.sample()
+
+        self.assertEqual(self.mock_ps.call_count, 1)
+        self.assertEqual(self.child.get_cpu_percent.call_count, 3)
+
+    def test_sample_skips_finished_children(self):
+        self.child.get_num_fds.side_effect = psutil.NoSuchProcess(11)
+        stats = ProcessTreeStats(10, 3)
+
+        self.assertEqual(stats.sample().rss, 1000)
+
+    def test_sample_finished_process(self):
+        self.mock_ps.side_effect = psutil.NoSuchProcess(10)
+        stats = ProcessTreeStats(10, 3)
+
+        self.assertIsNone(stats.sample())
+        self.assertFalse(stats.samples)
+
+    def test_summary(self):
+        stats = ProcessTreeStats(10, 5)
+
+        stats.sample()
+        self.root.get_cpu_percent.return_value = 95.0
+        self.root.get_memory_info.return_value = mem(4000, 0)
+        self.root.get_num_ctx_switches.return_value = ctx(40, 0)
+        self.root.get_io_counters.return_value = io(1100, 200)
+        stats.sample()
+
+        self.assertEqual(dict(stats.summary()), {
+            'samples': 2,
+            'cpu_mean': 97.5,
+            'cpu_max': 120.0,
+            'rss_peak': 4500,
+            'threads_max': 6,
+            'fds_max': 11,
+            'ctx_switches': 30,
+            'read_bytes': 1000,
+            'write_bytes': 0,
+        })
+
+    def test_summary_without_samples(self):
+        self.assertEqual(ProcessTreeStats(10, 5).summary(), [])
+
+
+class TestClaraMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_ts = patch_on_setup(self, 'clara_monitor.ProcessTreeStats')
+        self.monitor = ClaraMonitor(interval=0.5, samples=20)
+
+    def test_watch_creates_ring_buffer(self):
+        self.monitor.watch('java/dpe', 100)
+
+        self.mock_ts.assert_called_once_with(100, 20)
+
+    def test_sample_only_watched_instances(self):
+        stats1, stats2 = mock.Mock(), mock.Mock()
+        self.mock_ts.side_effect = [stats1, stats2]
+
+        self.monitor.watch('java/dpe', 100)
+        self.monitor.watch('java/platform', 200)
+        self.monitor.unwatch('java/dpe')
+        self.monitor.sample_all()
+
+        self.assertFalse(stats1.sample.called)
+        stats2.sample.assert_called_once_with()
+
+    def test_report_keeps_samples_of_stopped_instances(self):
+        stats = self.mock_ts.return_value
+        stats.summary.return_value = [('samples', 1), ('cpu_max', 12.5)]
+        stats.samples = [(1.5, 12.5, 1000, 4, 10, 100, 200, 8)]
+
+        self.monitor.watch('java/dpe', 100)
+        self.monitor.unwatch('java/dpe')
+
+        self.assertEqual(self.monitor.report('java/dpe'), [
+            'samples 1',
+            'cpu_max 12.5',
+            'time cpu rss threads ctx_switches read_bytes write_bytes fds',
+            '1.500 12.5 1000 4 10 100 200 8',
+        ])
+
+    def test_report_unknown_instance(self):
+        self.assertIsNone(self.monitor.report('java/dpe'))
+
+
+class TestClaraMonitorSampling(unittest.TestCase):
+
+    def test_sample_running_process(self):
+        stats = ProcessTreeStats(os.getpid(), 2)
+
+        sample = stats.sample()
+
+        self.assertGreater(sample.rss, 0)
+        self.assertGreater(sample.threads, 0)
+        self.assertGreater(sample.fds, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import json
+import os
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+from clara_report import build_report
+from clara_report import compare_reports
+from clara_report import format_report
+from clara_report import junit_xml
+from clara_report import percentile
+from clara_report import read_report
+from clara_report import write_json
+
+
+def action(kind, duration):
+    return {'action': kind, 'type': kind, 'client': duration,
+            'server': None, 'duration': duration}
+
+
+def suite(name, passed, tests, error=None):
+    return {'name': name, 'passed': passed, 'error': error,
+            'duration': sum(t['duration'] for t in tests), 'tests': tests}
+
+
+def test(name, actions, error=None):
+    return {'name': name, 'error': error, 'actions': actions,
+            'duration': sum(a['duration'] for a in actions)}
+
+
+class TestClaraReport(unittest.TestCase):
+
+    def setUp(self):
+        self.suites = [
+            suite('S1', True, [
+                test('test 1 [java]', [action('start dpe', 1.0),
+                                       action('list dpes', 0.1)]),
+                test('test 2 [java]', [action('start dpe', 3.0)]),
+            ]),
+            suite('S2', False, [
+                test('test 1 [java]', [action('start dpe', 2.0)],
+                     'Wrong result'),
+            ], 'Wrong result'),
+            suite('S3', False, [], 'Missing tests'),
+        ]
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile([4], 95), 4)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_build_report(self):
+        report = build_report(self.suites, 4.5)
+
+        self.assertFalse(report['passed'])
+        self.assertEqual(report['duration'], 4.5)
+        self.assertEqual(report['actions'], {
+            'start dpe': {'count': 3, 'p50': 2.0, 'p95': 3.0, 'max': 3.0},
+            'list dpes': {'count': 1, 'p50': 0.1, 'p95': 0.1, 'max': 0.1},
+        })
+
+    def test_compare_reports_flags_slowdowns(self):
+        previous = {'actions': {
+            'start dpe': {'p50': 1.0, 'p95': 2.9},
+            'list dpes': {'p50': 0.08, 'p95': 0.08},
+        }}
+
+        slowdowns = compare_reports(build_report(self.suites, 4.5), previous)
+
+        self.assertEqual(slowdowns, [{'type': 'start dpe', 'stat': 'p50',
+                                      'previous': 1.0, 'current': 2.0}])
+
+    def test_compare_reports_ignores_new_actions(self):
+        report = build_report(self.suites, 4.5)
+        self.assertEqual(compare_reports(report, {}), [])
+
+    def test_junit_xml(self):
+        root = ET.fromstring(junit_xml(build_report(self.suites, 4.5)))
+
+        self.assertEqual(root.get('tests'), '4')
+        self.assertEqual(root.get('failures'), '1')
+        self.assertEqual(root.get('errors'), '1')
+        self.assertEqual(root.get('time'), '4.500')
+        s1, s2, s3 = root.findall('testsuite')
+        self.assertEqual([(s.get('failures'), s.get('errors'))
+                          for s in (s1, s2, s3)],
+                         [('0', '0'), ('1', '0'), ('0', '1')])
+        self.assertEqual([c.get('name') for c in s1.findall('testcase')],
+                         ['test 1 [java]', 'test 2 [java]'])
+        self.assertEqual(s1.get('time'), '4.100')
+        failure = s2.find('testcase/failure')
+        self.assertEqual(failure.get('message'), 'Wrong result')
+        error = s3.find('testcase/error')
+        self.assertEqual(error.get('message'), 'Missing tests')
+
+    def test_junit_xml_suite_error_after_tests(self):
+        self.suites.append(suite('S4', False, [
+            test('test 1 [java]', [action('start dpe', 1.0)]),
+        ], 'Could not stop DPEs'))
+
+        root = ET.fromstring(junit_xml(build_report(self.suites, 5.5)))
+
+        self.assertEqual(root.get('tests'), '6')
+        self.assertEqual(root.get('errors'), '2')
+        s4 = root.findall('testsuite')[-1]
+        self.assertEqual(s4.get('tests'), '2')
+        self.assertEqual([c.get('name') for c in s4.findall('testcase')],
+                         ['test 1 [java]', 'setup'])
+        self.assertEqual(s4.find('testcase/error').get('message'),
+                         'Could not stop DPEs')
+
+    def test_json_round_trip(self):
+        report = build_report(self.suites, 4.5)
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        write_json(report, path)
+
+        self.assertEqual(read_report(path),
+                         json.loads(json.dumps(report)))
+
+    def test_format_report(self):
+        report = build_report(self.suites, 4.5)
+        report['slowdowns'] = [{'type': 'start dpe', 'stat': 'p95',
+                                'previous': 1.0, 'current': 3.0}]
+
+        lines = format_report(report)
+
+        self.assertTrue(lines[0].startswith('PASS  S1'))
+        self.assertTrue(lines[1].startswith('FAIL  S2'))
+        self.assertTrue(lines[5].startswith('list dpes'))
+        self.assertTrue(lines[6].startswith('start dpe'))
+        self.assertEqual(lines[-1],
+                         'SLOWER  start dpe p95: 1.000 s -> 3.000 s')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
+import json
 import mock
+import os
+import tempfile
+import threading
 import unittest
 import zmq
 
@@ -7,9 +11,18 @@ from clara_testing import ClaraDaemonClient
 from clara_testing import ClaraTest
 from clara_testing import ClaraTestSuite
 from clara_testing import ClaraTestRunner
+from clara_testing import ClusterState
+from clara_testing import TestPlan
+from clara_testing import TestStep
 
+from clara_testing import action_type
+from clara_testing import compile_test
 from clara_testing import get_all_files
+from clara_testing import is_idempotent
 from clara_testing import parse_action
+from clara_testing import parse_step
+from clara_testing import step_target
+from clara_testing import with_fe_host
 
 from test_clara_common import nodes
 
@@ -88,17 +101,154 @@ class TestClaraDaemonClient(unittest.TestCase):
         self._test_request_response(['SOMETHING', 'Text'],
                                     'Bad status: "SOMETHING"')
 
-    @mock.patch('clara_testing.ClaraDaemonClient._request')
-    def test_request_all(self, mock_rq):
-        msg = 'clara:stop:all:all'
-        n_nodes = len(nodes)
+    def test_request_batch_sends_multipart_message(self):
+        self.sck.recv_multipart.return_value = [
+            'SUCCESS', 'SUCCESS 0.250000\n', 'ERROR 0.001000\nBad\nrequest'
+        ]
+
+        msgs = ['clara:start:java:dpe', '&clara:request:java:list-dpes']
+        res = self.client.request_batch('platform', msgs)
+
+        self.sck.send_multipart.assert_called_once_with(['clara:batch'] +
+                                                        msgs)
+        self.assertEqual(res, [('SUCCESS', 0.25, ['']),
+                               ('ERROR', 0.001, ['Bad', 'request'])])
+
+    def test_request_batch_throws_if_bad_result(self):
+        self.sck.recv_multipart.return_value = ['SUCCESS', 'garbage']
+
+        self.assertRaisesRegexp(ClaraRequestError, 'Bad batch result',
+                                self.client.request_batch,
+                                'platform', ['clara:start:java:dpe'])
+
+    def test_request_batch_throws_if_empty(self):
+        self.assertRaisesRegexp(ClaraRequestError, 'Empty message',
+                                self.client.request_batch, 'platform', [])
+        self.assertRaisesRegexp(ClaraRequestError, 'Bad node',
+                                self.client.request_batch, 'bad', ['msg'])
+
+    def test_request_waits_reply_until_deadline(self):
+        self.sck.recv_multipart.return_value = ['SUCCESS', '']
+
+        self.client.request('platform', 'clara:start:java:dpe', 5)
 
-        request_calls = [mock.call(self.sck, msg)] * n_nodes
+        self.sck.poll.assert_called_once_with(5000, zmq.POLLIN)
 
-        self.client.request_all(msg)
+    def test_start_deadline_covers_readiness_and_stop(self):
+        self.sck.recv_multipart.return_value = ['SUCCESS', '']
+        start = json.dumps({'action': 'start', 'args': {'timeout': '60'}})
 
-        mock_rq.assert_has_calls(request_calls)
-        self.assertEqual(mock_rq.call_count, n_nodes)
+        self.client.request('platform', 'clara:request:java:list-dpes')
+        self.client.request('platform', 'clara:start:java:dpe')
+        self.client.request('platform', start)
+
+        self.assertEqual(self.sck.poll.call_args_list, [
+            mock.call(30000, zmq.POLLIN),
+            mock.call(40000, zmq.POLLIN),
+            mock.call(70000, zmq.POLLIN),
+        ])
+
+    def test_batch_deadline_scales_with_the_actions(self):
+        self.sck.recv_multipart.return_value = ['SUCCESS'] + \
+            ['SUCCESS 0.1\n'] * 3
+
+        self.client.request_batch('platform', ['clara:start:java:platform',
+                                               '&clara:start:java:dpe',
+                                               'clara:stats:java:dpe'])
+
+        self.sck.poll.assert_called_once_with(110000, zmq.POLLIN)
+
+    def test_request_fails_fast_if_not_idempotent(self):
+        self.sck.poll.return_value = 0
+
+        self.assertRaisesRegexp(ClaraRequestError,
+                                'Timeout: no reply from dpe1 after 40.0 s',
+                                self.client.request, 'dpe1',
+                                'clara:start:java:dpe')
+        self.sck.send.assert_called_once_with('clara:start:java:dpe')
+        self.sck.close.assert_called_once_with()
+
+    def test_request_retries_idempotent_request_on_new_socket(self):
+        self.sck.poll.side_effect = [0, 0, zmq.POLLIN]
+        self.sck.recv_multipart.return_value = ['SUCCESS', 'dpe']
+
+        text = self.client.request('dpe1', 'clara:request:java:list-dpes')
+
+        self.assertEqual(text, ['dpe'])
+        self.assertEqual(self.sck.send.call_count, 3)
+        self.assertEqual(self.sck.close.call_count, 2)
+        self.sck.setsockopt.assert_called_with(zmq.LINGER, 0)
+
+    def test_request_gives_up_after_retries(self):
+        self.sck.poll.return_value = 0
+
+        self.assertRaisesRegexp(ClaraRequestError, 'Timeout',
+                                self.client.request, 'dpe1',
+                                'clara:stats:java:dpe')
+        self.assertEqual(self.sck.send.call_count, 3)
+
+    def test_request_all_sends_before_collecting_replies(self):
+        client, socks, poller = self._broadcast_client()
+        poller.poll.side_effect = [[(socks['platform'], zmq.POLLIN)],
+                                   [(socks['dpe1'], zmq.POLLIN),
+                                    (socks['dpe2'], zmq.POLLIN)]]
+        socks['platform'].recv_multipart.return_value = ['SUCCESS', '']
+        socks['dpe1'].recv_multipart.return_value = ['SUCCESS', '']
+        socks['dpe2'].recv_multipart.return_value = ['ERROR', 'Failed']
+
+        res = client.request_all('clara:stop:all:all')
+
+        for sock in socks.values():
+            sock.send.assert_called_once_with('clara:stop:all:all')
+        self.assertEqual(poller.register.call_count, 3)
+        self.assertEqual(res, {'platform': ('SUCCESS', ['']),
+                               'dpe1': ('SUCCESS', ['']),
+                               'dpe2': ('ERROR', 'Failed')})
+
+    @mock.patch('time.time')
+    def test_request_all_reconnects_nodes_without_reply(self, mock_tm):
+        mock_tm.side_effect = [0, 0, 5, 31]
+        client, socks, poller = self._broadcast_client()
+        poller.poll.side_effect = [[(socks['dpe1'], zmq.POLLIN)], []]
+        socks['dpe1'].recv_multipart.return_value = ['SUCCESS', '']
+
+        res = client.request_all('clara:stop:all:all', timeout=30)
+
+        self.assertEqual(res['dpe1'], ('SUCCESS', ['']))
+        self.assertEqual(res['platform'][0], 'TIMEOUT')
+        self.assertEqual(res['dpe2'][0], 'TIMEOUT')
+        poller.poll.assert_has_calls([mock.call(30000), mock.call(25000)])
+        socks['platform'].close.assert_called_once_with()
+        self.assertFalse(socks['dpe1'].close.called)
+        self.assertIsNot(client._sockets['platform'], socks['platform'])
+
+    def test_subscribe_to_events(self):
+        self.ctx.socket.reset_mock()
+        self.sck.connect.reset_mock()
+
+        self.client.subscribe(['exit'], ['dpe1'])
+
+        self.ctx.socket.assert_called_once_with(zmq.SUB)
+        self.sck.setsockopt.assert_called_once_with(zmq.SUBSCRIBE, 'exit')
+        self.sck.connect.assert_called_once_with(
+            "tcp://%s:7789" % nodes['dpe1'])
+
+    def test_receive_event(self):
+        event = {'event': 'exit', 'instance': 'java/dpe', 'code': -9}
+        self.sck.poll.side_effect = [1, 0]
+        self.sck.recv_multipart.return_value = ['exit', json.dumps(event)]
+        stream = self.client.subscribe()
+
+        self.assertEqual(stream.receive(0.5), event)
+        self.assertIsNone(stream.receive(0.5))
+        self.sck.poll.assert_called_with(500, zmq.POLLIN)
+
+    def _broadcast_client(self):
+        self.ctx.socket.side_effect = lambda _: mock.MagicMock()
+        client = ClaraDaemonClient(self.ctx, nodes)
+        socks = dict(client._sockets)
+        poller = patch_on_setup(self, 'zmq.Poller').return_value
+        return client, socks, poller
 
     def _assert_request_exception(self, node, msg, err_msg):
         with self.assertRaises(ClaraRequestError) as e:
@@ -124,27 +274,149 @@ class TestClaraTest(unittest.TestCase):
         self.item = 'J'
 
         self.client.request.return_value = self.result
-        self.parser.return_value = (None, None)
+        self.parser.side_effect = lambda a, i: ('node' + a, 'msg' + a)
 
     def test_parse_all_actions(self):
         calls = [mock.call(a, self.item) for a in self.data['actions']]
 
-        ClaraTest(self.client, self.data, self.item).run()
+        self._create_test().run()
 
         self.parser.assert_has_calls(calls)
         self.assertEqual(self.parser.call_count, len(calls))
 
     def test_request_all_actions(self):
-        parsed = [('node', a) for a in self.data['actions']]
-        calls = [mock.call(*p) for p in parsed]
+        parsed = [('node' + a, a) for a in self.data['actions']]
+        calls = [mock.call(n, m, None) for n, m in parsed]
 
         self.parser.side_effect = parsed
 
-        ClaraTest(self.client, self.data, self.item).run()
+        self._create_test().run()
 
         self.client.request.assert_has_calls(calls)
         self.assertEqual(self.client.request.call_count, len(calls))
 
+    def test_batch_consecutive_actions_on_same_node(self):
+        parsed = [('dpe1', 'a1'), ('dpe1', 'a2'), ('dpe2', 'a3'),
+                  ('dpe1', 'a4'), ('dpe1', 'a5')]
+        self.data.update({'actions': list('12345'), 'result': ['']})
+        self.parser.side_effect = parsed
+        self.client.request_batch.return_value = [('SUCCESS', 0.1, [''])] * 2
+
+        self._create_test().run()
+
+        self.client.request_batch.assert_has_calls([
+            mock.call('dpe1', ['a1', 'a2'], None),
+            mock.call('dpe1', ['a4', 'a5'], None),
+        ])
+        self.client.request.assert_called_once_with('dpe2', 'a3', None)
+
+    def test_pass_test_timeout_as_request_deadline(self):
+        parsed = [('dpe1', 'a1'), ('dpe1', 'a2'), ('dpe2', 'a3')]
+        self.data.update({'actions': list('123'), 'timeout': 10})
+        self.parser.side_effect = parsed
+        self.client.request_batch.return_value = [('SUCCESS', 0.1, [''])] * 2
+        self.client.request.return_value = self.data['result']
+
+        self._create_test().run()
+
+        self.client.request_batch.assert_called_once_with('dpe1',
+                                                          ['a1', 'a2'], 20)
+        self.client.request.assert_called_once_with('dpe2', 'a3', 10)
+
+    def test_batch_uses_result_of_last_action(self):
+        self.parser.side_effect = None
+        self.parser.return_value = ('dpe1', 'msg')
+        self.client.request_batch.return_value = [
+            ('SUCCESS', 0.1, ['']), ('SUCCESS', 0.2, ['A']),
+            ('SUCCESS', 0.3, ['R'])
+        ]
+
+        self.assertEqual(self._create_test().run(),
+                         ['R'])
+
+    def test_raise_on_failed_batch_action(self):
+        self.parser.side_effect = None
+        self.parser.return_value = ('dpe1', 'msg')
+        self.client.request_batch.return_value = [
+            ('SUCCESS', 0.1, ['']), ('ERROR', 0.2, ['Bad', 'start']),
+            ('SKIPPED', 0.0, [''])
+        ]
+
+        self._assert_run_exception("Bad\nstart")
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_wait_polls_until_result_converges(self, mock_tm, mock_sl):
+        mock_tm.side_effect = [0, 0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+        self.client.request.side_effect = [['A'], ClaraRequestError('busy'),
+                                           ['A', 'B']]
+
+        result = self._run_wait(['A', 'B'], 10)
+
+        self.assertEqual(result, ['A', 'B'])
+        mock_sl.assert_has_calls([mock.call(0.05), mock.call(0.1)])
+        self.assertEqual(self.client.request.call_count, 3)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_wait_records_convergence_time(self, mock_tm, mock_sl):
+        mock_tm.side_effect = [10, 10, 11.5]
+        self.client.request.return_value = ['A']
+
+        test = ClaraTest(self.client, self._wait_plan(['A'], 5))
+        test.run()
+
+        self.client.request.assert_called_once_with('platform', 'msg', 5)
+        self.assertEqual(test.convergence, [('wait', 1.5)])
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_wait_raises_if_no_convergence(self, mock_tm, mock_sl):
+        mock_tm.side_effect = [0, 0, 2, 2, 4, 4, 6]
+        self.client.request.return_value = ['A']
+
+        self.assertRaisesRegexp(ClaraRequestError,
+                                'Timeout: no convergence after 5 s. '
+                                'Last result: ".*A.*"',
+                                self._run_wait, ['A', 'B'], 5)
+        self.assertEqual(self.client.request.call_count, 3)
+
+    def _wait_plan(self, expect, within):
+        step = TestStep('wait', 'platform', 'msg', expect, within)
+        return TestPlan('java', [step], expect, None)
+
+    def _run_wait(self, expect, within):
+        return ClaraTest(self.client, self._wait_plan(expect, within)).run()
+
+    def test_record_action_timings(self):
+        self.parser.side_effect = [
+            ('dpe1', 'clara:start:java:dpe'),
+            ('dpe1', 'clara:start:java:dpe.2'),
+            ('platform', 'clara:request:java:list-dpes'),
+        ]
+        self.client.request_batch.return_value = [('SUCCESS', 0.5, ['']),
+                                                  ('SUCCESS', 0.25, [''])]
+
+        test = self._create_test()
+        test.run()
+
+        self.assertEqual([t['type'] for t in test.timings],
+                         ['start dpe', 'start dpe', 'list dpes'])
+        self.assertEqual([t['server'] for t in test.timings],
+                         [0.5, 0.25, None])
+        self.assertEqual(test.timings[0]['duration'], 0.5)
+        self.assertEqual(test.timings[2]['duration'],
+                         test.timings[2]['client'])
+
+    def test_track_successful_steps_in_cluster_state(self):
+        state = mock.Mock()
+
+        ClaraTest(self.client, compile_test(self.data, self.item),
+                  state).run()
+
+        self.assertEqual([c[0][0].msg for c in state.track.call_args_list],
+                         ['msg1', 'msg2', 'msg3'])
+
     def test_run_using_result_of_last_action(self):
         self._assert_result((['A'], ['B'], ['C', 'D']), ['C', 'D'])
 
@@ -180,13 +452,16 @@ class TestClaraTest(unittest.TestCase):
         self.data.update({'result': result})
 
         self.client.request.side_effect = action_results
-        test = ClaraTest(self.client, self.data, self.item)
+        test = self._create_test()
 
         self.assertEqual(test.run(), result)
 
+    def _create_test(self):
+        return ClaraTest(self.client, compile_test(self.data, self.item))
+
     def _assert_run_exception(self, regex, exc=ClaraRequestError):
-        test = ClaraTest(self.client, self.data, self.item)
-        self.assertRaisesRegexp(exc, regex, test.run)
+        self.assertRaisesRegexp(exc, regex,
+                                lambda: self._create_test().run())
 
 
 class TestClaraTestSuite(unittest.TestCase):
@@ -195,6 +470,9 @@ class TestClaraTestSuite(unittest.TestCase):
         self.mock_cd = patch_on_setup(self, 'clara_testing.ClaraDaemonClient')
         self.mock_ry = patch_on_setup(self, 'clara_testing.read_yaml')
         self.mock_ct = patch_on_setup(self, 'clara_testing.ClaraTest')
+        self.mock_cp = patch_on_setup(self, 'clara_testing.compile_test')
+
+        self.mock_cp.side_effect = lambda data, item: (data, item)
 
     def _create_suite(self, data, test_file='./test.yaml'):
         self.mock_ry.return_value = data
@@ -208,6 +486,46 @@ class TestClaraTestSuite(unittest.TestCase):
 
         self.mock_ry.assert_called_once_with(name)
 
+    def test_read_node_roles(self):
+        self.mock_cp.side_effect = lambda data, item: mock.Mock(steps=[])
+        suite = self._create_suite({'tests': ['1']})
+        self.assertIsNone(suite.roles)
+
+        suite = self._create_suite({'tests': ['1'], 'nodes': ['dpe1']})
+        self.assertEqual(suite.roles, ['dpe1'])
+
+    def test_hold_platform_if_starting_java_dpes(self):
+        self.mock_cp.side_effect = compile_test
+        data = {'tests': [{'actions': ['start {{item}} dpe on dpe1'],
+                           'result': ['']}],
+                'nodes': ['dpe1']}
+        self.assertEqual(self._create_suite(data).roles,
+                         ['dpe1', 'platform'])
+
+        data['with'] = ['python']
+        self.assertEqual(self._create_suite(data).roles, ['dpe1'])
+
+    def test_report_error_if_steps_use_undeclared_nodes(self):
+        self.mock_cp.side_effect = compile_test
+        data = {'tests': [{'actions': ['start {{item}} dpe on dpe2'],
+                           'result': ['']}],
+                'setup': ['start platform'],
+                'nodes': ['dpe1']}
+
+        suite = self._create_suite(data)
+
+        self.assertEqual(suite.error, 'Unknown nodes: dpe2')
+        self.assertEqual(suite.nodes(), [])
+
+    def test_list_nodes_used_by_the_steps(self):
+        self.mock_cp.side_effect = compile_test
+        data = {'tests': [{'actions': ['start {{item}} dpe on dpe2'],
+                           'result': ['']}],
+                'setup': ['start platform']}
+
+        self.assertEqual(self._create_suite(data).nodes(),
+                         ['dpe2', 'platform'])
+
     def test_run_all_tests_in_file_with_no_items(self):
         data = {'tests': ['1', '2', '3']}
         tests = [(t, 'java') for t in data['tests']]
@@ -222,7 +540,7 @@ class TestClaraTestSuite(unittest.TestCase):
 
     def _assert_run_all_tests(self, test_data, exp_tests):
         def set_status(*args):
-            act_tests.append((args[1], args[2]))
+            act_tests.append(args[1])
             return mock.DEFAULT
 
         act_tests = []
@@ -249,6 +567,151 @@ class TestClaraTestSuite(unittest.TestCase):
 
         self.assertEqual(run.call_count, 2)
 
+    def test_compile_all_tests_before_sending_requests(self):
+        data = {'name': 'NAME', 'tests': ['1', '2', '3'], 'with': ['J', 'P']}
+
+        def compile_error(data, item):
+            if (data, item) == ('2', 'P'):
+                raise ClaraRequestError('Malformed action: "x"')
+            return data, item
+
+        self.mock_cp.side_effect = compile_error
+        client = self.mock_cd.return_value
+
+        suite = self._create_suite(data)
+
+        self.assertEqual(suite.error, 'Test 2 (P): Malformed action: "x"')
+        self.assertEqual(suite.run_tests(), (False, 'NAME'))
+        self.assertFalse(self.mock_ct.called)
+        self.assertFalse(client.request_all.called)
+
+    def test_cache_compiled_suites_by_path_and_mtime(self):
+        data = {'tests': ['1']}
+        self.mock_ry.return_value = data
+        with tempfile.NamedTemporaryFile(suffix='.yaml') as tf:
+            os.utime(tf.name, (1000, 1000))
+            ClaraTestSuite(None, tf.name)
+            ClaraTestSuite(None, tf.name)
+            self.assertEqual(self.mock_ry.call_count, 1)
+
+            os.utime(tf.name, (2000, 2000))
+            ClaraTestSuite(None, tf.name)
+            self.assertEqual(self.mock_ry.call_count, 2)
+
+    def test_record_test_results(self):
+        data = {'tests': ['1', '2'], 'with': ['J']}
+        test = self.mock_ct.return_value
+        test.timings = [{'type': 'start dpe'}]
+        test.run.side_effect = [None, ClaraRequestError('Wrong result')]
+
+        suite = self._create_suite(data)
+        suite.run_tests()
+
+        self.assertEqual([r['name'] for r in suite.results],
+                         ['test 1 [J]', 'test 2 [J]'])
+        self.assertEqual([r['error'] for r in suite.results],
+                         [None, 'Wrong result'])
+        self.assertEqual(suite.results[0]['actions'], test.timings)
+        self.assertEqual(suite.error, 'Wrong result')
+        self.assertGreaterEqual(suite.duration, 0.0)
+
+    def test_reset_unknown_nodes_and_start_setup(self):
+        data = {'tests': ['1'], 'setup': ['start platform']}
+        client = self.mock_cd.return_value
+        state = ClusterState()
+
+        self._create_suite(data).run_tests(client, state)
+
+        self.assertEqual(client.request.call_args_list, [
+            mock.call('platform', 'clara:stop:all:all'),
+            mock.call('platform', 'clara:start:java:platform'),
+        ])
+        self.assertFalse(client.request_all.called)
+        platform = state.node('platform')
+        self.assertTrue(platform.known)
+        self.assertEqual(platform.running, {
+            ('java', 'platform'): 'clara:start:java:platform'
+        })
+
+    def test_start_dpes_with_fe_host(self):
+        self.mock_cp.side_effect = compile_test
+        data = {'tests': [{'actions': ['start java dpe on dpe1'],
+                           'result': ['']}],
+                'setup': ['start java dpe on dpe2']}
+        client = self.mock_cd.return_value
+
+        self._create_suite(data).run_tests(client, ClusterState(), '10.1.1.1')
+
+        _, setup_msg = client.request.call_args_list[-1][0]
+        plan = self.mock_ct.call_args[0][1]
+        for msg in (setup_msg, plan.steps[0].msg):
+            self.assertEqual(json.loads(msg)['args'],
+                             {'fe_host': '10.1.1.1'})
+
+    def test_reuse_healthy_platform(self):
+        data = {'tests': ['1'], 'setup': ['start platform']}
+        client = self.mock_cd.return_value
+        state = self._running_state()
+
+        self._create_suite(data).run_tests(client, state)
+
+        client.request.assert_called_once_with(
+            'platform', 'clara:request:java:list-dpes')
+
+    def test_restart_platform_if_health_check_fails(self):
+        def request(node, msg):
+            if msg == 'clara:request:java:list-dpes':
+                raise ClaraRequestError('Timeout')
+
+        data = {'tests': ['1'], 'setup': ['start platform']}
+        client = self.mock_cd.return_value
+        client.request.side_effect = request
+
+        self._create_suite(data).run_tests(client, self._running_state())
+
+        self.assertEqual(client.request.call_args_list[1:], [
+            mock.call('platform', 'clara:stop:java:platform'),
+            mock.call('platform', 'clara:start:java:platform'),
+        ])
+
+    def test_stop_instances_not_in_setup(self):
+        data = {'tests': ['1'], 'setup': ['start platform']}
+        client = self.mock_cd.return_value
+        state = self._running_state()
+        state.node('dpe1').reset()
+        state.node('dpe1').running[('java', 'dpe')] = 'clara:start:java:dpe'
+
+        self._create_suite(data).run_tests(client, state)
+
+        client.request.assert_any_call('dpe1', 'clara:stop:java:dpe')
+        self.assertEqual(state.node('dpe1').running, {})
+
+    def test_stop_all_if_suite_fails_with_shared_state(self):
+        data = {'tests': ['1'], 'setup': ['start platform']}
+        client = self.mock_cd.return_value
+        client.request_all.return_value = {'platform': ('SUCCESS', [''])}
+        self.mock_ct.return_value.run.side_effect = ClaraRequestError
+        state = self._running_state()
+
+        self._create_suite(data).run_tests(client, state)
+
+        client.request_all.assert_called_once_with('clara:stop:all:all')
+        self.assertEqual(state.node('platform').running, {})
+
+    def test_reject_setup_actions_other_than_start(self):
+        data = {'tests': ['1'], 'setup': ['stop platform']}
+
+        suite = self._create_suite(data)
+
+        self.assertRegexpMatches(suite.error, 'Setup .* Only start actions')
+
+    def _running_state(self):
+        state = ClusterState()
+        platform = state.node('platform')
+        platform.reset()
+        platform.running[('java', 'platform')] = 'clara:start:java:platform'
+        return state
+
     def test_use_filename_if_no_name(self):
         data = {'tests': ['1']}
 
@@ -320,46 +783,260 @@ class TestClaraTestRunner(unittest.TestCase):
     def setUp(self):
         self.mock_ctx = patch_on_setup(self, 'zmq.Context')
         self.mock_cln = patch_on_setup(self, 'clara_testing.ClaraDaemonClient')
+        self.mock_cts = patch_on_setup(self, 'clara_testing.ClaraTestSuite')
+
+        self.mock_cts.return_value.roles = None
+        self.mock_cts.return_value.error = None
 
         self.test_files = ['./t/01.yaml', './t/02.yaml', './t/05.yaml']
         self.runner = ClaraTestRunner(nodes, self.test_files)
-
-    def test_start_client(self):
         self.runner.start_client()
 
-        ctx = self.mock_ctx.return_value
-        self.mock_cln.assert_called_once_with(ctx, nodes)
+    def test_start_client(self):
+        self.mock_ctx.assert_called_once_with()
 
-    @mock.patch('clara_testing.ClaraTestSuite')
-    def test_run_all_files(self, mock_cts):
+    def test_run_all_files(self):
         def set_status(*args):
             test_suites.append(args[1])
             return mock.DEFAULT
 
         test_suites = []
-        mock_cts.side_effect = set_status
+        self.mock_cts.side_effect = set_status
 
         self.runner.run_all_tests()
 
         self.assertEqual(test_suites, self.test_files)
 
-    @mock.patch('clara_testing.ClaraTestSuite')
-    def test_report_all_tests(self, mock_cts):
-        mock_cts.return_value.run_tests.side_effect = self.test_files
+    def test_report_all_tests(self):
+        self.mock_cts.return_value.run_tests.side_effect = self.test_files
 
         result = self.runner.run_all_tests()
 
         self.assertEqual(result, self.test_files)
 
+    def test_run_each_suite_with_its_own_client(self):
+        suite = self.mock_cts.return_value
+        ctx = self.mock_ctx.return_value
+        client = self.mock_cln.return_value
+
+        self.runner.run_all_tests()
+
+        self.assertEqual(self.mock_cln.call_args_list[:3],
+                         [mock.call(ctx, nodes)] * 3)
+        suite.run_tests.assert_called_with(client, mock.ANY,
+                                           nodes['platform'])
+        self.assertEqual(suite.run_tests.call_count, 3)
+
+    def test_share_node_state_between_suites(self):
+        suite = self.mock_cts.return_value
+
+        self.runner.run_all_tests()
+
+        states = [c[0][1] for c in suite.run_tests.call_args_list]
+        self.assertEqual(sorted(states[0].nodes), sorted(nodes))
+        for role in nodes:
+            self.assertIs(states[0].nodes[role], states[2].nodes[role])
+
+    def test_stop_all_nodes_after_last_suite(self):
+        ctx = self.mock_ctx.return_value
+        client = self.mock_cln.return_value
+
+        self.runner.run_all_tests()
+
+        self.assertEqual(self.mock_cln.call_count, 4)
+        self.mock_cln.assert_called_with(ctx, nodes)
+        client.request_all.assert_called_once_with('clara:stop:all:all')
+        self.assertEqual(client.close.call_count, 4)
+
+    def test_run_suites_with_disjoint_roles_concurrently(self):
+        running = []
+        both = threading.Event()
+        lock = threading.Lock()
+
+        def run_tests(client, state, fe_host):
+            with lock:
+                running.append(client.nodes)
+                if len(running) == 2:
+                    both.set()
+            return (both.wait(5), 'suite')
+
+        suites = [mock.MagicMock(roles=['platform', 'dpe1'], error=None),
+                  mock.MagicMock(roles=['dpe2'], error=None)]
+        for suite in suites:
+            suite.name = 'suite'
+            suite.run_tests.side_effect = run_tests
+        self.mock_cts.side_effect = suites
+        self.mock_cln.side_effect = \
+            lambda ctx, nodes: mock.MagicMock(nodes=sorted(nodes.items()))
+
+        result = ClaraTestRunner(nodes, ['a', 'b']).run_all_tests()
+
+        self.assertEqual(result, [(True, 'suite'), (True, 'suite')])
+        self.assertEqual(sorted(running), [
+            [('dpe1', nodes['dpe1']), ('platform', nodes['platform'])],
+            [('dpe2', nodes['dpe2'])],
+        ])
+
+    def test_run_suites_sharing_roles_on_separate_groups(self):
+        groups = [{'platform': '10.1.1.1'}, {'platform': '10.2.2.2'}]
+        suites = [mock.MagicMock(roles=['platform'], error=None)
+                  for _ in range(2)]
+        for suite in suites:
+            suite.name = 'suite'
+        self.mock_cts.side_effect = suites
+
+        ClaraTestRunner(groups, ['a', 'b']).run_all_tests()
+
+        calls = self.mock_cln.call_args_list[:2]
+        used = sorted(args[1]['platform'] for args, _ in calls)
+        self.assertEqual(used, ['10.1.1.1', '10.2.2.2'])
+
+    def test_dpes_register_with_the_platform_of_their_group(self):
+        groups = [{'platform': '10.1.1.1', 'dpe1': '10.1.1.2'},
+                  {'platform': '10.2.2.1', 'dpe1': '10.2.2.2'}]
+        suites = [mock.MagicMock(roles=['platform', 'dpe1'], error=None)
+                  for _ in range(2)]
+        for suite in suites:
+            suite.name = 'suite'
+        self.mock_cts.side_effect = suites
+        self.mock_cln.side_effect = \
+            lambda ctx, nodes: mock.MagicMock(nodes=nodes)
+
+        ClaraTestRunner(groups, ['a', 'b']).run_all_tests()
+
+        used = sorted((c[0][0].nodes['dpe1'], c[0][2])
+                      for c in [s.run_tests.call_args for s in suites])
+        self.assertEqual(used, [('10.1.1.2', '10.1.1.1'),
+                                ('10.2.2.2', '10.2.2.1')])
+
+    def test_no_fe_host_if_platform_is_not_held(self):
+        suite = mock.MagicMock(roles=['dpe1'], error=None)
+        suite.name = 'suite'
+        self.mock_cts.side_effect = [suite]
+
+        ClaraTestRunner(nodes, ['a']).run_all_tests()
+
+        self.assertIsNone(suite.run_tests.call_args[0][2])
+
+    def test_stop_client(self):
+        ctx = self.mock_ctx.return_value
+
+        self.runner.stop_client()
+        self.runner.stop_client()
+
+        ctx.destroy.assert_called_once_with(linger=0)
+
+    def test_build_report_from_suites(self):
+        suite = self.mock_cts.return_value
+        suite.duration = 1.5
+        suite.error = None
+        suite.results = [{'name': 'test 1 [java]', 'error': None,
+                          'duration': 1.5, 'actions': [
+                              {'type': 'start dpe', 'duration': 1.5},
+                          ]}]
+        suite.run_tests.side_effect = [(True, 'A'), (False, 'B'),
+                                       (True, 'C')]
+
+        self.runner.run_all_tests()
+        report = self.runner.report()
+
+        self.assertFalse(report['passed'])
+        self.assertEqual([s['name'] for s in report['suites']],
+                         ['A', 'B', 'C'])
+        self.assertEqual(report['actions']['start dpe']['count'], 3)
+        self.assertLess(report['duration'], 1.5)
+
+    def test_report_error_if_suite_does_not_compile(self):
+        suite = self.mock_cts.return_value
+        suite.name = 'NAME'
+        suite.error = 'Test 1 (java): Malformed action: "x"'
+
+        result = self.runner.run_all_tests()
+
+        self.assertEqual(result, [(False, 'NAME')] * 3)
+        self.assertFalse(self.mock_cln.called)
+        self.assertFalse(suite.run_tests.called)
+
+    def test_report_error_if_roles_are_not_configured(self):
+        suite = self.mock_cts.return_value
+        suite.name = 'NAME'
+        suite.roles = ['dpe9']
+
+        result = self.runner.run_all_tests()
+
+        self.assertEqual(result, [(False, 'NAME')] * 3)
+        self.assertFalse(suite.run_tests.called)
+
+    def test_report_error_if_nodes_are_not_configured(self):
+        suite = self.mock_cts.return_value
+        suite.name = 'NAME'
+        suite.nodes.return_value = ['dpe1', 'dpe9']
+
+        result = self.runner.run_all_tests()
+
+        self.assertEqual(result, [(False, 'NAME')] * 3)
+        self.assertEqual(suite.error, 'Unknown nodes: dpe9')
+        self.assertFalse(suite.run_tests.called)
+        self.assertFalse(self.mock_cln.called)
+
 
 class TestUtils(unittest.TestCase):
 
+    def test_action_type(self):
+        def step(msg, expect=None):
+            return TestStep('action', 'node', msg, expect, None)
+
+        self.assertEqual(action_type(step('clara:start:java:platform')),
+                         'start platform')
+        self.assertEqual(action_type(step('clara:stop:python:dpe.3')),
+                         'stop dpe')
+        self.assertEqual(action_type(step('clara:request:java:list-dpes')),
+                         'list dpes')
+        self.assertEqual(action_type(step('clara:request:java:list-dpes',
+                                          ['R'])),
+                         'wait list dpes')
+        msg = json.dumps({'action': 'start',
+                          'target': {'lang': 'java', 'instance': 'dpe'}})
+        self.assertEqual(action_type(step(msg)), 'start dpe')
+
+    def test_cluster_state_tracks_started_instances(self):
+        def step(node, msg):
+            return TestStep('action', node, msg, None, None)
+
+        state = ClusterState()
+        state.track(step('platform', 'clara:start:java:platform'))
+        state.track(step('dpe1', 'clara:start:java:dpe'))
+        state.track(step('dpe1', 'clara:start:python:dpe'))
+        state.track(step('dpe1', 'clara:stop:java:dpe'))
+        state.track(step('platform', 'clara:stop:all:all'))
+
+        self.assertEqual(state.node('platform').running, {})
+        self.assertEqual(state.node('dpe1').running, {
+            ('python', 'dpe'): 'clara:start:python:dpe'
+        })
+
+    def test_is_idempotent(self):
+        self.assertTrue(is_idempotent('clara:request:java:list-dpes'))
+        self.assertTrue(is_idempotent('clara:logs:tail:java:dpe:5'))
+        self.assertTrue(is_idempotent(json.dumps({'action': 'stats'})))
+        self.assertTrue(is_idempotent(['clara:batch',
+                                       'clara:stats:java:dpe',
+                                       '&clara:stats:java:platform']))
+        self.assertFalse(is_idempotent('clara:start:java:dpe'))
+        self.assertFalse(is_idempotent(json.dumps({'action': 'stop'})))
+        self.assertFalse(is_idempotent(['clara:batch',
+                                        'clara:stats:java:dpe',
+                                        'clara:stop:java:dpe']))
+
     @mock.patch('os.listdir')
     def test_get_all_files(self, mock_ls):
         mock_ls.return_value = ['01-run.yaml', '02-dpes.yaml', 'dummmy']
 
         self.assertEqual(get_all_files('.'),
                          ['./tests/01-run.yaml', './tests/02-dpes.yaml'])
+        self.assertEqual(get_all_files('..', 'tests-local'),
+                         ['../tests-local/01-run.yaml',
+                          '../tests-local/02-dpes.yaml'])
 
     def test_parse_action_replace_item(self):
         self.assertEqual(parse_action('start {{item}} platform', 'python'),
@@ -386,8 +1063,80 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(parse_action('stop java dpe on dpe1'),
                          ('dpe1', 'clara:stop:java:dpe'))
 
+        self.assertEqual(parse_action('start java dpe 2 on dpe1'),
+                         ('dpe1', 'clara:start:java:dpe.2'))
+
         self.assertRaises(ClaraRequestError, parse_action, 'start dpe on node')
 
+    def test_parse_action_with_arguments(self):
+        node, msg = parse_action('start {{item}} dpe on dpe1 with '
+                                 'pool_size=4 jvm_opts="-Xms1g -Xmx2g"',
+                                 'java')
+
+        self.assertEqual(node, 'dpe1')
+        self.assertEqual(json.loads(msg), {
+            'version': 1,
+            'action': 'start',
+            'target': {'lang': 'java', 'instance': 'dpe'},
+            'args': {'pool_size': '4', 'jvm_opts': '-Xms1g -Xmx2g'},
+        })
+
+        self.assertRaisesRegexp(ClaraRequestError,
+                                'Malformed argument: "pool_size"',
+                                parse_action,
+                                'start java dpe on dpe1 with pool_size')
+
+    def test_parse_wait_step(self):
+        step = parse_step('wait until request list dpes equals '
+                          '[10.1.1.1_admin, 10.1.1.2_admin] within 10s')
+
+        self.assertEqual(step.node, 'platform')
+        self.assertEqual(json.loads(step.msg), {
+            'version': 1,
+            'action': 'request',
+            'target': {'lang': 'java', 'instance': 'list-dpes'},
+            'args': {'cache': False},
+        })
+        self.assertEqual(step.expect, ['10.1.1.1_admin', '10.1.1.2_admin'])
+        self.assertEqual(step.within, 10.0)
+
+    def test_parse_wait_step_using_test_result(self):
+        step = parse_step('wait until request {{item}} list dpes on dpe1 '
+                          'equals result within 2.5', 'python', ['R'])
+
+        self.assertEqual(step.node, 'dpe1')
+        self.assertEqual(step_target(step),
+                         ('request', 'python', 'list-dpes'))
+        self.assertEqual(step.expect, ['R'])
+        self.assertEqual(step.within, 2.5)
+
+    def test_dpe_start_with_fe_host(self):
+        def msg(action):
+            return with_fe_host(parse_step(action), '10.2.2.1').msg
+
+        self.assertEqual(json.loads(msg('start java dpe 2 on dpe1')), {
+            'version': 1,
+            'action': 'start',
+            'target': {'lang': 'java', 'instance': 'dpe.2'},
+            'args': {'fe_host': '10.2.2.1'},
+        })
+        self.assertEqual(
+            json.loads(msg('start java dpe on dpe1 with pool_size=2'))['args'],
+            {'fe_host': '10.2.2.1', 'pool_size': '2'})
+        self.assertEqual(
+            json.loads(msg('start java dpe on dpe1 with fe_host=h'))['args'],
+            {'fe_host': 'h'})
+        self.assertEqual(msg('start platform'), 'clara:start:java:platform')
+        self.assertEqual(msg('stop java dpe on dpe1'), 'clara:stop:java:dpe')
+        self.assertEqual(msg('start python dpe on dpe1'),
+                         'clara:start:python:dpe')
+
+    def test_parse_non_wait_step(self):
+        step = parse_step('start java dpe on dpe1')
+
+        self.assertEqual(step, TestStep('start java dpe on dpe1', 'dpe1',
+                                        'clara:start:java:dpe', None, None))
+
     def test_parse_action_for_standard_requests(self):
         self.assertEqual(parse_action('request list dpes'),
                          ('platform', 'clara:request:java:list-dpes'))